@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncContextManager, Callable, Dict, List, Optional
+
+import aiohttp
+import requests
+
+from stub_server import run_stub_server
+
+
+# Compare sequential requests, requests in threads and aiohttp against a
+# local stand-in server, so results don't depend on python.org and network.
+
+
+def fetch_sequential(urls: List[str], concurrency: int) -> List[float]:
+    latencies = []
+    with requests.Session() as session:
+        for url in urls:
+            start = time.perf_counter()
+            session.get(url).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def fetch_threads(urls: List[str], concurrency: int) -> List[float]:
+    local = threading.local()
+
+    def fetch(url: str) -> float:
+        # requests.Session is not thread-safe, one per thread
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        session.get(url).raise_for_status()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return [latency for latency in executor.map(fetch, urls)]
+
+
+def fetch_aiohttp(urls: List[str], concurrency: int) -> List[float]:
+    async def fetch_all() -> List[float]:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            limit = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*(fetch(session, limit, url) for url in urls))
+
+    async def fetch(
+        session: aiohttp.ClientSession, limit: asyncio.Semaphore, url: str
+    ) -> float:
+        async with limit:
+            start = time.perf_counter()
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                await resp.read()
+            return time.perf_counter() - start
+
+    return asyncio.run(fetch_all())
+
+
+STRATEGIES: Dict[str, Callable[[List[str], int], List[float]]] = {
+    "sequential": fetch_sequential,
+    "threads": fetch_threads,
+    "aiohttp": fetch_aiohttp,
+}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    # Nearest-rank, statistics.quantiles() needs Python 3.8
+    index = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+
+def run_strategy(name: str, urls: List[str], concurrency: int) -> Dict[str, Any]:
+    """Run in a fresh process, so peak RSS belongs to this strategy only"""
+    start = time.perf_counter()
+    latencies = sorted(STRATEGIES[name](urls, concurrency))
+    elapsed = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024  # reported in KiB
+    return {
+        "strategy": name,
+        "concurrency": concurrency,
+        "requests": len(urls),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(urls) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mib": round(max_rss / 1024 ** 2, 1),
+    }
+
+
+class LocalServer:
+    """Run the stand-in server in a background thread of this process"""
+
+    def __init__(self, delay: float, size: int) -> None:
+        self._server: AsyncContextManager[str] = run_stub_server(delay=delay, size=size)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def __enter__(self) -> str:
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(self._server.__aenter__(), self._loop)
+        return future.result()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        future = asyncio.run_coroutine_threadsafe(
+            self._server.__aexit__(None, None, None), self._loop
+        )
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    columns = list(results[0])
+    widths = [max(len(col), *(len(str(r[col])) for r in results)) for col in columns]
+    print("  ".join(col.rjust(width) for col, width in zip(columns, widths)))
+    for result in results:
+        print(
+            "  ".join(
+                str(result[col]).rjust(width) for col, width in zip(columns, widths)
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="HTTP client strategies benchmark")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES))
+    parser.add_argument(
+        "--delay", type=float, default=0.05, help="server latency, seconds"
+    )
+    parser.add_argument("--size", type=int, default=50_000, help="page size, bytes")
+    parser.add_argument("--json", dest="json_path", help="save results to the file")
+    args = parser.parse_args()
+
+    results = []
+    # Spawned children start clean instead of inheriting the server thread
+    ctx = multiprocessing.get_context("spawn")
+    with LocalServer(args.delay, args.size) as base_url:
+        urls = [f"{base_url}/dev/peps/pep-{i}/" for i in range(args.requests)]
+        for name in args.strategies:
+            for concurrency in args.concurrency:
+                if name == "sequential" and concurrency != args.concurrency[0]:
+                    continue  # concurrency makes no difference
+                with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+                    future = executor.submit(run_strategy, name, urls, concurrency)
+                    result = future.result()
+                print(f"{name} x{concurrency}: {result['rps']} req/s", file=sys.stderr)
+                results.append(result)
+
+    print_table(results)
+    json_path: Optional[str] = args.json_path
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import aiohttp
+from yarl import URL
+
+from download import CHUNK_SIZE, DiskWriter
+from stub_server import run_stub_server
+
+
+Handler = Callable[[str, aiohttp.ClientResponse], Awaitable[None]]
+
+# Worth another try: the server is overloaded or temporarily broken
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+@dataclass
+class CrawlStats:
+    started: float = field(default_factory=time.perf_counter)
+    done: int = 0
+    failed: int = 0
+    retries: int = 0
+    bytes: int = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self) -> str:
+        elapsed = self.elapsed
+        rate = self.done / elapsed if elapsed else 0.0
+        mbps = self.bytes / elapsed / 1024 ** 2 if elapsed else 0.0
+        return (
+            f"{self.done} done, {self.failed} failed, {self.retries} retries "
+            f"in {elapsed:0.2f}s ({rate:0.1f} req/s, {mbps:0.2f} MiB/s)"
+        )
+
+
+class HostLimiter:
+    """Per-host concurrency and request rate limits.
+
+    At most *concurrency* requests to a host run at once, and request
+    starts are spaced by 1 / *rate* seconds when *rate* is given.
+    """
+
+    def __init__(self, concurrency: int, rate: Optional[float] = None) -> None:
+        self._concurrency = concurrency
+        self._interval = 1 / rate if rate else 0.0
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._next_start: Dict[str, float] = {}
+
+    async def acquire(self, host: str) -> None:
+        sem = self._semaphores.get(host)
+        if sem is None:
+            sem = self._semaphores[host] = asyncio.Semaphore(self._concurrency)
+        await sem.acquire()
+        if self._interval:
+            loop = asyncio.get_event_loop()
+            now = loop.time()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self._interval
+            await asyncio.sleep(start - now)
+
+    def release(self, host: str) -> None:
+        self._semaphores[host].release()
+
+
+class Crawler:
+    """Fetch many URLs with a fixed pool of workers and one shared session.
+
+    URLs are consumed lazily through a bounded queue, so the number of
+    pending tasks doesn't grow with the input.  Failed requests are retried
+    with exponential backoff and jitter, *handler* is called with every
+    successful response and should read its body.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = 10,
+        per_host: int = 4,
+        rate: Optional[float] = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+        progress_interval: Optional[float] = None,
+    ) -> None:
+        self._workers = workers
+        self._per_host = per_host
+        self._limiter = HostLimiter(per_host, rate)
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._progress_interval = progress_interval
+        self.stats = CrawlStats()
+
+    async def crawl(self, urls: Iterable[str], handler: Handler) -> CrawlStats:
+        self.stats = CrawlStats()
+        connector = aiohttp.TCPConnector(
+            limit=self._workers, limit_per_host=self._per_host
+        )
+        queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(self._workers * 2)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=self._timeout
+        ) as session:
+            workers = [
+                asyncio.ensure_future(self._worker(session, queue, handler))
+                for _ in range(self._workers)
+            ]
+            progress = None
+            if self._progress_interval:
+                progress = asyncio.ensure_future(self._progress())
+            try:
+                for url in urls:
+                    await queue.put(url)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+                if progress is not None:
+                    progress.cancel()
+        return self.stats
+
+    async def _worker(
+        self,
+        session: aiohttp.ClientSession,
+        queue: "asyncio.Queue[Optional[str]]",
+        handler: Handler,
+    ) -> None:
+        while True:
+            url = await queue.get()
+            if url is None:
+                return
+            try:
+                await self._fetch(session, url, handler)
+                self.stats.done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # A failed URL, including a handler error, must not stop
+                # the worker: the others would be left to do all the work.
+                self.stats.failed += 1
+                print(f"Failed {url}: {str(exc) or type(exc).__name__}")
+
+    async def _fetch(
+        self, session: aiohttp.ClientSession, url: str, handler: Handler
+    ) -> None:
+        host = URL(url).host or ""
+        attempt = 0
+        while True:
+            await self._limiter.acquire(host)
+            try:
+                async with session.get(url) as resp:
+                    if resp.status not in RETRY_STATUSES:
+                        resp.raise_for_status()
+                        await handler(url, resp)
+                        self.stats.bytes += resp.content.total_bytes
+                        return
+                    error: Exception = aiohttp.ClientResponseError(
+                        resp.request_info,
+                        resp.history,
+                        status=resp.status,
+                        message=resp.reason or "",
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                error = exc
+            finally:
+                self._limiter.release(host)
+            if attempt >= self._retries:
+                raise error
+            delay = self._backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _progress(self) -> None:
+        assert self._progress_interval
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            print(self.stats.report())
+
+
+def pep_urls(base_url: str, first: int, count: int) -> Iterable[str]:
+    for pep_number in range(first, first + count):
+        yield f"{base_url}/dev/peps/pep-{pep_number}/"
+
+
+def page_saver(writer: DiskWriter, directory: Path) -> Handler:
+    async def save_page(url: str, resp: aiohttp.ClientResponse) -> None:
+        # Streamed chunk by chunk, neither memory nor the loop depend on size
+        pep_number = URL(url).parts[-2].rsplit("-", 1)[-1]
+        path = directory / f"async_{pep_number}.html"
+        await writer.save(resp.content.iter_chunked(CHUNK_SIZE), path)
+
+    return save_page
+
+
+async def discard_page(url: str, resp: aiohttp.ClientResponse) -> None:
+    async for _ in resp.content.iter_any():
+        pass
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Download PEPs concurrently")
+    parser.add_argument("--first", type=int, default=8010)
+    parser.add_argument("--count", type=int, default=7)
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--per-host", type=int, default=4)
+    parser.add_argument("--rate", type=float, help="requests per second per host")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument(
+        "--save-dir",
+        type=Path,
+        help="directory for downloaded pages, default is current one",
+    )
+    parser.add_argument("--fsync", action="store_true", help="fsync saved pages")
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="crawl a local stand-in server, pages are discarded unless --save-dir",
+    )
+    args = parser.parse_args()
+
+    crawler = Crawler(
+        workers=args.workers,
+        per_host=args.per_host,
+        rate=args.rate,
+        retries=args.retries,
+        progress_interval=1.0,
+    )
+    writer = DiskWriter(fsync=args.fsync)
+    handler = page_saver(writer, args.save_dir or Path.cwd())
+    try:
+        if args.local:
+            if args.save_dir is None:
+                handler = discard_page
+            async with run_stub_server(delay=0.01, failure_rate=0.01) as base_url:
+                urls = pep_urls(base_url, args.first, args.count)
+                stats = await crawler.crawl(urls, handler)
+        else:
+            urls = pep_urls("https://www.python.org", args.first, args.count)
+            stats = await crawler.crawl(urls, handler)
+    finally:
+        writer.close()
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
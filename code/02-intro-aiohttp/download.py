@@ -0,0 +1,109 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterable, BinaryIO, Optional
+
+import aiohttp
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DiskWriter:
+    """Write streamed downloads to disk from a small pool of threads.
+
+    Every download gets a bounded queue of chunks between the network and
+    the disk, so memory per download stays under *queue_size* chunks no
+    matter how large the file is, and a slow disk pushes back on the
+    socket.  Files are written to a temporary name, optionally fsynced,
+    and renamed into place only when complete.
+    """
+
+    def __init__(
+        self, threads: int = 4, *, queue_size: int = 8, fsync: bool = False
+    ) -> None:
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="writer")
+        self._queue_size = queue_size
+        self._fsync = fsync
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    async def save(self, chunks: AsyncIterable[bytes], path: Path) -> int:
+        """Write *chunks* to *path* atomically, return the number of bytes"""
+        loop = asyncio.get_event_loop()
+        tmp = path.with_name(f".{path.name}.part")
+        f = await loop.run_in_executor(self._executor, open, tmp, "wb")
+        queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(self._queue_size)
+        writer = asyncio.ensure_future(self._write_chunks(f, queue))
+        size = 0
+        try:
+            try:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    # Waits while the disk is behind, TCP flow control
+                    # then slows down the sender.
+                    await _put(queue, chunk, writer)
+                await _put(queue, None, writer)
+                await writer
+            finally:
+                writer.cancel()
+                await loop.run_in_executor(self._executor, f.close)
+            await loop.run_in_executor(self._executor, os.replace, tmp, path)
+        except BaseException:
+            try:
+                await loop.run_in_executor(self._executor, tmp.unlink)
+            except FileNotFoundError:
+                pass
+            raise
+        return size
+
+    async def _write_chunks(
+        self, f: BinaryIO, queue: "asyncio.Queue[Optional[bytes]]"
+    ) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            await loop.run_in_executor(self._executor, f.write, chunk)
+        if self._fsync:
+            await loop.run_in_executor(self._executor, _fsync, f)
+
+
+async def _put(
+    queue: "asyncio.Queue[Optional[bytes]]",
+    item: Optional[bytes],
+    writer: "asyncio.Future[None]",
+) -> None:
+    if writer.done():
+        writer.result()  # raises the write error
+    if not queue.full():
+        queue.put_nowait(item)
+        return
+    # Don't wait on a full queue forever if the writer fails meanwhile
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait([put, writer], return_when=asyncio.FIRST_COMPLETED)
+    if writer.done():
+        put.cancel()
+        writer.result()  # raises the write error
+
+
+def _fsync(f: BinaryIO) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+async def download(
+    session: aiohttp.ClientSession,
+    url: str,
+    path: Path,
+    writer: DiskWriter,
+    *,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """Stream *url* into *path* without buffering the body in memory"""
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        return await writer.save(resp.content.iter_chunked(chunk_size), path)
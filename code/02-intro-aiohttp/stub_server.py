@@ -0,0 +1,53 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aiohttp import web
+
+
+# Local stand-in for www.python.org, serves fake PEP pages so the crawler
+# can be tried and measured without hammering the real site.
+
+
+async def pep_page(request: web.Request) -> web.Response:
+    app = request.app
+    await asyncio.sleep(app["DELAY"])
+    if random.random() < app["FAILURE_RATE"]:
+        raise web.HTTPServiceUnavailable()
+    pep_number = request.match_info["number"]
+    head = f"<html><body><h1>PEP {pep_number}</h1><p>"
+    tail = "</p></body></html>\n"
+    filler = "x" * max(app["SIZE"] - len(head) - len(tail), 0)
+    return web.Response(text=head + filler + tail, content_type="text/html")
+
+
+def make_app(
+    *, delay: float = 0.0, size: int = 50_000, failure_rate: float = 0.0
+) -> web.Application:
+    app = web.Application()
+    app["DELAY"] = delay
+    app["SIZE"] = size
+    app["FAILURE_RATE"] = failure_rate
+    app.router.add_get("/dev/peps/pep-{number}/", pep_page)
+    return app
+
+
+@asynccontextmanager
+async def run_stub_server(
+    *, delay: float = 0.0, size: int = 50_000, failure_rate: float = 0.0
+) -> AsyncIterator[str]:
+    """Serve fake PEPs on a random local port, yield the base URL"""
+    runner = web.AppRunner(make_app(delay=delay, size=size, failure_rate=failure_rate))
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(delay=0.05), host="127.0.0.1", port=8080)
@@ -0,0 +1,35 @@
+import pytest
+
+from benchmark import STRATEGIES, LocalServer, percentile, run_strategy
+
+
+RESULT_KEYS = {
+    "strategy",
+    "concurrency",
+    "requests",
+    "seconds",
+    "rps",
+    "p50_ms",
+    "p90_ms",
+    "p99_ms",
+    "peak_rss_mib",
+}
+
+
+@pytest.mark.parametrize("name", list(STRATEGIES))
+def test_run_strategy(name: str) -> None:
+    with LocalServer(delay=0, size=1000) as base_url:
+        urls = [f"{base_url}/dev/peps/pep-{i}/" for i in range(5)]
+        result = run_strategy(name, urls, 2)
+    assert set(result) == RESULT_KEYS
+    assert result["strategy"] == name
+    assert result["requests"] == 5
+    assert result["rps"] > 0
+    assert result["p50_ms"] <= result["p90_ms"] <= result["p99_ms"]
+
+
+def test_percentile() -> None:
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([1.0], 90) == 1
@@ -0,0 +1,104 @@
+import asyncio
+import random
+import time
+from typing import Any, Callable, List
+
+import aiohttp
+
+from crawler import Crawler, CrawlStats, HostLimiter, discard_page, pep_urls
+from stub_server import run_stub_server
+
+
+def fail_first(count: int) -> Callable[[], float]:
+    # Replaces random.random() of the stub server, the first *count*
+    # requests get 503 with any failure rate
+    calls = 0
+
+    def fake_random() -> float:
+        nonlocal calls
+        calls += 1
+        return 0.0 if calls <= count else 1.0
+
+    return fake_random
+
+
+async def test_crawl() -> None:
+    async with run_stub_server(size=1000) as base_url:
+        crawler = Crawler(workers=5, per_host=2)
+        stats = await crawler.crawl(pep_urls(base_url, 1, 20), discard_page)
+    assert (stats.done, stats.failed, stats.retries) == (20, 0, 0)
+    assert stats.bytes == 20 * 1000
+    assert "20 done, 0 failed, 0 retries" in stats.report()
+
+
+async def test_retry_then_succeed(monkeypatch: Any) -> None:
+    monkeypatch.setattr(random, "random", fail_first(2))
+    async with run_stub_server(failure_rate=0.5) as base_url:
+        crawler = Crawler(workers=1, retries=3, backoff=0)
+        stats = await crawler.crawl(pep_urls(base_url, 1, 3), discard_page)
+    assert (stats.done, stats.failed, stats.retries) == (3, 0, 2)
+
+
+async def test_give_up_after_retries() -> None:
+    async with run_stub_server(failure_rate=1.0) as base_url:
+        crawler = Crawler(workers=2, retries=2, backoff=0)
+        stats = await crawler.crawl(pep_urls(base_url, 1, 4), discard_page)
+    assert (stats.done, stats.failed, stats.retries) == (0, 4, 8)
+
+
+async def test_handler_error_keeps_workers() -> None:
+    async def broken(url: str, resp: aiohttp.ClientResponse) -> None:
+        if url.endswith("-2/"):
+            raise ValueError("cannot parse")
+        await discard_page(url, resp)
+
+    async with run_stub_server(size=100) as base_url:
+        crawler = Crawler(workers=1)
+        stats = await crawler.crawl(pep_urls(base_url, 1, 3), broken)
+    # Not retried, the server is fine
+    assert (stats.done, stats.failed, stats.retries) == (2, 1, 0)
+
+
+async def test_host_limiter_concurrency() -> None:
+    limiter = HostLimiter(2)
+    running: List[str] = []
+    peak = 0
+
+    async def request(host: str) -> None:
+        nonlocal peak
+        await limiter.acquire(host)
+        try:
+            running.append(host)
+            peak = max(peak, running.count(host))
+            await asyncio.sleep(0.01)
+            running.remove(host)
+        finally:
+            limiter.release(host)
+
+    await asyncio.gather(*(request(host) for host in ["a", "b"] * 5))
+    assert peak == 2
+
+
+async def test_host_limiter_rate() -> None:
+    limiter = HostLimiter(10, rate=50)
+    starts: List[float] = []
+
+    async def request(host: str) -> None:
+        await limiter.acquire(host)
+        starts.append(time.perf_counter())
+        limiter.release(host)
+
+    began = time.perf_counter()
+    await asyncio.gather(*(request("a") for i in range(5)))
+    # Starts are spaced by 20 ms, the first one is immediate
+    assert starts[-1] - began >= 0.08
+    began = time.perf_counter()
+    await request("b")
+    assert starts[-1] - began < 0.02
+
+
+def test_stats_report() -> None:
+    stats = CrawlStats(started=time.perf_counter() - 2, done=10, bytes=1024 ** 2)
+    report = stats.report()
+    assert report.startswith("10 done, 0 failed, 0 retries in 2.")
+    assert "(5.0 req/s, 0.50 MiB/s)" in report
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Iterator
+
+import aiohttp
+import pytest
+
+import download
+from download import DiskWriter
+from stub_server import run_stub_server
+
+
+@pytest.fixture
+def writer() -> Iterator[DiskWriter]:
+    writer = DiskWriter(threads=2, queue_size=2)
+    yield writer
+    writer.close()
+
+
+async def test_download(writer: DiskWriter, tmp_path: Path) -> None:
+    path = tmp_path / "pep.html"
+    async with run_stub_server(size=200_000) as base_url:
+        async with aiohttp.ClientSession() as session:
+            url = f"{base_url}/dev/peps/pep-8/"
+            size = await download.download(session, url, path, writer, chunk_size=1024)
+    assert size == 200_000
+    content = path.read_text()
+    assert content.startswith("<html><body><h1>PEP 8</h1>")
+    assert len(content) == size
+    assert [item.name for item in tmp_path.iterdir()] == ["pep.html"]
+
+
+async def test_failed_download_leaves_nothing(
+    writer: DiskWriter, tmp_path: Path
+) -> None:
+    path = tmp_path / "pep.html"
+    path.write_text("old")
+
+    async def broken() -> AsyncIterator[bytes]:
+        yield b"x" * 1024
+        raise aiohttp.ClientPayloadError("connection lost")
+
+    with pytest.raises(aiohttp.ClientPayloadError):
+        await writer.save(broken(), path)
+    # The previous version is kept, the partial file is removed
+    assert path.read_text() == "old"
+    assert [item.name for item in tmp_path.iterdir()] == ["pep.html"]
+
+
+async def test_http_error_creates_no_file(writer: DiskWriter, tmp_path: Path) -> None:
+    async with run_stub_server(failure_rate=1.0) as base_url:
+        async with aiohttp.ClientSession() as session:
+            url = f"{base_url}/dev/peps/pep-8/"
+            with pytest.raises(aiohttp.ClientResponseError):
+                await download.download(session, url, tmp_path / "pep.html", writer)
+    assert list(tmp_path.iterdir()) == []
+
+
+class GatedFile:
+    """File whose writes wait for the gate, a stalled disk"""
+
+    def __init__(self, f: IO[Any], gate: threading.Event) -> None:
+        self._f = f
+        self._gate = gate
+
+    def write(self, data: bytes) -> int:
+        self._gate.wait()
+        return self._f.write(data)
+
+    def close(self) -> None:
+        self._f.close()
+
+
+async def test_slow_disk_pushes_back(
+    writer: DiskWriter, tmp_path: Path, monkeypatch: Any
+) -> None:
+    gate = threading.Event()
+    monkeypatch.setattr(
+        download,
+        "open",
+        lambda path, mode: GatedFile(open(path, mode), gate),
+        raising=False,
+    )
+    produced = 0
+
+    async def chunks() -> AsyncIterator[bytes]:
+        nonlocal produced
+        for i in range(100):
+            produced += 1
+            yield b"x" * 1024
+
+    path = tmp_path / "file"
+    save = asyncio.ensure_future(writer.save(chunks(), path))
+    try:
+        await asyncio.sleep(0.1)
+        # Queued chunks, the one being written and the one waiting to be put
+        assert produced <= 2 + 2
+        # Renamed into place only when complete
+        assert not path.exists()
+    finally:
+        gate.set()
+    assert await save == 100 * 1024
+    assert path.stat().st_size == 100 * 1024
@@ -0,0 +1,197 @@
+import asyncio
+import math
+from typing import Awaitable, Callable, Dict, Iterable, Mapping, Optional
+
+import aiohttp_session
+from aiohttp import web
+
+
+_WebHandler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class LagMonitor:
+    """Measure event loop lag: how late a periodic timer fires.
+
+    The lag jumps up with a late tick and halves with every punctual one,
+    so a single quiet moment doesn't let a burst in.
+    """
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self._interval = interval
+        self._task: Optional["asyncio.Task[None]"] = None
+        self.lag = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._interval)
+            lag = loop.time() - start - self._interval
+            self.lag = max(lag, self.lag / 2)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token, return 0 or seconds until a token is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionControl:
+    """Shed load early instead of letting latency grow without bound.
+
+    A request is rejected right away with 503 when the event loop lags
+    more than *max_lag* seconds or *max_in_flight* requests are already
+    being handled, with 429 when its logged in user is over *user_rate*
+    requests per second with bursts of *user_burst*, and with 503 when its
+    route is at the concurrency limit from *route_limits*, keyed by method
+    and route, e.g. ``"GET /{post}/image"``.  Rejections carry
+    ``Retry-After``.
+
+    Anonymous requests have no rate limit of their own: CLI and batch
+    clients on one host or behind one proxy share the client address, a
+    bucket per address would throttle all of them together.  They are
+    still bounded by the in-flight and route limits.
+
+    Paths in *exempt* bypass the control, *long_lived* ones (streams) are
+    admitted by the same rules but not counted as in flight.  Limits are
+    per worker process.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_in_flight: int = 256,
+        max_lag: float = 0.5,
+        user_rate: float = 50.0,
+        user_burst: float = 100.0,
+        route_limits: Optional[Mapping[str, int]] = None,
+        exempt: Iterable[str] = ("/ready",),
+        long_lived: Iterable[str] = ("/api/events", "/api/ws"),
+        max_buckets: int = 10000,
+    ) -> None:
+        self._max_in_flight = max_in_flight
+        self._max_lag = max_lag
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._route_limits = dict(route_limits or {})
+        self._exempt = frozenset(exempt)
+        self._long_lived = frozenset(long_lived)
+        self._max_buckets = max_buckets
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._routes_in_flight: Dict[str, int] = {}
+        self.lag_monitor = LagMonitor()
+        self.in_flight = 0
+        self.rejected = {"lag": 0, "in_flight": 0, "rate": 0, "route": 0}
+
+    def start(self) -> None:
+        self.lag_monitor.start()
+
+    async def stop(self) -> None:
+        await self.lag_monitor.stop()
+
+    async def handle(
+        self, request: web.Request, handler: _WebHandler
+    ) -> web.StreamResponse:
+        path = request.path
+        if path in self._exempt:
+            return await handler(request)
+        lag = self.lag_monitor.lag
+        if lag > self._max_lag:
+            self.rejected["lag"] += 1
+            return _reject(503, lag, "Server is overloaded")
+        if self.in_flight >= self._max_in_flight:
+            self.rejected["in_flight"] += 1
+            return _reject(503, 1, "Server is overloaded")
+
+        wait = await self._take_token(request)
+        if wait:
+            self.rejected["rate"] += 1
+            return _reject(429, wait, "Too many requests")
+
+        route = _route_key(request)
+        limit = self._route_limits.get(route)
+        if limit is not None:
+            if self._routes_in_flight.get(route, 0) >= limit:
+                self.rejected["route"] += 1
+                return _reject(503, 1, "Server is busy")
+            self._routes_in_flight[route] = self._routes_in_flight.get(route, 0) + 1
+        counted = path not in self._long_lived
+        if counted:
+            self.in_flight += 1
+        try:
+            return await handler(request)
+        finally:
+            if counted:
+                self.in_flight -= 1
+            if limit is not None:
+                self._routes_in_flight[route] -= 1
+
+    async def _take_token(self, request: web.Request) -> float:
+        session = await aiohttp_session.get_session(request)
+        key = session.get("username")
+        if not key:
+            return 0.0
+        now = asyncio.get_event_loop().time()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_buckets:
+                self._prune(now)
+            bucket = TokenBucket(self._user_rate, self._user_burst, now)
+            self._buckets[key] = bucket
+        return bucket.take(now)
+
+    def _prune(self, now: float) -> None:
+        # A full bucket is the same as a new one, forget idle users
+        for key, bucket in list(self._buckets.items()):
+            if bucket.full(now):
+                del self._buckets[key]
+
+
+def _route_key(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    canonical = resource.canonical if resource is not None else request.path
+    return f"{request.method} {canonical}"
+
+
+def _reject(status: int, retry_after: float, reason: str) -> web.Response:
+    return web.Response(
+        status=status,
+        text=reason,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+@web.middleware
+async def admission_middleware(
+    request: web.Request, handler: _WebHandler
+) -> web.StreamResponse:
+    return await request.config_dict["ADMISSION"].handle(request, handler)
@@ -0,0 +1,62 @@
+import functools
+import json
+import time
+from typing import Callable, Dict, List
+
+import click
+
+from .repository import PostSummary
+from .serializer import SERIALIZERS, orjson
+
+
+# Encoding speed of the posts listing, the largest API response
+
+
+def make_posts(count: int) -> List[PostSummary]:
+    return [
+        PostSummary(i, f"user{i % 50}", f"user{i % 7}", f"Post title number {i}")
+        for i in range(1, count + 1)
+    ]
+
+
+def json_response_body(posts: List[PostSummary]) -> bytes:
+    # What web.json_response() did before serializers: dicts, str, bytes
+    data = [post._asdict() for post in posts]
+    return json.dumps({"status": "ok", "data": data}).encode()
+
+
+def measure(encode: Callable[[], bytes], duration: float) -> float:
+    """Return the best time of one call within *duration* seconds"""
+    best = float("inf")
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        encode()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.command()
+@click.option("--rows", type=int, default=10_000, show_default=True)
+@click.option("--duration", type=float, default=1.0, show_default=True)
+def main(rows: int, duration: float) -> None:
+    """Benchmark JSON encoding of the posts listing"""
+    posts = make_posts(rows)
+    encoders: Dict[str, Callable[[], bytes]] = {
+        "json_response": functools.partial(json_response_body, posts)
+    }
+    for name, factory in SERIALIZERS.items():
+        if name == "orjson" and orjson is None:
+            click.echo("orjson is not installed, skipped", err=True)
+            continue
+        encoders[name] = functools.partial(factory().ok_records, posts)
+    click.echo(f"{'encoder':>14} {'MiB/s':>8} {'rows/s':>10} {'size':>9}")
+    for name, encode in encoders.items():
+        size = len(encode())
+        elapsed = measure(encode, duration)
+        mibps = size / elapsed / 1024 ** 2
+        click.echo(f"{name:>14} {mibps:8.1f} {rows / elapsed:10.0f} {size:9}")
+
+
+if __name__ == "__main__":
+    main()
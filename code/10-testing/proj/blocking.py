@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+_WebHandler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+# Route of the request every handler task is serving, read by detectors
+_task_routes: Dict["asyncio.Task[object]", str] = {}
+
+
+@web.middleware
+async def track_route(request: web.Request, handler: _WebHandler) -> web.StreamResponse:
+    task = asyncio.current_task()
+    if task is None:
+        return await handler(request)
+    resource = request.match_info.route.resource
+    canonical = resource.canonical if resource is not None else request.path
+    _task_routes[task] = f"{request.method} {canonical}"
+    try:
+        return await handler(request)
+    finally:
+        del _task_routes[task]
+
+
+@dataclass
+class Stall:
+    route: Optional[str]  # "GET /{post}/image" if a handler blocked
+    stack: str  # of the loop thread, captured while it was blocked
+    duration: Optional[float] = None  # set when the loop responds again
+
+
+class BlockingDetector:
+    """Report callbacks that block the event loop longer than *threshold*.
+
+    A sidecar thread pings the loop with call_soon_threadsafe().  When a
+    ping isn't answered within *threshold* seconds the stack of the loop
+    thread is captured and logged together with the route of the request
+    being handled, and the stall is appended to *stalls*.
+
+    start() should be called from the loop thread.  Pings are only sent
+    while the loop runs, so a loop stopped between run_until_complete()
+    calls doesn't count as blocked.
+    """
+
+    def __init__(self, threshold: float = 0.1) -> None:
+        self.threshold = threshold
+        self.stalls: List[Stall] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        if self._thread is not None:
+            return
+        self._loop = loop or asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._watch, name="blocking-detector", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def report(self) -> str:
+        return "\n".join(_format_stall(stall, self.threshold) for stall in self.stalls)
+
+    def _watch(self) -> None:
+        loop = self._loop
+        assert loop is not None
+        interval = self.threshold / 2
+        while not self._stopped.wait(interval):
+            if not loop.is_running():
+                continue
+            pong = threading.Event()
+            sent = time.monotonic()
+            try:
+                loop.call_soon_threadsafe(pong.set)
+            except RuntimeError:  # closed
+                return
+            if pong.wait(self.threshold) or not loop.is_running():
+                continue
+            stall = self._capture()
+            self.stalls.append(stall)
+            log.warning("%s", _format_stall(stall, self.threshold))
+            while not pong.wait(interval):
+                if self._stopped.is_set():
+                    return
+            stall.duration = time.monotonic() - sent
+
+    def _capture(self) -> Stall:
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        task = asyncio.current_task(self._loop)
+        return Stall(_task_routes.get(task) if task is not None else None, stack)
+
+
+def _format_stall(stall: Stall, threshold: float) -> str:
+    if stall.duration is not None:
+        blocked = f"for {stall.duration * 1000:.0f} ms"
+    else:
+        blocked = f"for more than {threshold * 1000:.0f} ms"
+    where = f" in {stall.route}" if stall.route is not None else ""
+    return f"Event loop was blocked {blocked}{where}:\n{stall.stack}"
@@ -0,0 +1,221 @@
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Sequence
+
+import aiosqlite
+
+
+# Cache hits are recorded in memory and written in batches of that many
+USED_FLUSH_SIZE = 64
+
+
+class CacheEntry(NamedTuple):
+    etag: Optional[str]
+    body: bytes
+    fresh: bool  # may be used without asking the server
+
+
+class HTTPCache:
+    """Persistent cache of GET responses in a local SQLite file.
+
+    Bodies are stored with their ETag and an expiration time taken from
+    the response's ``Cache-Control: max-age`` or *fresh_for* seconds by
+    default.  Fresh entries are served without network, stale ones are
+    revalidated with a conditional request.  Entries not used for *max_age*
+    seconds are dropped, and the least recently used ones are evicted when
+    bodies exceed *max_size* bytes in total.
+
+    A hit doesn't write to the file: use times are kept in memory and
+    written in batches, before eviction and on close.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        fresh_for: float = 60.0,
+        max_size: int = 64 * 1024 ** 2,
+        max_age: float = 7 * 24 * 3600,
+    ) -> None:
+        self._path = path
+        self._fresh_for = fresh_for
+        self._max_size = max_size
+        self._max_age = max_age
+        self._db: Optional[aiosqlite.Connection] = None
+        self._size = 0
+        self._used: Dict[str, float] = {}  # use times not written yet
+
+    async def open(self) -> None:
+        db = await aiosqlite.connect(self._path)
+        try:
+            async with db.execute("PRAGMA busy_timeout = 5000"):
+                pass
+            async with db.execute("PRAGMA journal_mode = WAL"):
+                pass
+            async with db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "url TEXT PRIMARY KEY, etag TEXT, body BLOB NOT NULL, "
+                "size INTEGER NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+            ):
+                pass
+            async with db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used ON responses (used)"
+            ):
+                pass
+            await db.commit()
+        except BaseException:
+            await db.close()
+            raise
+        self._db = db
+        await self.evict()
+
+    async def close(self) -> None:
+        if self._db is not None:
+            try:
+                await self.flush()
+            finally:
+                await self._db.close()
+            self._db = None
+
+    async def __aenter__(self) -> "HTTPCache":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.close()
+
+    @property
+    def db(self) -> aiosqlite.Connection:
+        if self._db is None:
+            raise RuntimeError("Cache is not opened")
+        return self._db
+
+    @property
+    def size(self) -> int:
+        """Total size of stored bodies"""
+        return self._size
+
+    async def get(self, url: str) -> Optional[CacheEntry]:
+        now = time.time()
+        async with self.db.execute(
+            "SELECT etag, body, expires FROM responses WHERE url = ?", [url]
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        self._used[url] = now
+        if len(self._used) >= USED_FLUSH_SIZE:
+            await self.flush()
+        return CacheEntry(row[0], row[1], row[2] > now)
+
+    async def flush(self) -> None:
+        """Write use times of cache hits"""
+        if not self._used:
+            return
+        used = [(when, url) for url, when in self._used.items()]
+        self._used.clear()
+        async with self.db.executemany(
+            "UPDATE responses SET used = ? WHERE url = ?", used
+        ):
+            pass
+        await self.db.commit()
+
+    async def put(
+        self,
+        url: str,
+        etag: Optional[str],
+        body: bytes,
+        cache_control: Optional[str] = None,
+    ) -> None:
+        fresh_for = _max_age(cache_control, self._fresh_for)
+        if fresh_for is None or len(body) > self._max_size:
+            return
+        now = time.time()
+        # A replaced entry no longer takes space
+        old_size = await self._stored_size("url = ?", [url])
+        self._used.pop(url, None)
+        await self._execute(
+            "INSERT OR REPLACE INTO responses (url, etag, body, size, expires, used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [url, etag, body, len(body), now + fresh_for, now],
+        )
+        self._size += len(body) - old_size
+        if self._size > self._max_size:
+            await self.evict()
+
+    async def refresh(self, url: str, cache_control: Optional[str] = None) -> None:
+        """Extend freshness of a stored entry revalidated by 304 Not Modified"""
+        fresh_for = _max_age(cache_control, self._fresh_for) or 0.0
+        now = time.time()
+        self._used.pop(url, None)
+        await self._execute(
+            "UPDATE responses SET expires = ?, used = ? WHERE url = ?",
+            [now + fresh_for, now, url],
+        )
+
+    async def invalidate(self, url: str, *, prefix: bool = False) -> None:
+        """Drop the entry for *url*, or all entries starting with it"""
+        if prefix:
+            where = "substr(url, 1, ?) = ?"
+            params: Sequence[Any] = [len(url), url]
+        else:
+            where = "url = ?"
+            params = [url]
+        self._size -= await self._stored_size(where, params)
+        await self._execute(f"DELETE FROM responses WHERE {where}", params)
+
+    async def _stored_size(self, where: str, params: Sequence[Any]) -> int:
+        async with self.db.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE {where}", params
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def _execute(self, sql: str, params: Sequence[Any]) -> None:
+        async with self.db.execute(sql, params):
+            pass
+        await self.db.commit()
+
+    async def evict(self) -> None:
+        await self.flush()  # eviction goes by use times
+        db = self.db
+        async with db.execute(
+            "DELETE FROM responses WHERE used < ?", [time.time() - self._max_age]
+        ):
+            pass
+        async with db.execute("SELECT COALESCE(SUM(size), 0) FROM responses") as cur:
+            self._size = (await cur.fetchone())[0]
+        if self._size > self._max_size:
+            # Keep the most recently used entries which fit into 3/4 of the
+            # limit, the rest of space is left for new responses.
+            async with db.execute(
+                "SELECT url, size FROM responses ORDER BY used DESC"
+            ) as cursor:
+                kept = 0
+                victims = []
+                async for url, size in cursor:
+                    if kept + size > self._max_size * 3 // 4:
+                        victims.append((url,))
+                    else:
+                        kept += size
+            async with db.executemany("DELETE FROM responses WHERE url = ?", victims):
+                pass
+            self._size = kept
+        await db.commit()
+
+
+def _max_age(cache_control: Optional[str], default: float) -> Optional[float]:
+    """Seconds the response stays fresh, None if it must not be stored"""
+    if cache_control is None:
+        return default
+    for directive in cache_control.lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "no-store":
+            return None
+        if name == "no-cache":
+            return 0.0
+        if name == "max-age":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return default
@@ -1,111 +1,97 @@
-import asyncio
 import functools
+import json
+import shlex
+import sys
+from collections import deque
 from contextlib import asynccontextmanager
-from dataclasses import dataclass
-from types import TracebackType
-from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Type
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Optional,
+    TextIO,
+)
 
-import aiohttp
 import click
-from yarl import URL
 
 
-@dataclass(frozen=True)
-class Post:
-    id: int
-    owner: str
-    editor: str
-    title: str
-    text: Optional[str]  # post listing doesn't return text field
-
-    def pprint(self) -> None:
-        click.echo(f"Post {self.id}")
-        click.echo(f"  Owner:  {self.owner}")
-        click.echo(f"  Editor: {self.editor}")
-        click.echo(f"  Title:  {self.title}")
-        if self.text is not None:
-            click.echo(f"  Text:   {self.text}")
-
-
-class Client:
-    def __init__(self, base_url: URL, user: str) -> None:
-        self._base_url = base_url
-        self._user = user
-        self._client = aiohttp.ClientSession(raise_for_status=True)
-
-    async def close(self) -> None:
-        return await self._client.close()
-
-    async def __aenter__(self) -> "Client":
-        return self
-
-    async def __aexit__(
-        self,
-        exc_type: Optional[Type[BaseException]],
-        exc_val: Optional[BaseException],
-        exc_tb: Optional[TracebackType],
-    ) -> Optional[bool]:
-        await self.close()
-        return None
+# Command line interface.  Short runs, --help above all, are dominated by
+# startup, so asyncio, aiohttp, yarl and aiosqlite are imported only when
+# a command actually runs.  The client itself lives in proj.restclient,
+# its names are still importable from here.
+
+if TYPE_CHECKING:
+    from .restclient import Client
+
+
+_RESTCLIENT_NAMES = frozenset(
+    ["RETRY_STATUSES", "Client", "ClientStats", "Event", "Post"]
+)
 
-    def _make_url(self, path: str) -> URL:
-        return self._base_url / path
-
-    async def create(self, title: str, text: str) -> Post:
-        async with self._client.post(
-            self._make_url("api"),
-            json={"owner": self._user, "title": title, "text": text},
-        ) as resp:
-            ret = await resp.json()
-            return Post(**ret["data"])
-
-    async def get(self, post_id: int) -> Post:
-        async with self._client.get(self._make_url(f"api/{post_id}")) as resp:
-            ret = await resp.json()
-            return Post(**ret["data"])
-
-    async def delete(self, post_id: int) -> None:
-        async with self._client.delete(self._make_url(f"api/{post_id}")) as resp:
-            resp  # to make linter happy
-
-    async def update(
-        self, post_id: int, title: Optional[str] = None, text: Optional[str] = None
-    ) -> Post:
-        json = {"editor": self._user}
-        if title is not None:
-            json["title"] = title
-        if text is not None:
-            json["text"] = text
-        async with self._client.patch(
-            self._make_url(f"api/{post_id}"), json=json
-        ) as resp:
-            ret = await resp.json()
-            return Post(**ret["data"])
-
-    async def list(self) -> List[Post]:
-        async with self._client.get(self._make_url(f"api")) as resp:
-            ret = await resp.json()
-            return [Post(text=None, **item) for item in ret["data"]]
+
+def __getattr__(name: str) -> Any:
+    # PEP 562, loads proj.restclient on first access
+    if name in _RESTCLIENT_NAMES:
+        from . import restclient
+
+        return getattr(restclient, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @dataclass(frozen=True)
 class Root:
-    base_url: URL
+    base_url: str
     user: str
     show_traceback: bool
+    transport: str = "http"
+    cache_path: Optional[Path] = None
+    cache_ttl: float = 60.0
+    timeout: Optional[float] = None
+    retries: int = 0
+    hedge: bool = False
+    show_stats: bool = False
 
     @asynccontextmanager
-    async def client(self) -> AsyncIterator[Client]:
-        client = Client(self.base_url, self.user)
+    async def client(self) -> AsyncIterator["Client"]:
+        from yarl import URL
+
+        from .cache import HTTPCache
+        from .restclient import Client
+
+        cache = None
+        if self.cache_path is not None:
+            cache = HTTPCache(self.cache_path, fresh_for=self.cache_ttl)
+            await cache.open()
+        client = Client(
+            URL(self.base_url),
+            self.user,
+            transport=self.transport,
+            cache=cache,
+            timeout=self.timeout,
+            retries=self.retries,
+            hedge=self.hedge,
+        )
         try:
             yield client
         finally:
             await client.close()
+            if self.show_stats:
+                click.echo(client.stats.report(), err=True)
+            if cache is not None:
+                await cache.close()
 
 
 def async_cmd(func: Callable[..., Awaitable[None]]) -> Callable[..., None]:
     @functools.wraps(func)
     def inner(root: Root, **kwargs: Any) -> None:
+        import asyncio
+
         try:
             return asyncio.run(func(root, **kwargs))
         except Exception as exc:
@@ -124,10 +110,68 @@ def async_cmd(func: Callable[..., Awaitable[None]]) -> Callable[..., None]:
 )
 @click.option("--user", type=str, default="Anonymous", show_default=True)
 @click.option("--show-traceback", is_flag=True, default=False, show_default=True)
+@click.option(
+    "--transport",
+    type=click.Choice(["http", "ws"]),
+    default="http",
+    show_default=True,
+    help="Send requests over HTTP or pipeline them through one WebSocket",
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    type=click.Path(dir_okay=False),
+    help="Keep responses in this SQLite file between runs",
+)
+@click.option(
+    "--cache-ttl",
+    type=float,
+    default=60.0,
+    show_default=True,
+    help="Seconds a cached response is used without revalidation",
+)
+@click.option("--timeout", type=float, help="Seconds to wait for every request")
+@click.option(
+    "--retries",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Retry get, list and delete on network errors and overload",
+)
+@click.option(
+    "--hedge",
+    is_flag=True,
+    default=False,
+    help="Repeat a GET slower than the p95 latency, use the first answer",
+)
+@click.option("--stats", "show_stats", is_flag=True, default=False)
 @click.pass_context
-def main(ctx: click.Context, base_url: str, user: str, show_traceback: bool) -> None:
+def main(
+    ctx: click.Context,
+    base_url: str,
+    user: str,
+    show_traceback: bool,
+    transport: str,
+    cache_path: Optional[str],
+    cache_ttl: float,
+    timeout: Optional[float],
+    retries: int,
+    hedge: bool,
+    show_stats: bool,
+) -> None:
     """REST client for tutorial server"""
-    ctx.obj = Root(URL(base_url), user, show_traceback)
+    ctx.obj = Root(
+        base_url,
+        user,
+        show_traceback,
+        transport,
+        Path(cache_path) if cache_path is not None else None,
+        cache_ttl,
+        timeout,
+        retries,
+        hedge,
+        show_stats,
+    )
 
 
 @main.command()
@@ -177,15 +221,151 @@ async def update(
 
 
 @main.command()
+@click.option("--owner", type=str, help="Only posts created by the user")
+@click.option("--editor", type=str, help="Only posts last edited by the user")
+@click.option(
+    "--order",
+    type=click.Choice(["id", "-id", "title", "-title"]),
+    help="Sort order, prefix with - for descending",
+)
 @async_cmd
-async def list(root: Root) -> None:
+async def list(
+    root: Root, owner: Optional[str], editor: Optional[str], order: Optional[str]
+) -> None:
     """List existing blog posts"""
     async with root.client() as client:
-        posts = await client.list()
+        posts = await client.list(owner=owner, editor=editor, order=order)
         click.echo("List posts:")
         for post in posts:
             post.pprint()
 
 
+@main.command()
+@click.option(
+    "--file",
+    "file",
+    type=click.File("r"),
+    default="-",
+    show_default=True,
+    help="Commands, one per line",
+)
+@click.option(
+    "--parallel",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="Max number of commands running at once",
+)
+@async_cmd
+async def batch(root: Root, file: TextIO, parallel: int) -> None:
+    """Run many commands over one connection, print NDJSON results.
+
+    Every line is a create, get, update, delete or list command with the
+    usual arguments, e.g. "update 1 --title 'New title'".  Results are
+    printed in input order.  Exits with status 1 if any command failed.
+    """
+    async with root.client() as client:
+        failed = await run_batch(client, file, sys.stdout, parallel)
+    if failed:
+        click.echo(f"{failed} commands failed", err=True)
+        sys.exit(1)
+
+
+# Commands which can be used in batch mode
+BATCH_COMMANDS = ("create", "get", "update", "delete", "list")
+
+
+async def run_batch(
+    client: "Client", lines: Iterable[str], out: TextIO, parallel: int = 10
+) -> int:
+    """Run commands from *lines*, write a JSON result per command to *out*.
+
+    Up to *parallel* commands run at once, finished results wait for the
+    earlier ones so the output follows the input order.  Return the number
+    of failed commands.
+
+    *lines* are read in the default executor: waiting for the next line of
+    stdin or a pipe doesn't stop the commands already running.
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    source = iter(lines)
+    running = asyncio.Semaphore(parallel)
+    # Finished results waiting for a slow earlier command are bounded too
+    window = parallel * 4
+    results: "deque[asyncio.Future[Dict[str, Any]]]" = deque()
+    failed = 0
+
+    def write(result: Dict[str, Any]) -> None:
+        nonlocal failed
+        if "error" in result:
+            failed += 1
+        out.write(json.dumps(result) + "\n")
+
+    async def run(lineno: int, line: str) -> Dict[str, Any]:
+        try:
+            return {"line": lineno, "result": await _run_command(client, line)}
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            return {"line": lineno, "error": str(exc) or type(exc).__name__}
+        finally:
+            running.release()
+
+    lineno = 0
+    while True:
+        next_line: Optional[str] = await loop.run_in_executor(None, next, source, None)
+        if next_line is None:
+            break
+        lineno += 1
+        line = next_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        await running.acquire()
+        results.append(asyncio.ensure_future(run(lineno, line)))
+        while results and (results[0].done() or len(results) > window):
+            write(await results.popleft())
+    while results:
+        write(await results.popleft())
+    out.flush()
+    return failed
+
+
+async def _run_command(client: "Client", line: str) -> Any:
+    # Arguments are parsed by the regular command, so the syntax is the same
+    name, *args = shlex.split(line)
+    if name not in BATCH_COMMANDS:
+        raise click.UsageError(f"Unknown command {name!r}")
+    command = main.get_command(click.Context(main), name)
+    assert command is not None
+    with command.make_context(name, args) as ctx:
+        params = ctx.params
+    if name == "create":
+        return asdict(await client.create(params["title"], params["text"]))
+    elif name == "get":
+        return asdict(await client.get(params["post_id"]))
+    elif name == "update":
+        post = await client.update(params["post_id"], params["title"], params["text"])
+        return asdict(post)
+    elif name == "delete":
+        await client.delete(params["post_id"])
+        return None
+    else:
+        posts = await client.list(
+            owner=params["owner"], editor=params["editor"], order=params["order"]
+        )
+        return [asdict(post) for post in posts]
+
+
+@main.command()
+@async_cmd
+async def watch(root: Root) -> None:
+    """Print blog post changes as they happen"""
+    async with root.client() as client:
+        async for event in client.watch():
+            event.pprint()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,80 @@
+import asyncio
+import json
+from typing import Any, Dict, Optional, Set
+
+
+class Subscription:
+    """Bounded queue of encoded SSE frames for a single subscriber."""
+
+    def __init__(self, hub: "EventHub", queue_size: int) -> None:
+        self._hub = hub
+        self._queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def _push(self, frame: bytes) -> None:
+        try:
+            self._queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Slow consumer: drop pending frames and ask it to disconnect,
+            # the client reconnects and resyncs with a fresh GET /api.
+            self.overflowed = True
+            self._hub.unsubscribe(self)
+            self._close()
+
+    def _close(self) -> None:
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    async def get(self) -> Optional[bytes]:
+        """Return next frame or None if the subscription is closed"""
+        return await self._queue.get()
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._hub.unsubscribe(self)
+
+
+class EventHub:
+    """In-process fan out of post change events to SSE subscribers.
+
+    Every event is encoded once and pushed to all subscriber queues without
+    waiting, so a publisher never blocks on slow readers.  Each worker process
+    has its own hub and sees only writes made by that process.
+    """
+
+    def __init__(self, queue_size: int = 64) -> None:
+        self._queue_size = queue_size
+        self._subscribers: Set[Subscription] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Subscription:
+        sub = Subscription(self, self._queue_size)
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self._subscribers.discard(sub)
+
+    def publish(self, event: str, data: Dict[str, Any]) -> None:
+        frame = encode_event(event, data)
+        for sub in list(self._subscribers):
+            sub._push(frame)
+
+    def close(self) -> None:
+        for sub in self._subscribers:
+            sub._close()
+        self._subscribers.clear()
+
+
+def encode_event(event: str, data: Dict[str, Any]) -> bytes:
+    lines = []
+    if "version" in data:
+        lines.append(f"id: {data['version']}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
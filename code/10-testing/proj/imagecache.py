@@ -0,0 +1,136 @@
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from .singleflight import SingleFlight
+
+
+class VariantCache:
+    """Size-bounded disk cache of generated image variants.
+
+    Entries are files in *root* named by their key, the least recently used
+    ones are removed when the total size exceeds *max_bytes*.  Generation
+    of a missing entry is single-flighted: concurrent requests for the same
+    key wait for one call of the factory.  All disk I/O runs in the default
+    executor.
+
+    The LRU order is kept in file mtimes, a hit touches its file.  Worker
+    processes share *root*, so before evicting, a miss rescans the directory
+    to count files written by other processes as well and the bound holds
+    for the directory as a whole.  The in-memory index is the view of the
+    last scan.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._flight: SingleFlight[bytes] = SingleFlight()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def load(self) -> None:
+        """Index existing cache files, blocking"""
+        self._root.mkdir(parents=True, exist_ok=True)
+        self._index(self._scan())
+        self._unlink(self._pop_victims())
+
+    async def get(self, key: str, factory: Callable[[], bytes]) -> bytes:
+        """Return cached content for *key*, call blocking *factory* on a miss"""
+        loop = asyncio.get_event_loop()
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            try:
+                return await loop.run_in_executor(None, self._read, key)
+            except FileNotFoundError:
+                # Evicted by another worker process
+                self._drop(key)
+        return await self._flight.do(key, functools.partial(self._create, key, factory))
+
+    async def _create(self, key: str, factory: Callable[[], bytes]) -> bytes:
+        loop = asyncio.get_event_loop()
+        content = await loop.run_in_executor(None, factory)
+        if len(content) > self._max_bytes:
+            return content
+        await loop.run_in_executor(None, self._write, key, content)
+        self._index(await loop.run_in_executor(None, self._scan))
+        victims = self._pop_victims()
+        if victims:
+            await loop.run_in_executor(None, self._unlink, victims)
+        return content
+
+    def _index(self, files: List[Tuple[str, int]]) -> None:
+        self._entries = OrderedDict(files)
+        self._size = sum(size for _, size in files)
+
+    def _drop(self, key: str) -> None:
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _pop_victims(self) -> List[str]:
+        victims = []
+        while self._size > self._max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            victims.append(key)
+        return victims
+
+    def _scan(self) -> List[Tuple[str, int]]:
+        """Return names and sizes of cache files, least recently used first"""
+        files = []
+        now = time.time()
+        for path in self._root.iterdir():
+            try:
+                stat = path.stat()
+                if path.name.startswith("."):
+                    # Temporary file, being written or left by an interrupted write
+                    if stat.st_mtime < now - 60:
+                        path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue  # removed by another process meanwhile
+            files.append((stat.st_mtime_ns, path.name, stat.st_size))
+        return [(name, size) for _, name, size in sorted(files)]
+
+    def _read(self, key: str) -> bytes:
+        path = self._root / key
+        content = path.read_bytes()
+        try:
+            _touch(path)
+        except FileNotFoundError:
+            pass
+        return content
+
+    def _write(self, key: str, content: bytes) -> None:
+        tmp = self._root / f".{key}.{os.getpid()}"
+        tmp.write_bytes(content)
+        _touch(tmp)
+        tmp.replace(self._root / key)
+
+    def _unlink(self, keys: List[str]) -> None:
+        for key in keys:
+            try:
+                (self._root / key).unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _touch(path: Path) -> None:
+    # File systems stamp writes with a coarse clock, a few milliseconds
+    # apart; set the exact time so that recent uses of files keep their order
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
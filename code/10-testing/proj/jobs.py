@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional, Set
+
+from .repository import ImageJob, PostRepository
+
+
+log = logging.getLogger(__name__)
+
+
+class _JobShard(NamedTuple):
+    posts: PostRepository  # on a connection owned by the queue
+    media_path: Path
+    lock: asyncio.Lock  # claims and results of the workers don't interleave
+
+
+class _Claim(NamedTuple):
+    shard: _JobShard
+    job: ImageJob
+
+
+class ImageJobs:
+    """Durable queue of thumbnail jobs run by a pool of async workers.
+
+    Jobs are rows of the image_jobs table in every shard.  They are queued
+    in the same transaction which adds the image, so they survive restarts.
+    A worker claims a due job by moving its run_at *lease* seconds ahead,
+    so a job held by a crashed process runs again once the lease expires.
+    Worker processes sharing the DB claim jobs from the same tables.
+
+    *process* makes the thumbnail from the original file and runs in the
+    default executor.  A failed attempt is retried after *backoff* seconds,
+    doubled with every attempt, and the image is marked failed after
+    *max_attempts* attempts.  The thumbnail stays NULL until the job is
+    done, so the placeholder is served meanwhile.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[Path], bytes],
+        *,
+        workers: int = 2,
+        max_attempts: int = 5,
+        backoff: float = 1.0,
+        lease: float = 60.0,
+        poll_interval: float = 5.0,
+    ) -> None:
+        self._process = process
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._lease = lease
+        self._poll_interval = poll_interval
+        self._shards: List[_JobShard] = []
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._claims: Set[_Claim] = set()
+        self._wakeup = asyncio.Event()
+        self._busy = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    def add_shard(self, posts: PostRepository, media_path: Path) -> None:
+        """Take jobs from *posts*, the queue closes its connection on stop"""
+        self._shards.append(_JobShard(posts, media_path, asyncio.Lock()))
+
+    def start(self) -> None:
+        for i in range(self._workers):
+            self._tasks.append(asyncio.ensure_future(self._work()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Interrupted jobs run again on the next start, not after the lease
+        for shard, job in self._claims:
+            await shard.posts.release_image_job(job)
+            await shard.posts.db.commit()
+        self._claims.clear()
+        for shard in self._shards:
+            await shard.posts.db.close()
+        self._shards = []
+
+    def wake(self) -> None:
+        """Notify workers about a committed job"""
+        self._wakeup.set()
+
+    async def join(self) -> None:
+        """Wait until all jobs due now are done"""
+        while True:
+            await self._idle.wait()
+            if not await self._run_next() and self._busy == 0:
+                return
+
+    async def _work(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                if await self._run_next():
+                    continue
+            except Exception:
+                log.exception("Image job queue failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass  # look for retries and jobs queued by other processes
+
+    async def _run_next(self) -> bool:
+        """Run a due job of any shard, return False if there is none"""
+        self._busy += 1
+        self._idle.clear()
+        try:
+            for shard in self._shards:
+                job = await self._claim(shard)
+                if job is not None:
+                    await self._run(shard, job)
+                    return True
+            return False
+        finally:
+            self._busy -= 1
+            if self._busy == 0:
+                self._idle.set()
+
+    async def _claim(self, shard: _JobShard) -> Optional[ImageJob]:
+        async with shard.lock:
+            try:
+                job = await shard.posts.claim_image_job(time.time(), self._lease)
+            finally:
+                await shard.posts.db.commit()
+        return job
+
+    async def _run(self, shard: _JobShard, job: ImageJob) -> None:
+        loop = asyncio.get_event_loop()
+        claim = _Claim(shard, job)
+        self._claims.add(claim)
+        try:
+            original = shard.media_path / job.image_hash
+            thumbnail: Optional[bytes] = await loop.run_in_executor(
+                None, self._process, original
+            )
+            error = None
+        except Exception as ex:
+            thumbnail = None
+            error = f"{type(ex).__name__}: {ex}"
+        self._claims.discard(claim)
+        async with shard.lock:
+            if thumbnail is not None:
+                await shard.posts.finish_image_job(job, thumbnail)
+                self.done += 1
+            elif job.attempts < self._max_attempts:
+                delay = self._backoff * 2 ** (job.attempts - 1)
+                log.warning(
+                    "Image %s attempt %d failed, retry in %.0f s: %s",
+                    job.image_hash,
+                    job.attempts,
+                    delay,
+                    error,
+                )
+                await shard.posts.retry_image_job(job, time.time() + delay, str(error))
+                self.retried += 1
+            else:
+                log.error("Image %s failed: %s", job.image_hash, error)
+                await shard.posts.fail_image_job(job)
+                self.failed += 1
+            await shard.posts.db.commit()
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import aiosqlite
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class TaskStats:
+    runs: int = 0
+    last_run: Optional[float] = None  # unix time
+    last_duration: float = 0.0  # seconds
+    total_duration: float = 0.0
+
+
+class _DB(NamedTuple):
+    path: Path
+    db: aiosqlite.Connection  # owned by Maintenance
+
+
+async def _pragma(db: aiosqlite.Connection, sql: str) -> List[Any]:
+    # Some pragmas do a step of work per row, fetch all to finish them
+    async with db.execute(sql) as cursor:
+        return list(await cursor.fetchall())
+
+
+async def _pragma_value(db: aiosqlite.Connection, sql: str) -> Any:
+    return (await _pragma(db, sql))[0][0]
+
+
+class Maintenance:
+    """Keep DB files compact and query plans fresh without downtime.
+
+    Periodically runs passive WAL checkpoints, which never wait for readers
+    or writers, and ``PRAGMA optimize``, which runs ANALYZE when tables
+    changed enough (a full ANALYZE on the first run if the file has no
+    statistics).  Free pages are returned to the file system by
+    ``incremental_vacuum`` in slices of *vacuum_pages* while *quiet*
+    returns true, so writes of handlers wait for a short slice only.  It
+    needs ``auto_vacuum = INCREMENTAL``, which migrate() sets on new files
+    and ``--convert-vacuum`` of the server on older ones; a file in another
+    mode is skipped.
+
+    Every task first runs one interval after start.  Statements run on
+    connections of the scheduler, not on the ones of request handlers.
+    """
+
+    def __init__(
+        self,
+        *,
+        quiet: Callable[[], bool] = lambda: True,
+        checkpoint_interval: float = 60.0,
+        vacuum_interval: float = 30.0,
+        vacuum_pages: int = 256,
+        optimize_interval: float = 3600.0,
+    ) -> None:
+        self._quiet = quiet
+        self._vacuum_pages = vacuum_pages
+        self._schedule = [
+            ("checkpoint", checkpoint_interval, self.checkpoint),
+            ("vacuum", vacuum_interval, self.vacuum),
+            ("optimize", optimize_interval, self.optimize),
+        ]
+        self._dbs: List[_DB] = []
+        self._tasks: List["asyncio.Task[None]"] = []
+        self.stats = {name: TaskStats() for name, _, _ in self._schedule}
+
+    def add_db(self, path: Path, db: aiosqlite.Connection) -> None:
+        """Maintain the file at *path* over *db*, closed on stop"""
+        self._dbs.append(_DB(path, db))
+
+    def start(self) -> None:
+        for name, interval, _ in self._schedule:
+            self._tasks.append(asyncio.ensure_future(self._every(name, interval)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for item in self._dbs:
+            await item.db.close()
+        self._dbs = []
+
+    async def checkpoint(self) -> None:
+        for item in self._dbs:
+            await _pragma(item.db, "PRAGMA wal_checkpoint(PASSIVE)")
+
+    async def vacuum(self) -> None:
+        for item in self._dbs:
+            if await _pragma_value(item.db, "PRAGMA auto_vacuum") != 2:
+                continue  # not INCREMENTAL
+            while self._quiet():
+                free = await _pragma_value(item.db, "PRAGMA freelist_count")
+                if not free:
+                    break
+                pages = min(free, self._vacuum_pages)
+                await _pragma(item.db, f"PRAGMA incremental_vacuum({pages})")
+                await asyncio.sleep(0)  # let handlers in between slices
+
+    async def optimize(self) -> None:
+        for item in self._dbs:
+            tables = await _pragma(
+                item.db,
+                "SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'",
+            )
+            if tables:
+                await _pragma(item.db, "PRAGMA optimize")
+            else:
+                await _pragma(item.db, "ANALYZE")
+
+    async def files(self) -> List[Dict[str, Any]]:
+        """Return sizes of the maintained files"""
+        loop = asyncio.get_event_loop()
+        result = []
+        for item in self._dbs:
+            page_size = await _pragma_value(item.db, "PRAGMA page_size")
+            pages = await _pragma_value(item.db, "PRAGMA page_count")
+            free = await _pragma_value(item.db, "PRAGMA freelist_count")
+            wal = item.path.with_name(item.path.name + "-wal")
+            wal_size = await loop.run_in_executor(None, _file_size, wal)
+            result.append(
+                {
+                    "name": item.path.name,
+                    "size": page_size * pages,
+                    "free": page_size * free,
+                    "wal_size": wal_size,
+                }
+            )
+        return result
+
+    async def report(self) -> Dict[str, Any]:
+        tasks = {name: asdict(stats) for name, stats in self.stats.items()}
+        return {"files": await self.files(), "tasks": tasks}
+
+    async def run(self, name: str) -> None:
+        """Run a task by *name* now, recording its timing"""
+        [func] = [func for task, _, func in self._schedule if task == name]
+        stats = self.stats[name]
+        start = time.perf_counter()
+        await func()
+        stats.last_duration = time.perf_counter() - start
+        stats.total_duration += stats.last_duration
+        stats.last_run = time.time()
+        stats.runs += 1
+
+    async def _every(self, name: str, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run(name)
+            except Exception:
+                log.exception("DB maintenance %s failed", name)
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Callable, List, Set
+
+
+log = logging.getLogger(__name__)
+
+
+def _tables(cur: sqlite3.Cursor) -> Set[str]:
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {row[0] for row in cur.fetchall()}
+
+
+def _columns(cur: sqlite3.Cursor, table: str) -> Set[str]:
+    cur.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cur.fetchall()}
+
+
+# Files created before the runner existed have user_version 0 but may
+# already contain any part of the schema, so every step checks first.
+
+
+def _create_posts(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY,
+        title TEXT,
+        text TEXT,
+        owner TEXT,
+        editor TEXT,
+        image BLOB)
+    """
+    )
+
+
+def _add_versions(cur: sqlite3.Cursor) -> None:
+    if "version" not in _columns(cur, "posts"):
+        cur.execute("ALTER TABLE posts ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    if "revision" not in _tables(cur):
+        # Shard change counter, bumped by every write.
+        # A post's version is the revision of its last modification,
+        # the sum of shard counters versions the posts list.
+        cur.execute("CREATE TABLE revision (value INTEGER NOT NULL)")
+        cur.execute("INSERT INTO revision (value) VALUES (0)")
+
+
+def _add_images(cur: sqlite3.Cursor) -> None:
+    if "images" not in _tables(cur):
+        # Uploaded images deduplicated by content within the shard,
+        # refs counts posts which use the image.
+        cur.execute(
+            """CREATE TABLE images (
+            hash TEXT PRIMARY KEY,
+            thumbnail BLOB NOT NULL,
+            refs INTEGER NOT NULL)
+        """
+        )
+    columns = _columns(cur, "posts")
+    if "image" not in columns:
+        return
+    # Thumbnails stored inline become shared images rows.  The original
+    # upload was never kept, so such posts have no resized variants.
+    if "image_hash" not in columns:
+        cur.execute("ALTER TABLE posts ADD COLUMN image_hash TEXT")
+    cur.execute("SELECT id, image FROM posts WHERE image IS NOT NULL")
+    for post_id, thumbnail in cur.fetchall():
+        image_hash = hashlib.sha256(thumbnail).hexdigest()
+        cur.execute(
+            "INSERT INTO images (hash, thumbnail, refs) VALUES (?, ?, 1) "
+            "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1",
+            [image_hash, thumbnail],
+        )
+        cur.execute(
+            "UPDATE posts SET image_hash = ? WHERE id = ?", [image_hash, post_id]
+        )
+    # Old SQLite cannot DROP COLUMN, rebuild the table instead
+    cur.execute(
+        """CREATE TABLE posts_new (
+        id INTEGER PRIMARY KEY,
+        title TEXT,
+        text TEXT,
+        owner TEXT,
+        editor TEXT,
+        image_hash TEXT,
+        version INTEGER NOT NULL DEFAULT 0)
+    """
+    )
+    cur.execute(
+        "INSERT INTO posts_new (id, title, text, owner, editor, image_hash, version) "
+        "SELECT id, title, text, owner, editor, image_hash, version FROM posts"
+    )
+    cur.execute("DROP TABLE posts")
+    cur.execute("ALTER TABLE posts_new RENAME TO posts")
+
+
+def _add_settings(cur: sqlite3.Cursor) -> None:
+    cur.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)")
+
+
+def _add_listing_indexes(cur: sqlite3.Cursor) -> None:
+    # Filtered listings are ordered by id unless asked otherwise,
+    # the trailing id column serves both without a sort.
+    cur.execute("CREATE INDEX IF NOT EXISTS posts_owner ON posts (owner, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS posts_editor ON posts (editor, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS posts_title ON posts (title, id)")
+
+
+def _add_image_jobs(cur: sqlite3.Cursor) -> None:
+    if "status" not in _columns(cur, "images"):
+        # Thumbnails are made by background jobs, NULL until a job is done.
+        # status is 'pending', 'ready' or 'failed'.
+        cur.execute(
+            """CREATE TABLE images_new (
+            hash TEXT PRIMARY KEY,
+            thumbnail BLOB,
+            refs INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'ready')
+        """
+        )
+        cur.execute(
+            "INSERT INTO images_new (hash, thumbnail, refs) "
+            "SELECT hash, thumbnail, refs FROM images"
+        )
+        cur.execute("DROP TABLE images")
+        cur.execute("ALTER TABLE images_new RENAME TO images")
+    # One job per pending image, run_at is unix time, 0 means now.
+    # A claimed job has run_at pushed ahead by the claim lease.
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS image_jobs (
+        id INTEGER PRIMARY KEY,
+        image_hash TEXT NOT NULL UNIQUE,
+        run_at REAL NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT)
+    """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS image_jobs_run_at ON image_jobs (run_at)")
+
+
+# Append only: a DB at schema version N has MIGRATIONS[:N] applied
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _create_posts,
+    _add_versions,
+    _add_images,
+    _add_settings,
+    _add_listing_indexes,
+    _add_image_jobs,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(sqlite_db: Path) -> int:
+    """Upgrade DB file to the latest schema, return the number of applied steps.
+
+    Creates the file if it doesn't exist.  The write lock is taken before
+    reading the schema version, so worker processes starting together
+    upgrade the file only once.
+
+    Files are kept in incremental auto-vacuum mode, see Maintenance.vacuum().
+    A new file gets it right away, an older one keeps its mode until
+    convert_auto_vacuum() rebuilds it.
+    """
+    conn = sqlite3.connect(str(sqlite_db), timeout=30, isolation_level=None)
+    try:
+        cur = conn.cursor()
+        # Takes effect on a new file, or on the next VACUUM of an existing one
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("PRAGMA user_version")
+            version = cur.fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"{sqlite_db} has schema version {version}, "
+                    f"newer than supported {SCHEMA_VERSION}"
+                )
+            for migration in MIGRATIONS[version:]:
+                migration(cur)
+            cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] != 2:
+            log.warning(
+                "%s is not in incremental auto-vacuum mode, free pages are not "
+                "returned until it is converted with --convert-vacuum",
+                sqlite_db,
+            )
+    finally:
+        conn.close()
+    if version < SCHEMA_VERSION:
+        log.info("Upgraded %s to schema version %d", sqlite_db, SCHEMA_VERSION)
+    return SCHEMA_VERSION - version
+
+
+def convert_auto_vacuum(sqlite_db: Path) -> bool:
+    """Switch DB file to incremental auto-vacuum, return False if it already is.
+
+    The file is rebuilt by VACUUM, which holds the write lock for the whole
+    copy and needs free disk space of the file size, so this is an offline
+    step: run it with the server stopped.
+    """
+    conn = sqlite3.connect(str(sqlite_db), timeout=30, isolation_level=None)
+    try:
+        cur = conn.cursor()
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] == 2:
+            return False
+        log.info("Converting %s to incremental auto-vacuum", sqlite_db)
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("VACUUM")
+    finally:
+        conn.close()
+    return True
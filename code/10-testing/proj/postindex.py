@@ -0,0 +1,101 @@
+import bisect
+import sys
+from array import array
+from typing import Iterable, List, Optional
+
+from .repository import PostSummary
+
+
+class PostIndex:
+    """In-memory listing metadata of all posts, ordered by id.
+
+    Columns are stored separately: ids in a compact ``array('q')``, owners
+    and editors as interned strings shared between posts, so a post costs
+    a few machine words besides its title.  The index is loaded once on
+    startup and updated by the write handlers after commit; *revision*
+    follows the DB revision and is used as the posts list ETag.
+    """
+
+    def __init__(self) -> None:
+        self._ids = array("q")
+        self._owners: List[Optional[str]] = []
+        self._editors: List[Optional[str]] = []
+        self._titles: List[Optional[str]] = []
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, post_id: int) -> bool:
+        return self._find(int(post_id)) >= 0
+
+    def load(self, posts: Iterable[PostSummary], revision: int) -> None:
+        """Replace the content, *posts* should be ordered by id"""
+        self._ids = array("q")
+        self._owners = []
+        self._editors = []
+        self._titles = []
+        for post in posts:
+            self._ids.append(post.id)
+            self._owners.append(_intern(post.owner))
+            self._editors.append(_intern(post.editor))
+            self._titles.append(post.title)
+        self.revision = revision
+
+    def add(self, post_id: int, owner: str, editor: str, title: str) -> None:
+        post_id = int(post_id)
+        pos = bisect.bisect_left(self._ids, post_id)
+        if pos < len(self._ids) and self._ids[pos] == post_id:
+            self._owners[pos] = _intern(owner)
+            self._editors[pos] = _intern(editor)
+            self._titles[pos] = title
+        else:
+            self._ids.insert(pos, post_id)
+            self._owners.insert(pos, _intern(owner))
+            self._editors.insert(pos, _intern(editor))
+            self._titles.insert(pos, title)
+        self.revision += 1
+
+    def update(self, post_id: int, **fields: str) -> None:
+        pos = self._find(int(post_id))
+        if pos >= 0:
+            if "owner" in fields:
+                self._owners[pos] = _intern(fields["owner"])
+            if "editor" in fields:
+                self._editors[pos] = _intern(fields["editor"])
+            if "title" in fields:
+                self._titles[pos] = fields["title"]
+        self.revision += 1
+
+    def remove(self, post_id: int) -> None:
+        pos = self._find(int(post_id))
+        if pos >= 0:
+            del self._ids[pos]
+            del self._owners[pos]
+            del self._editors[pos]
+            del self._titles[pos]
+        self.revision += 1
+
+    def list(
+        self, owner: Optional[str] = None, editor: Optional[str] = None
+    ) -> List[PostSummary]:
+        """Return posts ordered by id, optionally filtered by owner and editor"""
+        return [
+            PostSummary(post_id, post_owner, post_editor, title)
+            for post_id, post_owner, post_editor, title in zip(
+                self._ids, self._owners, self._editors, self._titles
+            )
+            if (owner is None or post_owner == owner)
+            and (editor is None or post_editor == editor)
+        ]
+
+    def _find(self, post_id: int) -> int:
+        pos = bisect.bisect_left(self._ids, post_id)
+        if pos < len(self._ids) and self._ids[pos] == post_id:
+            return pos
+        return -1
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # Few distinct users own many posts, share a single copy of each name
+    return sys.intern(value) if value is not None else None
@@ -0,0 +1,424 @@
+import asyncio
+import functools
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import aiosqlite
+
+from .singleflight import SingleFlight
+
+
+# Posts list orders, mapped to ORDER BY clauses
+LIST_ORDERS = {
+    "id": "id",
+    "-id": "id DESC",
+    "title": "title, id",
+    "-title": "title DESC, id DESC",
+}
+
+
+class ListQuery(NamedTuple):
+    owner: Optional[str] = None
+    editor: Optional[str] = None
+    order: str = "id"
+
+
+class PostSummary(NamedTuple):
+    """Listing row, the post without its text.
+
+    Columns of posts are nullable, rows created outside of the API may
+    lack an owner, an editor or a title.
+    """
+
+    id: int
+    owner: Optional[str]
+    editor: Optional[str]
+    title: Optional[str]
+
+
+class Post(NamedTuple):
+    id: int
+    owner: str
+    editor: str
+    title: str
+    text: str
+    image_hash: Optional[str]
+    version: int
+
+
+class ImageJob(NamedTuple):
+    """Claimed thumbnail job"""
+
+    id: int
+    image_hash: str
+    attempts: int  # including the current one
+
+
+def _list_sql(owner: bool, editor: bool, order: str) -> str:
+    sql = "SELECT id, owner, editor, title FROM posts"
+    where = []
+    if owner:
+        where.append("owner = ?")
+    if editor:
+        where.append("editor = ?")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY " + LIST_ORDERS[order]
+
+
+# Every listing query is built once, the same SQL string lets sqlite3 reuse
+# the prepared statement from its per-connection cache.
+_LIST_SQL = {
+    (owner, editor, order): _list_sql(owner, editor, order)
+    for owner in (False, True)
+    for editor in (False, True)
+    for order in LIST_ORDERS
+}
+
+_GET_POST_SQL = (
+    "SELECT id, owner, editor, title, text, image_hash, version "
+    "FROM posts WHERE id = ?"
+)
+
+# Fields which update() may change, in the order of SET clauses
+_UPDATE_FIELDS = ("title", "text", "editor", "version")
+# UPDATE ... RETURNING appeared in SQLite 3.35
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# Retries of BEGIN refused because of a stale snapshot, see PostRepository.begin()
+_BEGIN_RETRIES = 5
+# Single-flighted reads of one post, see PostRepository._read()
+_POST_READS = ("get", "version", "image_hash", "thumbnail")
+
+
+class PostRepository:
+    """All SQL over posts and images of one DB file.
+
+    Rows are fetched as plain tuples, the connection has no row factory,
+    and turned into ``NamedTuple`` records: no per-row ``sqlite3.Row`` or
+    dict.  Statements are fixed strings, so their prepared versions stay
+    in the connection's statement cache.  Write transactions are controlled
+    by the caller through begin() and commit() or rollback(), or
+    transaction(); requests sharing the connection take turns.
+
+    Reads of a single post are single-flighted: concurrent requests for a
+    hot post share one query.  Writes to a post drop its reads in flight
+    from sharing, so a read issued after a write never gets older data.
+    """
+
+    def __init__(self, db: aiosqlite.Connection) -> None:
+        self.db = db
+        self._reads: SingleFlight[Any] = SingleFlight()
+        # Held from begin() till commit() or rollback()
+        self._write_lock = asyncio.Lock()
+
+    async def _read(
+        self, name: str, post_id: int, func: Callable[[int], Awaitable[Any]]
+    ) -> Any:
+        # Ids come as int or as str from URLs, both share a key
+        key = (name, str(post_id))
+        return await self._reads.do(key, functools.partial(func, post_id))
+
+    def _written(self, post_id: int) -> None:
+        for name in _POST_READS:
+            self._reads.forget((name, str(post_id)))
+
+    async def _fetchone(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        async with self.db.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+    async def _fetchall(self, sql: str, params: Sequence[Any] = ()) -> Iterable[Any]:
+        # One round trip to the DB thread, iterating fetches in small chunks
+        async with self.db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def _execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Run a modifying statement, return the number of changed rows"""
+        async with self.db.execute(sql, params) as cursor:
+            return cursor.rowcount
+
+    async def begin(self) -> None:
+        """Start a write transaction, taking the write lock right away.
+
+        Concurrent requests share the connection and so its transaction,
+        a rollback or commit of one would end writes of another.  begin()
+        waits until the previous write transaction on the connection is
+        committed or rolled back.
+
+        A read of a concurrent request on the same connection may hold a
+        snapshot older than a commit of another connection (image jobs,
+        other worker processes).  SQLite refuses to upgrade such a snapshot
+        to a write without waiting for busy_timeout, so BEGIN is retried
+        until that read is done.
+        """
+        await self._write_lock.acquire()
+        try:
+            for attempt in range(_BEGIN_RETRIES + 1):
+                try:
+                    async with self.db.execute("BEGIN IMMEDIATE"):
+                        return
+                except sqlite3.OperationalError:
+                    if attempt == _BEGIN_RETRIES:
+                        raise
+                    await asyncio.sleep(0.001 * 2 ** attempt)
+        except BaseException:
+            self._write_lock.release()
+            raise
+
+    async def commit(self) -> None:
+        """Commit the transaction started by begin(), rolled back on failure"""
+        try:
+            await self.db.commit()
+        except BaseException:
+            await self.db.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+
+    async def rollback(self) -> None:
+        """Roll back the transaction started by begin()"""
+        try:
+            await self.db.rollback()
+        finally:
+            self._write_lock.release()
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        """Run the block in a write transaction, rolled back on errors"""
+        await self.begin()
+        try:
+            yield
+        except BaseException:
+            await self.rollback()
+            raise
+        await self.commit()
+
+    async def setting(self, name: str) -> Optional[str]:
+        row = await self._fetchone("SELECT value FROM settings WHERE name = ?", [name])
+        return row[0] if row is not None else None
+
+    async def revision(self) -> int:
+        row = await self._fetchone("SELECT value FROM revision")
+        return row[0]
+
+    async def bump_revision(self) -> int:
+        """Increment DB revision counter and return the new value.
+
+        Should be called inside the write transaction, every modified post
+        stores the returned value in its version column.
+        """
+        if _HAS_RETURNING:
+            # One statement, concurrent bumps never read back the same value
+            row = await self._fetchone(
+                "UPDATE revision SET value = value + 1 RETURNING value"
+            )
+            return row[0]
+        # The write lock of begin() keeps other requests from bumping in between
+        await self._execute("UPDATE revision SET value = value + 1")
+        return await self.revision()
+
+    async def next_post_id(self) -> int:
+        """Take the next value of the post id sequence.
+
+        Should be called inside the write transaction.  The sequence lives
+        in the settings of the main DB file and serves all shards, so ids
+        grow in creation order.
+        """
+        if _HAS_RETURNING:
+            row = await self._fetchone(
+                "INSERT INTO settings (name, value) VALUES ('post_id', 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value"
+            )
+            return row[0]
+        await self._execute(
+            "INSERT INTO settings (name, value) VALUES ('post_id', 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1"
+        )
+        row = await self._fetchone("SELECT value FROM settings WHERE name = 'post_id'")
+        return row[0]
+
+    async def skip_post_ids(self, last: int) -> None:
+        """Move the post id sequence past *last*, it never goes back.
+
+        Files older than the sequence have posts with ids it didn't give.
+        """
+        await self._execute(
+            "INSERT INTO settings (name, value) VALUES ('post_id', ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)",
+            [last],
+        )
+
+    async def max_post_id(self) -> int:
+        row = await self._fetchone("SELECT COALESCE(MAX(id), 0) FROM posts")
+        return row[0]
+
+    async def list(self, query: ListQuery = ListQuery()) -> List[PostSummary]:
+        params = [value for value in (query.owner, query.editor) if value is not None]
+        sql = _LIST_SQL[query.owner is not None, query.editor is not None, query.order]
+        return [PostSummary._make(row) for row in await self._fetchall(sql, params)]
+
+    async def get(self, post_id: int) -> Post:
+        return await self._read("get", post_id, self._get)
+
+    async def _get(self, post_id: int) -> Post:
+        row = await self._fetchone(_GET_POST_SQL, [post_id])
+        if row is None:
+            raise RuntimeError(f"Post {post_id} doesn't exist")
+        return Post._make(row)
+
+    async def version(self, post_id: int) -> Optional[int]:
+        return await self._read("version", post_id, self._version)
+
+    async def _version(self, post_id: int) -> Optional[int]:
+        row = await self._fetchone("SELECT version FROM posts WHERE id = ?", [post_id])
+        return row[0] if row is not None else None
+
+    async def insert(
+        self, post_id: int, owner: str, title: str, text: str, version: int
+    ) -> None:
+        """Insert a new post, *post_id* comes from next_post_id()"""
+        await self._execute(
+            "INSERT INTO posts (id, owner, editor, title, text, version) "
+            "VALUES(?, ?, ?, ?, ?, ?)",
+            [post_id, owner, owner, title, text, version],
+        )
+
+    async def update(self, post_id: int, **fields: Any) -> bool:
+        """Set title, text, editor or version, return False for a missing post"""
+        unknown = fields.keys() - set(_UPDATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Cannot update {', '.join(sorted(unknown))}")
+        self._written(post_id)
+        names = [name for name in _UPDATE_FIELDS if name in fields]
+        assignments = ", ".join(f"{name} = ?" for name in names)
+        params = [fields[name] for name in names] + [post_id]
+        sql = f"UPDATE posts SET {assignments} WHERE id = ?"
+        return await self._execute(sql, params) > 0
+
+    async def delete(self, post_id: int) -> bool:
+        self._written(post_id)
+        return await self._execute("DELETE FROM posts WHERE id = ?", [post_id]) > 0
+
+    async def image_hash(self, post_id: int) -> Optional[str]:
+        """Return hash of the post's image, None if it has no image"""
+        return await self._read("image_hash", post_id, self._image_hash)
+
+    async def _image_hash(self, post_id: int) -> Optional[str]:
+        row = await self._fetchone(
+            "SELECT image_hash FROM posts WHERE id = ?", [post_id]
+        )
+        if row is None:
+            raise RuntimeError(f"Post {post_id} doesn't exist")
+        return row[0]
+
+    async def thumbnail(self, post_id: int) -> Optional[bytes]:
+        return await self._read("thumbnail", post_id, self._thumbnail)
+
+    async def _thumbnail(self, post_id: int) -> Optional[bytes]:
+        row = await self._fetchone(
+            "SELECT thumbnail FROM posts JOIN images ON images.hash = posts.image_hash "
+            "WHERE posts.id = ?",
+            [post_id],
+        )
+        return row[0] if row is not None else None
+
+    async def set_image(self, post_id: int, image_hash: Optional[str]) -> None:
+        self._written(post_id)
+        await self._execute(
+            "UPDATE posts SET image_hash = ? WHERE id = ?", [image_hash, post_id]
+        )
+
+    async def queue_image(self, image_hash: str) -> None:
+        """Add a new image without thumbnail and a job to make it.
+
+        A known image gets one more reference, like in acquire_image().
+        """
+        await self._execute(
+            "INSERT INTO images (hash, thumbnail, refs, status) "
+            "VALUES (?, NULL, 1, 'pending') "
+            "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1",
+            [image_hash],
+        )
+        await self._execute(
+            "INSERT INTO image_jobs (image_hash) VALUES (?) "
+            "ON CONFLICT (image_hash) DO NOTHING",
+            [image_hash],
+        )
+
+    async def claim_image_job(self, now: float, lease: float) -> Optional[ImageJob]:
+        """Take the earliest due job for *lease* seconds.
+
+        Return None if no job is due or another process has just claimed
+        it.  The caller should commit the claim right away.
+        """
+        row = await self._fetchone(
+            "SELECT id, image_hash, attempts FROM image_jobs "
+            "WHERE run_at <= ? ORDER BY run_at LIMIT 1",
+            [now],
+        )
+        if row is None:
+            return None
+        job_id, image_hash, attempts = row
+        claimed = await self._execute(
+            "UPDATE image_jobs SET run_at = ?, attempts = attempts + 1 "
+            "WHERE id = ? AND attempts = ?",
+            [now + lease, job_id, attempts],
+        )
+        return ImageJob(job_id, image_hash, attempts + 1) if claimed else None
+
+    async def finish_image_job(self, job: ImageJob, thumbnail: bytes) -> None:
+        await self._execute(
+            "UPDATE images SET thumbnail = ?, status = 'ready' WHERE hash = ?",
+            [thumbnail, job.image_hash],
+        )
+        await self._execute("DELETE FROM image_jobs WHERE id = ?", [job.id])
+
+    async def retry_image_job(self, job: ImageJob, run_at: float, error: str) -> None:
+        await self._execute(
+            "UPDATE image_jobs SET run_at = ?, error = ? WHERE id = ?",
+            [run_at, error, job.id],
+        )
+
+    async def fail_image_job(self, job: ImageJob) -> None:
+        await self._execute(
+            "UPDATE images SET status = 'failed' WHERE hash = ?", [job.image_hash]
+        )
+        await self._execute("DELETE FROM image_jobs WHERE id = ?", [job.id])
+
+    async def release_image_job(self, job: ImageJob) -> None:
+        """Give an unfinished claim back, the attempt doesn't count"""
+        await self._execute(
+            "UPDATE image_jobs SET run_at = 0, attempts = attempts - 1 WHERE id = ?",
+            [job.id],
+        )
+
+    async def acquire_image(self, image_hash: str) -> bool:
+        """Add a reference to a known image, return False if it is unknown"""
+        changed = await self._execute(
+            "UPDATE images SET refs = refs + 1 WHERE hash = ?", [image_hash]
+        )
+        return changed > 0
+
+    async def release_image(self, image_hash: str) -> Optional[str]:
+        """Drop a reference to the image, return its hash if it was the last one"""
+        await self._execute(
+            "UPDATE images SET refs = refs - 1 WHERE hash = ?", [image_hash]
+        )
+        if await self._execute(
+            "DELETE FROM images WHERE hash = ? AND refs <= 0", [image_hash]
+        ):
+            await self._execute(
+                "DELETE FROM image_jobs WHERE image_hash = ?", [image_hash]
+            )
+            return image_hash
+        return None
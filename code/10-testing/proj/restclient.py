@@ -0,0 +1,429 @@
+import asyncio
+import functools
+import itertools
+import json
+import random
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from types import TracebackType
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+import aiohttp
+import click
+from yarl import URL
+
+from .cache import HTTPCache
+
+
+_T = TypeVar("_T")
+
+# Worth another try: the server is overloaded or temporarily broken
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+@dataclass(frozen=True)
+class Post:
+    id: int
+    owner: str
+    editor: str
+    title: str
+    text: Optional[str]  # post listing doesn't return text field
+
+    def pprint(self) -> None:
+        click.echo(f"Post {self.id}")
+        click.echo(f"  Owner:  {self.owner}")
+        click.echo(f"  Editor: {self.editor}")
+        click.echo(f"  Title:  {self.title}")
+        if self.text is not None:
+            click.echo(f"  Text:   {self.text}")
+
+
+@dataclass(frozen=True)
+class Event:
+    type: str  # "create", "update" or "delete"
+    post_id: int
+    version: int
+    data: Dict[str, Any]
+
+    def pprint(self) -> None:
+        click.echo(f"{self.type.capitalize()} post {self.post_id}")
+        for name, value in self.data.items():
+            click.echo(f"  {name.capitalize() + ':':7} {value}")
+
+
+@dataclass
+class ClientStats:
+    requests: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0  # duplicate GETs sent after the p95 latency
+    hedges_won: int = 0  # duplicates which answered first
+
+    def report(self) -> str:
+        return (
+            f"{self.requests} requests, {self.retries} retries, "
+            f"{self.timeouts} timeouts, {self.hedges} hedges "
+            f"({self.hedges_won} won)"
+        )
+
+
+class _Response(NamedTuple):
+    status: int
+    headers: Mapping[str, str]
+    body: bytes
+
+
+class Client:
+    # Max number of responses remembered for conditional GET revalidation
+    VALIDATED_CACHE_SIZE = 1024
+    # GET latencies kept to estimate p95 for hedging, hedging starts
+    # once there are enough samples.
+    LATENCY_SAMPLES = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        base_url: URL,
+        user: str,
+        *,
+        transport: str = "http",
+        cache: Optional[HTTPCache] = None,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        backoff: float = 0.1,
+        hedge: bool = False,
+    ) -> None:
+        """REST API client.
+
+        *timeout* limits every HTTP request, idempotent calls (get, list
+        and delete) are retried up to *retries* times with jittered
+        exponential backoff starting at *backoff* seconds.  With *hedge*
+        a GET still running after the observed p95 latency is sent again
+        and the first answer wins.  These apply to the HTTP transport.
+        """
+        if transport not in ("http", "ws"):
+            raise ValueError(f"Unknown transport {transport!r}")
+        self._base_url = base_url
+        self._user = user
+        self._transport = transport
+        # Opened and closed by the caller, may outlive the client
+        self._cache = cache
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._hedge = hedge
+        self._latencies: "deque[float]" = deque(maxlen=self.LATENCY_SAMPLES)
+        self.stats = ClientStats()
+        self._client = aiohttp.ClientSession(raise_for_status=True)
+        # URL -> (ETag, decoded JSON body)
+        self._validated: "OrderedDict[URL, Tuple[str, Any]]" = OrderedDict()
+        # WebSocket transport state, the socket is opened on first call
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._ws_lock = asyncio.Lock()
+        self._ws_reader: Optional["asyncio.Task[None]"] = None
+        self._ws_ids = itertools.count(1)
+        self._ws_pending: Dict[int, "asyncio.Future[Any]"] = {}
+
+    async def close(self) -> None:
+        if self._ws is not None:
+            await self._ws.close()
+        if self._ws_reader is not None:
+            await self._ws_reader
+        return await self._client.close()
+
+    async def __aenter__(self) -> "Client":
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> Optional[bool]:
+        await self.close()
+        return None
+
+    def _make_url(self, path: str) -> URL:
+        return self._base_url / path
+
+    async def _ws_connect(self) -> aiohttp.ClientWebSocketResponse:
+        async with self._ws_lock:
+            if self._ws is None or self._ws.closed:
+                self._ws = await self._client.ws_connect(self._make_url("api/ws"))
+                self._ws_reader = asyncio.ensure_future(self._ws_read(self._ws))
+            return self._ws
+
+    async def _ws_read(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                reply = msg.json()
+                fut = self._ws_pending.pop(reply.get("id"), None)
+                if fut is None or fut.done():
+                    continue
+                if reply["status"] == "ok":
+                    fut.set_result(reply["data"])
+                else:
+                    fut.set_exception(RuntimeError(reply["reason"]))
+        finally:
+            pending = tuple(self._ws_pending.values())
+            self._ws_pending.clear()
+            for fut in pending:
+                if not fut.done():
+                    fut.set_exception(ConnectionError("WebSocket is closed"))
+
+    async def _ws_call(self, op: str, **args: Any) -> Any:
+        # Calls are pipelined: many may be in flight on the same socket,
+        # replies are matched by id and can arrive in any order.
+        ws = await self._ws_connect()
+        call_id = next(self._ws_ids)
+        fut = asyncio.get_event_loop().create_future()
+        self._ws_pending[call_id] = fut
+        try:
+            await ws.send_json({"id": call_id, "op": op, "args": args})
+            return await fut
+        finally:
+            self._ws_pending.pop(call_id, None)
+
+    async def _get_json(self, url: URL) -> Any:
+        if self._cache is not None:
+            return await self._get_cached_json(url, self._cache)
+        # Revalidate previously seen response, the server answers
+        # 304 Not Modified without a body if the data is the same.
+        headers: Dict[str, str] = {}
+        cached = self._validated.get(url)
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        resp = await self._fetch(url, headers)
+        if resp.status == 304 and cached is not None:
+            self._validated.move_to_end(url)
+            return cached[1]
+        ret = json.loads(resp.body)
+        etag = resp.headers.get("ETag")
+        if etag is not None:
+            self._validated[url] = (etag, ret)
+            self._validated.move_to_end(url)
+            if len(self._validated) > self.VALIDATED_CACHE_SIZE:
+                self._validated.popitem(last=False)
+        return ret
+
+    async def _get_cached_json(self, url: URL, cache: HTTPCache) -> Any:
+        key = str(url)
+        entry = await cache.get(key)
+        if entry is not None and entry.fresh:
+            return json.loads(entry.body)
+        headers: Dict[str, str] = {}
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        resp = await self._fetch(url, headers)
+        cache_control = resp.headers.get("Cache-Control")
+        if resp.status == 304 and entry is not None:
+            await cache.refresh(key, cache_control)
+            return json.loads(entry.body)
+        await cache.put(key, resp.headers.get("ETag"), resp.body, cache_control)
+        return json.loads(resp.body)
+
+    async def _fetch(self, url: URL, headers: Dict[str, str]) -> _Response:
+        return await self._retry(functools.partial(self._hedged_get, url, headers))
+
+    async def _get_once(self, url: URL, headers: Dict[str, str]) -> _Response:
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        self.stats.requests += 1
+        async with self._client.get(
+            url, headers=headers, timeout=self._timeout
+        ) as resp:
+            body = await resp.read()
+        self._latencies.append(loop.time() - start)
+        return _Response(resp.status, resp.headers, body)
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self._hedge or len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    async def _hedged_get(self, url: URL, headers: Dict[str, str]) -> _Response:
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._get_once(url, headers)
+        primary = asyncio.ensure_future(self._get_once(url, headers))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Slower than 95% of requests, likely stuck behind something;
+                # a duplicate often overtakes it.
+                self.stats.hedges += 1
+                tasks.append(asyncio.ensure_future(self._get_once(url, headers)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats.hedges_won += 1
+                        return task.result()
+            return primary.result()  # both failed
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _retry(self, func: Callable[[], Awaitable[_T]]) -> _T:
+        """Call *func*, retrying on network errors, timeouts and overload"""
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except aiohttp.ClientResponseError as exc:
+                if exc.status not in RETRY_STATUSES:
+                    raise
+                error: Exception = exc
+            except asyncio.TimeoutError as exc:
+                self.stats.timeouts += 1
+                error = exc
+            except aiohttp.ClientConnectionError as exc:
+                error = exc
+            if attempt >= self._retries:
+                raise error
+            delay = self._backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _invalidate(self, post_id: Optional[int] = None) -> None:
+        # Own writes must be visible to following reads from the cache
+        if self._cache is None:
+            return
+        if post_id is not None:
+            await self._cache.invalidate(str(self._make_url(f"api/{post_id}")))
+        listing = str(self._make_url("api"))
+        await self._cache.invalidate(listing)
+        await self._cache.invalidate(listing + "?", prefix=True)
+
+    async def create(self, title: str, text: str) -> Post:
+        if self._transport == "ws":
+            data = await self._ws_call(
+                "create", owner=self._user, title=title, text=text
+            )
+            return Post(**data)
+        self.stats.requests += 1
+        async with self._client.post(
+            self._make_url("api"),
+            json={"owner": self._user, "title": title, "text": text},
+            timeout=self._timeout,
+        ) as resp:
+            ret = await resp.json()
+        await self._invalidate()
+        return Post(**ret["data"])
+
+    async def get(self, post_id: int) -> Post:
+        if self._transport == "ws":
+            return Post(**await self._ws_call("get", post_id=post_id))
+        ret = await self._get_json(self._make_url(f"api/{post_id}"))
+        return Post(**ret["data"])
+
+    async def delete(self, post_id: int) -> None:
+        if self._transport == "ws":
+            await self._ws_call("delete", post_id=post_id)
+            return
+        url = self._make_url(f"api/{post_id}")
+        self._validated.pop(url, None)
+        attempts = 0
+
+        async def delete_once() -> None:
+            nonlocal attempts
+            attempts += 1
+            self.stats.requests += 1
+            try:
+                async with self._client.delete(url, timeout=self._timeout) as resp:
+                    resp  # to make linter happy
+            except aiohttp.ClientResponseError as exc:
+                # An earlier attempt deleted the post but its answer was lost
+                if exc.status != 404 or attempts == 1:
+                    raise
+
+        await self._retry(delete_once)
+        await self._invalidate(post_id)
+
+    async def update(
+        self, post_id: int, title: Optional[str] = None, text: Optional[str] = None
+    ) -> Post:
+        json = {"editor": self._user}
+        if title is not None:
+            json["title"] = title
+        if text is not None:
+            json["text"] = text
+        if self._transport == "ws":
+            return Post(**await self._ws_call("update", post_id=post_id, **json))
+        self.stats.requests += 1
+        async with self._client.patch(
+            self._make_url(f"api/{post_id}"), json=json, timeout=self._timeout
+        ) as resp:
+            ret = await resp.json()
+        await self._invalidate(post_id)
+        return Post(**ret["data"])
+
+    async def list(
+        self,
+        *,
+        owner: Optional[str] = None,
+        editor: Optional[str] = None,
+        order: Optional[str] = None,
+    ) -> List[Post]:
+        params: Dict[str, str] = {}
+        if owner is not None:
+            params["owner"] = owner
+        if editor is not None:
+            params["editor"] = editor
+        if order is not None:
+            params["order"] = order
+        if self._transport == "ws":
+            data = await self._ws_call("list", **params)
+            return [Post(text=None, **item) for item in data]
+        ret = await self._get_json(self._make_url(f"api").with_query(params))
+        return [Post(text=None, **item) for item in ret["data"]]
+
+    async def watch(self) -> AsyncIterator[Event]:
+        """Iterate over post changes pushed by the server"""
+        async with self._client.get(
+            self._make_url("api/events"),
+            timeout=aiohttp.ClientTimeout(total=None),
+        ) as resp:
+            event_type = "message"
+            data: List[str] = []
+            async for raw_line in resp.content:
+                line = raw_line.decode("utf-8").rstrip("\r\n")
+                if not line:
+                    if data:
+                        payload = json.loads("\n".join(data))
+                        post_id = payload.pop("id")
+                        version = payload.pop("version")
+                        yield Event(event_type, post_id, version, payload)
+                    event_type = "message"
+                    data = []
+                elif line.startswith(":"):
+                    continue  # keep-alive comment
+                else:
+                    name, _, value = line.partition(":")
+                    value = value[1:] if value.startswith(" ") else value
+                    if name == "event":
+                        event_type = value
+                    elif name == "data":
+                        data.append(value)
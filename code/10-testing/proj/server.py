@@ -1,20 +1,88 @@
 import asyncio
+import functools
+import hashlib
+import heapq
 import io
+import logging
+import os
+import socket
 import sqlite3
+import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, AsyncIterator, Awaitable, Callable, Dict
-
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import aiohttp
 import aiohttp_jinja2
 import aiohttp_session
 import aiosqlite
+import click
 import jinja2
 import PIL
 import PIL.Image
 from aiohttp import web
 
+from .admission import AdmissionControl, admission_middleware
+from .blocking import BlockingDetector, track_route
+from .events import EventHub
+from .imagecache import VariantCache
+from .jobs import ImageJobs
+from .maintenance import Maintenance
+from .migrations import convert_auto_vacuum, migrate
+from .postindex import PostIndex
+from .repository import LIST_ORDERS, ListQuery, Post, PostRepository, PostSummary
+from .serializer import JSONSerializer, make_serializer
+from .workers import Supervisor, make_socket
+
+
+log = logging.getLogger(__name__)
 
 _WebHandler = Callable[[web.Request], Awaitable[web.StreamResponse]]
 
+# Allowed variant sizes, arbitrary ones would let clients flood the cache
+IMAGE_SIZES = frozenset([64, 128, 256, 512, 1024])
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+MAX_UPLOAD_SIZE = 64 * 1024 ** 2
+MAX_FIELD_SIZE = 1024 ** 2
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Concurrency limits of the costly routes, see AdmissionControl
+ROUTE_LIMITS = {
+    "GET /{post}/image": 16,  # resizes images in the executor
+    "POST /new": 8,  # uploads
+    "POST /{post}/edit": 8,
+}
+# DB maintenance may take the write lock with no more requests in flight
+# and the event loop lagging less than that many seconds
+QUIET_IN_FLIGHT = 2
+QUIET_LAG = 0.05
+# Warm-up reads at most this much of every DB file into the OS page cache
+WARM_UP_READ_SIZE = 256 * 1024 ** 2
+
+
+class Upload(NamedTuple):
+    path: Path  # temporary file
+    sha256: str  # hex digest of the content
+
+
+class Shard(NamedTuple):
+    number: int
+    db: aiosqlite.Connection
+    posts: PostRepository
+    media_path: Path  # originals of images referenced by the shard's posts
+
 
 def require_login(func: _WebHandler) -> _WebHandler:
     func.__require_login__ = True  # type: ignore
@@ -67,92 +135,399 @@ def handle_json_error(
         except asyncio.CancelledError:
             raise
         except Exception as ex:
-            return web.json_response(
-                {"status": "failed", "reason": str(ex)}, status=400
-            )
+            return api_failed(request, str(ex))
 
     return handler
 
 
+def api_response(
+    body: bytes, *, status: int = 200, headers: Optional[Mapping[str, str]] = None
+) -> web.Response:
+    """Response with JSON *body* encoded by the app serializer"""
+    return web.Response(
+        body=body, status=status, headers=headers, content_type="application/json"
+    )
+
+
+def api_ok(
+    request: web.Request, data: Any, headers: Optional[Mapping[str, str]] = None
+) -> web.Response:
+    body = request.config_dict["JSON"].ok(data)
+    return api_response(body, headers=headers)
+
+
+def api_failed(request: web.Request, reason: str, status: int = 400) -> web.Response:
+    body = request.config_dict["JSON"].failed(reason)
+    return api_response(body, status=status)
+
+
+def make_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def not_modified(request: web.Request, etag: str) -> Optional[web.Response]:
+    """Return 304 response if the client already has *etag* version"""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is None:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return web.Response(status=304, headers={"ETag": etag})
+    return None
+
+
+def publish_event(
+    request: web.Request, event: str, post_id: int, version: int, **fields: Any
+) -> None:
+    """Propagate a committed change to the post index and SSE subscribers"""
+    index = request.config_dict["POST_INDEX"]
+    if index is not None:
+        if event == "create":
+            index.add(post_id, fields["owner"], fields["editor"], fields["title"])
+        elif event == "update":
+            index.update(post_id, **fields)
+        elif event == "delete":
+            index.remove(post_id)
+    hub = request.config_dict["EVENTS"]
+    hub.publish(event, {"id": int(post_id), "version": version, **fields})
+
+
+def get_shard(request: web.Request, post_id: int) -> Shard:
+    """Return the shard which stores *post_id*"""
+    shards = request.config_dict["SHARDS"]
+    try:
+        return shards[int(post_id) % len(shards)]
+    except ValueError:
+        raise RuntimeError(f"Post {post_id} doesn't exist")
+
+
+async def list_revision(request: web.Request) -> int:
+    index = request.config_dict["POST_INDEX"]
+    if index is not None:
+        return index.revision
+    # Every shard counter only grows, so their sum changes on any write
+    shards = request.config_dict["SHARDS"]
+    revisions = await asyncio.gather(*(s.posts.revision() for s in shards))
+    return sum(revisions)
+
+
+def parse_list_query(params: Mapping[str, Any]) -> ListQuery:
+    """Validate ?owner=&editor=&order= listing parameters"""
+    order = params.get("order") or "id"
+    if order not in LIST_ORDERS:
+        orders = ", ".join(LIST_ORDERS)
+        raise ValueError(f"Posts order should be one of {orders}")
+    # Empty values come from a blank form field and mean no filter
+    return ListQuery(params.get("owner") or None, params.get("editor") or None, order)
+
+
+def _order_key(order: str) -> Tuple[Callable[[PostSummary], Any], bool]:
+    if order.lstrip("-") == "title":
+        return (lambda post: (post.title or "", post.id)), order[0] == "-"
+    return (lambda post: post.id), order[0] == "-"
+
+
+def post_json(post: Post) -> Dict[str, Any]:
+    """Public fields of the post"""
+    return {
+        "id": post.id,
+        "owner": post.owner,
+        "editor": post.editor,
+        "title": post.title,
+        "text": post.text,
+    }
+
+
+async def gather_posts(
+    request: web.Request, query: ListQuery = ListQuery()
+) -> List[PostSummary]:
+    """Scatter-gather posts of all shards, filtered and ordered by *query*"""
+    index = request.config_dict["POST_INDEX"]
+    if index is not None:
+        ret = index.list(owner=query.owner, editor=query.editor)
+        if query.order != "id":
+            key, reverse = _order_key(query.order)
+            ret.sort(key=key, reverse=reverse)
+        return ret
+    return await _gather_posts(request.config_dict["SHARDS"], query)
+
+
+async def _gather_posts(
+    shards: List[Shard], query: ListQuery = ListQuery()
+) -> List[PostSummary]:
+    if len(shards) == 1:
+        return await shards[0].posts.list(query)
+    results = await asyncio.gather(*(s.posts.list(query) for s in shards))
+    key, reverse = _order_key(query.order)
+    return [post for post in heapq.merge(*results, key=key, reverse=reverse)]
+
+
+@asynccontextmanager
+async def new_post_transaction(
+    request: web.Request,
+) -> AsyncIterator[Tuple[Shard, int]]:
+    """Take an id for a new post and run the block in its shard's transaction.
+
+    Ids come from one sequence in the main DB file, so they grow in creation
+    order across shards, and pick the shard like for any other post, see
+    get_shard(): consecutive posts are spread round robin.  With several
+    shards the id is committed first, a failed insert leaves a gap.
+    """
+    shards = request.config_dict["SHARDS"]
+    main_posts = shards[0].posts
+    if len(shards) == 1:
+        async with main_posts.transaction():
+            yield shards[0], await main_posts.next_post_id()
+        return
+    async with main_posts.transaction():
+        post_id = await main_posts.next_post_id()
+    shard = get_shard(request, post_id)
+    async with shard.posts.transaction():
+        yield shard, post_id
+
+
+async def create_post(
+    request: web.Request, owner: str, title: str, text: str
+) -> Dict[str, Any]:
+    async with new_post_transaction(request) as (shard, post_id):
+        version = await shard.posts.bump_revision()
+        await shard.posts.insert(post_id, owner, title, text, version)
+    publish_event(
+        request, "create", post_id, version, owner=owner, editor=owner, title=title
+    )
+    return {
+        "id": post_id,
+        "owner": owner,
+        "editor": owner,
+        "title": title,
+        "text": text,
+    }
+
+
+async def update_post(
+    request: web.Request,
+    post_id: int,
+    post: Mapping[str, Any],
+    image: Optional[Upload] = None,
+) -> Dict[str, Any]:
+    """Apply an edit of title, text, editor or image and publish it.
+
+    PATCH, the WebSocket update and the edit form all end here, so the
+    returned post and the event carry the same fields and version: the
+    post is read back in the edit's transaction.
+    """
+    shard = get_shard(request, post_id)
+    post_id = int(post_id)  # a str from URLs
+    fields = {name: post[name] for name in ("title", "text", "editor") if name in post}
+    if not fields and image is None:
+        return post_json(await shard.posts.get(post_id))
+    orphan = None
+    async with shard.posts.transaction():
+        version = await shard.posts.bump_revision()
+        if not await shard.posts.update(post_id, version=version, **fields):
+            raise RuntimeError(f"Post {post_id} doesn't exist")
+        if image is not None:
+            orphan = await apply_image(shard, post_id, image)
+        new_post = await shard.posts.get(post_id)
+    if image is not None:
+        request.config_dict["IMAGE_JOBS"].wake()
+    if orphan is not None:
+        await remove_original_image(shard.media_path, orphan)
+    publish_event(
+        request,
+        "update",
+        post_id,
+        new_post.version,
+        owner=new_post.owner,
+        editor=new_post.editor,
+        title=new_post.title,
+    )
+    return post_json(new_post)
+
+
+async def remove_post(request: web.Request, post_id: int) -> bool:
+    """Delete a post, return False if it doesn't exist"""
+    shard = get_shard(request, post_id)
+    posts = shard.posts
+    # A missing post leaves the transaction empty, there is nothing to undo
+    async with posts.transaction():
+        try:
+            image_hash = await posts.image_hash(post_id)
+        except RuntimeError:
+            return False
+        if not await posts.delete(post_id):
+            return False
+        orphan = None
+        if image_hash is not None:
+            orphan = await posts.release_image(image_hash)
+        version = await posts.bump_revision()
+    publish_event(request, "delete", post_id, version)
+    if orphan is not None:
+        await remove_original_image(shard.media_path, orphan)
+    return True
+
+
 @router.get("/api")
 @handle_json_error
 async def api_list_posts(request: web.Request) -> web.Response:
-    ret = []
-    db = request.config_dict["DB"]
-    async with db.execute("SELECT id, owner, editor, title FROM posts") as cursor:
-        async for row in cursor:
-            ret.append(
-                {
-                    "id": row["id"],
-                    "owner": row["owner"],
-                    "editor": row["editor"],
-                    "title": row["title"],
-                }
-            )
-    return web.json_response({"status": "ok", "data": ret})
+    query = parse_list_query(request.query)
+    etag = make_etag(await list_revision(request))
+    resp = not_modified(request, etag)
+    if resp is not None:
+        return resp
+    posts = await gather_posts(request, query)
+    body = request.config_dict["JSON"].ok_records(posts)
+    return api_response(body, headers={"ETag": etag})
 
 
 @router.post("/api")
 @handle_json_error
 async def api_new_post(request: web.Request) -> web.Response:
     post = await request.json()
-    title = post["title"]
-    text = post["text"]
-    owner = post["owner"]
-    db = request.config_dict["DB"]
-    async with db.execute(
-        "INSERT INTO posts (owner, editor, title, text) VALUES(?, ?, ?, ?)",
-        [owner, owner, title, text],
-    ) as cursor:
-        post_id = cursor.lastrowid
-    await db.commit()
-    return web.json_response(
-        {
-            "status": "ok",
-            "data": {
-                "id": post_id,
-                "owner": owner,
-                "editor": owner,
-                "title": title,
-                "text": text,
-            },
-        }
+    data = await create_post(request, post["owner"], post["title"], post["text"])
+    return api_ok(request, data)
+
+
+@router.get("/api/events")
+async def api_events(request: web.Request) -> web.StreamResponse:
+    """Server-sent events stream of post changes"""
+    hub = request.config_dict["EVENTS"]
+    resp = web.StreamResponse(
+        headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
     )
+    await resp.prepare(request)
+    with hub.subscribe() as subscription:
+        while True:
+            try:
+                frame = await asyncio.wait_for(
+                    subscription.get(), request.config_dict["EVENTS_HEARTBEAT"]
+                )
+            except asyncio.TimeoutError:
+                # Comment line keeps idle connection alive through proxies
+                await resp.write(b": ping\n\n")
+                continue
+            if frame is None:
+                break
+            await resp.write(frame)
+    return resp
+
+
+async def _ws_dispatch(request: web.Request, frame: Dict[str, Any]) -> Any:
+    op = frame["op"]
+    args = frame.get("args", {})
+    if op == "list":
+        posts = await gather_posts(request, parse_list_query(args))
+        return [post._asdict() for post in posts]
+    elif op == "create":
+        return await create_post(request, args["owner"], args["title"], args["text"])
+    elif op == "get":
+        post_id = args["post_id"]
+        post = await get_shard(request, post_id).posts.get(post_id)
+        return post_json(post)
+    elif op == "update":
+        return await update_post(request, args["post_id"], args)
+    elif op == "delete":
+        if not await remove_post(request, args["post_id"]):
+            raise RuntimeError(f"Post {args['post_id']} doesn't exist")
+        return None
+    else:
+        raise RuntimeError(f"Unknown operation {op!r}")
+
+
+async def _ws_handle_frame(
+    request: web.Request,
+    ws: web.WebSocketResponse,
+    frame: Dict[str, Any],
+    limit: asyncio.Semaphore,
+) -> None:
+    try:
+        data = await _ws_dispatch(request, frame)
+        reply = {"id": frame.get("id"), "status": "ok", "data": data}
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        reply = {"id": frame.get("id"), "status": "failed", "reason": str(ex)}
+    finally:
+        limit.release()
+    if not ws.closed:
+        await ws.send_str(request.config_dict["JSON"].dumps(reply).decode())
+
+
+@router.get("/api/ws")
+async def api_ws(request: web.Request) -> web.WebSocketResponse:
+    """Multiplexed REST API over a single WebSocket.
+
+    Every request frame is ``{"id": ..., "op": ..., "args": {...}}``, replies
+    carry the same id and are sent as soon as the operation finishes,
+    not necessarily in request order.
+    """
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    # Reading stops while too many operations are in flight,
+    # TCP flow control then pushes back on the client.
+    limit = asyncio.Semaphore(request.config_dict["WS_MAX_IN_FLIGHT"])
+    tasks: Set["asyncio.Task[None]"] = set()
+    try:
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                frame = msg.json()
+            except ValueError:
+                reply = request.config_dict["JSON"].failed("invalid JSON")
+                await ws.send_str(reply.decode())
+                continue
+            if not isinstance(frame, dict):
+                reply = request.config_dict["JSON"].failed("frame is not an object")
+                await ws.send_str(reply.decode())
+                continue
+            await limit.acquire()
+            task = asyncio.ensure_future(_ws_handle_frame(request, ws, frame, limit))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return ws
+
+
+@router.get("/api/maintenance")
+@handle_json_error
+async def api_maintenance(request: web.Request) -> web.Response:
+    report = await request.config_dict["MAINTENANCE"].report()
+    return api_ok(request, report)
 
 
 @router.get("/api/{post}")
 @handle_json_error
 async def api_get_post(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    post = await fetch_post(db, post_id)
-    return web.json_response(
-        {
-            "status": "ok",
-            "data": {
-                "id": post_id,
-                "owner": post["owner"],
-                "editor": post["editor"],
-                "title": post["title"],
-                "text": post["text"],
-            },
-        }
-    )
+    posts = get_shard(request, post_id).posts
+    version = await posts.version(post_id)
+    if version is not None:
+        resp = not_modified(request, make_etag(version))
+        if resp is not None:
+            return resp
+    post = await posts.get(post_id)
+    return api_ok(request, post_json(post), headers={"ETag": make_etag(post.version)})
 
 
 @router.delete("/api/{post}")
 @handle_json_error
 async def api_del_post(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    async with db.execute("DELETE FROM posts WHERE id = ?", [post_id]) as cursor:
-        if cursor.rowcount == 0:
-            return web.json_response(
-                {"status": "fail", "reason": f"post {post_id} doesn't exist"},
-                status=404,
-            )
-    await db.commit()
-    return web.json_response({"status": "ok", "id": post_id})
+    serializer = request.config_dict["JSON"]
+    if not await remove_post(request, post_id):
+        body = serializer.dumps(
+            {"status": "fail", "reason": f"post {post_id} doesn't exist"}
+        )
+        return api_response(body, status=404)
+    return api_response(serializer.dumps({"status": "ok", "id": int(post_id)}))
 
 
 @router.patch("/api/{post}")
@@ -160,52 +535,27 @@ async def api_del_post(request: web.Request) -> web.Response:
 async def api_update_post(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
     post = await request.json()
-    db = request.config_dict["DB"]
-    fields = {}
-    if "title" in post:
-        fields["title"] = post["title"]
-    if "text" in post:
-        fields["text"] = post["text"]
-    if "editor" in post:
-        fields["editor"] = post["editor"]
-    if fields:
-        field_names = ", ".join(f"{name} = ?" for name in fields)
-        field_values = list(fields.values())
-        await db.execute(
-            f"UPDATE posts SET {field_names} WHERE id = ?", field_values + [post_id]
-        )
-        await db.commit()
-    new_post = await fetch_post(db, post_id)
-    return web.json_response(
-        {
-            "status": "ok",
-            "data": {
-                "id": new_post["id"],
-                "owner": new_post["owner"],
-                "editor": new_post["editor"],
-                "title": new_post["title"],
-                "text": new_post["text"],
-            },
-        }
-    )
+    data = await update_post(request, post_id, post)
+    return api_ok(request, data)
+
+
+@router.get("/ready")
+async def ready(request: web.Request) -> web.Response:
+    """Readiness probe, fails until the warm-up is finished"""
+    if not request.config_dict["READY"].is_set():
+        return api_failed(request, "warming up", status=503)
+    return api_ok(request, {"ready": True})
 
 
 @router.get("/")
 @aiohttp_jinja2.template("index.html")
 async def index(request: web.Request) -> Dict[str, Any]:
-    ret = []
-    db = request.config_dict["DB"]
-    async with db.execute("SELECT id, owner, editor, title FROM posts") as cursor:
-        async for row in cursor:
-            ret.append(
-                {
-                    "id": row["id"],
-                    "owner": row["owner"],
-                    "editor": row["editor"],
-                    "title": row["title"],
-                }
-            )
-    return {"posts": ret}
+    query = parse_list_query(request.query)
+    return {
+        "posts": await gather_posts(request, query),
+        "query": query,
+        "orders": list(LIST_ORDERS),
+    }
 
 
 @router.get("/login")
@@ -240,20 +590,30 @@ async def new_post(request: web.Request) -> Dict[str, Any]:
 @require_login
 @aiohttp_jinja2.template("edit.html")
 async def new_post_apply(request: web.Request) -> Dict[str, Any]:
-    db = request.config_dict["DB"]
-    post = await request.post()
     session = await aiohttp_session.get_session(request)
     owner = session["username"]
-    async with db.execute(
-        "INSERT INTO posts (owner, editor, title, text) VALUES(?, ?, ?, ?)",
-        [owner, owner, post["title"], post["text"]],
-    ) as cursor:
-        post_id = cursor.lastrowid
-    image = post.get("image")
-    if image:
-        img_content = image.file.read()  # type: ignore
-        await apply_image(db, post_id, img_content)
-    await db.commit()
+    async with read_post_form(request) as (post, image):
+        async with new_post_transaction(request) as (shard, post_id):
+            version = await shard.posts.bump_revision()
+            await shard.posts.insert(
+                post_id, owner, post["title"], post["text"], version
+            )
+            orphan = None
+            if image is not None:
+                orphan = await apply_image(shard, post_id, image)
+        if image is not None:
+            request.config_dict["IMAGE_JOBS"].wake()
+        if orphan is not None:
+            await remove_original_image(shard.media_path, orphan)
+    publish_event(
+        request,
+        "create",
+        post_id,
+        version,
+        owner=owner,
+        editor=owner,
+        title=post["title"],
+    )
     raise web.HTTPSeeOther(location=f"/")
 
 
@@ -261,8 +621,7 @@ async def new_post_apply(request: web.Request) -> Dict[str, Any]:
 @aiohttp_jinja2.template("view.html")
 async def view_post(request: web.Request) -> Dict[str, Any]:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    return {"post": await fetch_post(db, post_id)}
+    return {"post": await get_shard(request, post_id).posts.get(post_id)}
 
 
 @router.get("/{post}/edit")
@@ -270,27 +629,18 @@ async def view_post(request: web.Request) -> Dict[str, Any]:
 @aiohttp_jinja2.template("edit.html")
 async def edit_post(request: web.Request) -> Dict[str, Any]:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    return {"post": await fetch_post(db, post_id)}
+    return {"post": await get_shard(request, post_id).posts.get(post_id)}
 
 
 @router.post("/{post}/edit")
 @require_login
 async def edit_post_apply(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    post = await request.post()
-    image = post.get("image")
     session = await aiohttp_session.get_session(request)
     editor = session["username"]
-    await db.execute(
-        f"UPDATE posts SET title = ?, text = ?, editor = ? WHERE id = ?",
-        [post["title"], post["text"], editor, post_id],
-    )
-    if image:
-        img_content = image.file.read()  # type: ignore
-        await apply_image(db, post_id, img_content)
-    await db.commit()
+    async with read_post_form(request) as (post, image):
+        fields = {"title": post["title"], "text": post["text"], "editor": editor}
+        await update_post(request, post_id, fields, image)
     raise web.HTTPSeeOther(location=f"/{post_id}/edit")
 
 
@@ -298,101 +648,518 @@ async def edit_post_apply(request: web.Request) -> web.Response:
 @require_login
 async def delete_post(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    await db.execute("DELETE FROM posts WHERE id = ?", [post_id])
+    await remove_post(request, post_id)
     raise web.HTTPSeeOther(location=f"/")
 
 
 @router.get("/{post}/image")
 async def render_post_image(request: web.Request) -> web.Response:
     post_id = request.match_info["post"]
-    db = request.config_dict["DB"]
-    async with db.execute("SELECT image FROM posts WHERE id = ?", [post_id]) as cursor:
-        row = await cursor.fetchone()
-        if row is None or row["image"] is None:
-            img = PIL.Image.new("RGB", (64, 64), color=0)
-            fp = io.BytesIO()
-            img.save(fp, format="JPEG")
-            content = fp.getvalue()
-        else:
-            content = row["image"]
+    if request.query.keys() & {"w", "h", "fmt"}:
+        return await render_image_variant(request, post_id)
+    content = await get_shard(request, post_id).posts.thumbnail(post_id)
+    if content is None:
+        content = placeholder_image()
     return web.Response(body=content, content_type="image/jpeg")
 
 
-async def apply_image(
-    db: aiosqlite.Connection, post_id: int, img_content: bytes
-) -> None:
-    buf = io.BytesIO(img_content)
-    out_buf = io.BytesIO()
+@functools.lru_cache(maxsize=None)
+def placeholder_image() -> bytes:
+    # Encoded once, JPEG encoding on every request blocked the loop
+    img = PIL.Image.new("RGB", (64, 64), color=0)
+    fp = io.BytesIO()
+    img.save(fp, format="JPEG")
+    return fp.getvalue()
+
+
+async def render_image_variant(request: web.Request, post_id: str) -> web.Response:
+    query = request.query
+    fmt = query.get("fmt", "jpeg")
+    try:
+        width = int(query.get("w", query.get("h", 64)))
+        height = int(query.get("h", width))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Image size should be integer")
+    if width not in IMAGE_SIZES or height not in IMAGE_SIZES:
+        sizes = ", ".join(str(size) for size in sorted(IMAGE_SIZES))
+        raise web.HTTPBadRequest(text=f"Image size should be one of {sizes}")
+    if fmt not in IMAGE_FORMATS:
+        formats = ", ".join(IMAGE_FORMATS)
+        raise web.HTTPBadRequest(text=f"Image format should be one of {formats}")
+    if not post_id.isdigit():
+        raise web.HTTPNotFound()
+    shard = get_shard(request, post_id)
+    try:
+        image_hash = await shard.posts.image_hash(post_id)
+    except RuntimeError:
+        raise web.HTTPNotFound()
+    if image_hash is None:
+        raise web.HTTPNotFound(text="Post has no image")
+    # Keyed by content, posts sharing an image share its variants
+    key = f"{image_hash}-{width}x{height}.{fmt}"
+    original = shard.media_path / image_hash
+    cache = request.config_dict["IMAGE_CACHE"]
+    try:
+        content = await cache.get(
+            key, functools.partial(make_image_variant, original, width, height, fmt)
+        )
+    except FileNotFoundError:
+        raise web.HTTPNotFound(text="Post has no image")
+    return web.Response(body=content, content_type=IMAGE_FORMATS[fmt])
+
+
+def make_image_variant(original: Path, width: int, height: int, fmt: str) -> bytes:
+    """Resize original image to fit into width x height box, blocking"""
+    with PIL.Image.open(original) as img:
+        img.thumbnail((width, height), PIL.Image.LANCZOS)
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format=fmt.upper())
+        return buf.getvalue()
+
+
+@asynccontextmanager
+async def read_post_form(
+    request: web.Request,
+) -> AsyncIterator[Tuple[Dict[str, str], Optional[Upload]]]:
+    """Stream multipart post form without buffering it in memory.
+
+    Yields text fields and the uploaded image.  The image part is written
+    chunk by chunk into a temporary file in the media directory and hashed
+    on the fly, apply_image() moves it into place; otherwise the file is
+    removed on exit.
+    """
+    fields: Dict[str, str] = {}
+    upload: Optional[Upload] = None
+    try:
+        content_length = request.content_length or 0  # None if chunked
+        if content_length > MAX_UPLOAD_SIZE + MAX_FIELD_SIZE:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=MAX_UPLOAD_SIZE, actual_size=content_length
+            )
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if not isinstance(part, aiohttp.BodyPartReader):
+                raise web.HTTPBadRequest(text="Nested multipart is not supported")
+            if part.filename is None:
+                fields[part.name or ""] = await _read_field(part)
+            elif part.name == "image" and part.filename:
+                if upload is not None:
+                    raise web.HTTPBadRequest(text="Only one image is allowed")
+                upload = await _spool_upload(request, part)
+            else:
+                # No file selected in the browser form
+                await part.release()
+        yield fields, upload
+    finally:
+        if upload is not None:
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, upload.path.unlink)
+            except FileNotFoundError:
+                pass  # moved by apply_image()
+
+
+async def _read_field(part: aiohttp.BodyPartReader) -> str:
+    data = bytearray()
+    while True:
+        chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        data.extend(chunk)
+        if len(data) > MAX_FIELD_SIZE:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=MAX_FIELD_SIZE, actual_size=len(data)
+            )
+    charset = part.get_charset(default="utf-8")
+    return data.decode(charset)
+
+
+async def _spool_upload(request: web.Request, part: aiohttp.BodyPartReader) -> Upload:
+    content_type = part.headers.get(aiohttp.hdrs.CONTENT_TYPE, "")
+    if not content_type.startswith("image/"):
+        raise web.HTTPUnsupportedMediaType(text=f"Not an image: {content_type}")
+    declared = part.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+    if declared is not None and int(declared) > MAX_UPLOAD_SIZE:
+        raise web.HTTPRequestEntityTooLarge(
+            max_size=MAX_UPLOAD_SIZE, actual_size=int(declared)
+        )
     loop = asyncio.get_event_loop()
-    img = PIL.Image.open(buf)
-    new_img = await loop.run_in_executor(None, img.resize, (64, 64), PIL.Image.LANCZOS)
-    new_img.save(out_buf, format="JPEG")
-    await db.execute(
-        "UPDATE posts SET image = ? WHERE id = ?", [out_buf.getvalue(), post_id]
+    # File operations run in the executor, a slow disk would block the loop
+    fd, name = await loop.run_in_executor(
+        None,
+        functools.partial(
+            tempfile.mkstemp, prefix=".upload-", dir=request.config_dict["MEDIA_PATH"]
+        ),
     )
+    path = Path(name)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        f = await loop.run_in_executor(None, open, fd, "wb")
+        try:
+            while True:
+                chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise web.HTTPRequestEntityTooLarge(
+                        max_size=MAX_UPLOAD_SIZE, actual_size=size
+                    )
+                digest.update(chunk)
+                await loop.run_in_executor(None, f.write, chunk)
+        finally:
+            await loop.run_in_executor(None, f.close)
+    except BaseException:
+        await loop.run_in_executor(None, path.unlink)
+        raise
+    return Upload(path, digest.hexdigest())
 
 
-async def fetch_post(db: aiosqlite.Connection, post_id: int) -> Dict[str, Any]:
-    async with db.execute(
-        "SELECT owner, editor, title, text, image FROM posts WHERE id = ?", [post_id]
-    ) as cursor:
-        row = await cursor.fetchone()
-        if row is None:
-            raise RuntimeError(f"Post {post_id} doesn't exist")
-        return {
-            "id": post_id,
-            "owner": row["owner"],
-            "editor": row["editor"],
-            "title": row["title"],
-            "text": row["text"],
-            "image": row["image"],
-        }
+async def remove_original_image(media_path: Path, image_hash: str) -> None:
+    loop = asyncio.get_event_loop()
+    path = media_path / image_hash
+    try:
+        await loop.run_in_executor(None, path.unlink)
+    except FileNotFoundError:
+        pass
+
+
+def make_thumbnail(path: Path) -> bytes:
+    """Decode image file and encode 64x64 JPEG thumbnail, blocking"""
+    out_buf = io.BytesIO()
+    with PIL.Image.open(path) as img:
+        new_img = img.resize((64, 64), PIL.Image.LANCZOS)
+    if new_img.mode not in ("RGB", "L"):
+        new_img = new_img.convert("RGB")
+    new_img.save(out_buf, format="JPEG")
+    return out_buf.getvalue()
+
+
+async def apply_image(shard: Shard, post_id: int, upload: Upload) -> Optional[str]:
+    """Attach uploaded image to the post.
+
+    Images are stored once per content hash and reference counted, a known
+    image is reused as is.  A new one is only moved into place, its
+    thumbnail is made by a job queued here, see ImageJobs; the caller
+    should wake the queue after commit.  Return hash of the replaced image
+    if it lost its last reference, the caller should remove its original
+    file after commit.
+    """
+    posts = shard.posts
+    old_hash = await posts.image_hash(post_id)
+    if old_hash == upload.sha256:
+        return None
+    if not await posts.acquire_image(upload.sha256):
+        loop = asyncio.get_event_loop()
+        # The original is kept for on-demand variants, see render_image_variant()
+        original = shard.media_path / upload.sha256
+        await loop.run_in_executor(None, os.replace, upload.path, original)
+        await posts.queue_image(upload.sha256)
+    await posts.set_image(post_id, upload.sha256)
+    if old_hash is not None:
+        return await posts.release_image(old_hash)
+    return None
+
+
+async def connect_db(sqlite_db: Path) -> aiosqlite.Connection:
+    db = await aiosqlite.connect(sqlite_db)
+    try:
+        # Worker processes share the file: writers wait for the lock
+        # instead of failing immediately, WAL lets readers run meanwhile.
+        async with db.execute("PRAGMA busy_timeout = 5000"):
+            pass
+        async with db.execute("PRAGMA journal_mode = WAL"):
+            pass
+    except BaseException:
+        await db.close()
+        raise
+    return db
 
 
 async def init_db(app: web.Application) -> AsyncIterator[None]:
     sqlite_db = app["DB_PATH"]
-    db = await aiosqlite.connect(sqlite_db)
-    db.row_factory = aiosqlite.Row
-    app["DB"] = db
-    yield
-    await db.close()
+    media_path = app["MEDIA_PATH"]
+    shards: List[Shard] = []
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, migrate, sqlite_db)
+        db = await connect_db(sqlite_db)
+        shards.append(Shard(0, db, PostRepository(db), media_path))
+        value = await shards[0].posts.setting("shards")
+        # Files older than sharding have no settings
+        count = int(value) if value is not None else 1
+        for index in range(1, count):
+            path = shard_db_path(sqlite_db, index)
+            if not path.exists():
+                raise RuntimeError(f"Shard {path} is missing")
+            await loop.run_in_executor(None, migrate, path)
+            shard_db = await connect_db(path)
+            shards.append(
+                Shard(
+                    index,
+                    shard_db,
+                    PostRepository(shard_db),
+                    media_path / f"shard{index}",
+                )
+            )
+        app["DB"] = db
+        app["SHARDS"] = shards
+        # Posts of files older than the id sequence keep their ids
+        last = max([await shard.posts.max_post_id() for shard in shards])
+        async with shards[0].posts.transaction():
+            await shards[0].posts.skip_post_ids(last)
+        yield
+    finally:
+        for shard in shards:
+            await shard.db.close()
+
+
+def is_quiet(app: web.Application) -> bool:
+    admission = app["ADMISSION"]
+    lag = admission.lag_monitor.lag
+    return admission.in_flight <= QUIET_IN_FLIGHT and lag < QUIET_LAG
+
+
+async def init_maintenance(app: web.Application) -> AsyncIterator[None]:
+    maintenance = app["MAINTENANCE"]
+    # Own connections, maintenance statements stay out of handlers' transactions
+    for shard in app["SHARDS"]:
+        path = shard_db_path(app["DB_PATH"], shard.number)
+        maintenance.add_db(path, await connect_db(path))
+    maintenance.start()
+    try:
+        yield
+    finally:
+        await maintenance.stop()
+
+
+async def close_events(app: web.Application) -> None:
+    app["EVENTS"].close()
+
+
+async def init_post_index(app: web.Application) -> None:
+    index = app["POST_INDEX"]
+    if index is None:
+        return
+    shards = app["SHARDS"]
+    revisions = await asyncio.gather(*(s.posts.revision() for s in shards))
+    index.load(await _gather_posts(shards), sum(revisions))
+
+
+async def init_image_cache(app: web.Application) -> None:
+    loop = asyncio.get_event_loop()
+    for shard in app["SHARDS"]:
+        await loop.run_in_executor(
+            None, functools.partial(shard.media_path.mkdir, parents=True, exist_ok=True)
+        )
+    await loop.run_in_executor(None, app["IMAGE_CACHE"].load)
+
+
+async def start_image_jobs(app: web.Application) -> None:
+    jobs = app["IMAGE_JOBS"]
+    # Own connections, job transactions don't interleave with handlers' ones
+    for shard in app["SHARDS"]:
+        db = await connect_db(shard_db_path(app["DB_PATH"], shard.number))
+        jobs.add_shard(PostRepository(db), shard.media_path)
+    jobs.start()
+
 
+async def stop_image_jobs(app: web.Application) -> None:
+    await app["IMAGE_JOBS"].stop()
 
-async def init_app(db_path: Path) -> web.Application:
+
+async def start_block_detector(app: web.Application) -> None:
+    detector = app["BLOCK_DETECTOR"]
+    if detector is not None:
+        detector.start()
+
+
+async def stop_block_detector(app: web.Application) -> None:
+    detector = app["BLOCK_DETECTOR"]
+    if detector is not None:
+        detector.stop()
+
+
+async def start_admission(app: web.Application) -> None:
+    app["ADMISSION"].start()
+
+
+async def stop_admission(app: web.Application) -> None:
+    await app["ADMISSION"].stop()
+
+
+async def start_warm_up(app: web.Application) -> None:
+    app["WARM_UP"] = asyncio.ensure_future(warm_up(app))
+
+
+async def stop_warm_up(app: web.Application) -> None:
+    # Wait for it, DB connections are closed next
+    app["WARM_UP"].cancel()
+    try:
+        await app["WARM_UP"]
+    except asyncio.CancelledError:
+        pass
+
+
+async def warm_up(app: web.Application) -> None:
+    """Get caches hot while the server already accepts /ready probes.
+
+    Compile all templates, read DB files into the OS page cache and run
+    hot queries once, which fills SQLite's page cache and the prepared
+    statements cache of every connection.  A failure only means a slower
+    start, the server becomes ready anyway.
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        env = aiohttp_jinja2.get_env(app)
+        for name in env.list_templates():
+            await loop.run_in_executor(None, env.get_template, name)
+        for shard in app["SHARDS"]:
+            path = shard_db_path(app["DB_PATH"], shard.number)
+            await loop.run_in_executor(None, _read_file, path, WARM_UP_READ_SIZE)
+            await shard.posts.revision()
+            posts = await shard.posts.list()
+            if posts:
+                await shard.posts.get(posts[0].id)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        log.exception("Warm-up failed")
+    else:
+        log.info("Warmed up in %.3f sec", loop.time() - start)
+    app["READY"].set()
+
+
+def _read_file(path: Path, size: int) -> None:
+    with path.open("rb") as f:
+        while size > 0 and f.read(min(size, 1024 ** 2)):
+            size -= 1024 ** 2
+
+
+async def init_app(
+    db_path: Path,
+    *,
+    media_path: Optional[Path] = None,
+    image_cache_path: Optional[Path] = None,
+    image_cache_size: int = 256 * 1024 ** 2,
+    post_index: bool = True,
+    serializer: Optional[JSONSerializer] = None,
+    admission: Optional[AdmissionControl] = None,
+    block_threshold: Optional[float] = None,
+) -> web.Application:
     app = web.Application(client_max_size=64 * 1024 ** 2)
     app["DB_PATH"] = db_path
+    # Original uploaded images, named by content hash
+    app["MEDIA_PATH"] = media_path or db_path.parent / "media"
+    app["IMAGE_CACHE"] = VariantCache(
+        image_cache_path or db_path.parent / "image-cache", image_cache_size
+    )
+    # Listing is served from memory, only valid if this process
+    # is the single writer to the DB.
+    app["POST_INDEX"] = PostIndex() if post_index else None
+    # Encodes all API responses, orjson is used when installed
+    app["JSON"] = serializer or make_serializer()
+    app["IMAGE_JOBS"] = ImageJobs(make_thumbnail)
+    app["MAINTENANCE"] = Maintenance(quiet=functools.partial(is_quiet, app))
+    app["EVENTS"] = EventHub()
+    app["EVENTS_HEARTBEAT"] = 15.0
+    app["WS_MAX_IN_FLIGHT"] = 64
+    app["READY"] = asyncio.Event()  # set when warmed up
+    app["ADMISSION"] = admission or AdmissionControl(route_limits=ROUTE_LIMITS)
+    # Debug mode, logs stacks of callbacks blocking the loop that long
+    app["BLOCK_DETECTOR"] = (
+        BlockingDetector(block_threshold) if block_threshold is not None else None
+    )
     app.add_routes(router)
     app.cleanup_ctx.append(init_db)
+    app.cleanup_ctx.append(init_maintenance)
+    app.on_startup.append(init_post_index)
+    app.on_startup.append(init_image_cache)
+    app.on_startup.append(start_image_jobs)
+    app.on_startup.append(start_block_detector)
+    app.on_startup.append(start_admission)
+    app.on_startup.append(start_warm_up)
+    app.on_shutdown.append(stop_warm_up)
+    app.on_shutdown.append(stop_image_jobs)
+    app.on_shutdown.append(stop_admission)
+    app.on_cleanup.append(stop_block_detector)
+    app.on_shutdown.append(close_events)
     aiohttp_session.setup(app, aiohttp_session.SimpleCookieStorage())
     aiohttp_jinja2.setup(
         app,
         loader=jinja2.FileSystemLoader(str(Path(__file__).parent / "templates")),
         context_processors=[username_ctx_processor],
     )
+    app.middlewares.append(track_route)
+    # Shed load before any other work is done for a request
+    app.middlewares.append(admission_middleware)
     app.middlewares.append(error_middleware)
     app.middlewares.append(check_login)
 
     return app
 
 
-def try_make_db(sqlite_db: Path) -> None:
+def shard_db_path(sqlite_db: Path, index: int) -> Path:
+    """Return file of the shard, shard 0 lives in the main DB file"""
+    if index == 0:
+        return sqlite_db
+    return sqlite_db.with_name(f"{sqlite_db.stem}.shard{index}{sqlite_db.suffix}")
+
+
+def try_make_db(sqlite_db: Path, shards: int = 1) -> None:
+    """Create a new DB with posts spread over *shards* files.
+
+    The main file keeps shard 0 and the shards count, the count cannot be
+    changed later since post ids are routed by it.
+    """
     if sqlite_db.exists():
         return
-
-    with sqlite3.connect(sqlite_db) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """CREATE TABLE posts (
-            id INTEGER PRIMARY KEY,
-            title TEXT,
-            text TEXT,
-            owner TEXT,
-            editor TEXT,
-            image BLOB)
-        """
+    if shards < 1:
+        raise ValueError("shards should be positive")
+
+    for index in range(1, shards):
+        path = shard_db_path(sqlite_db, index)
+        if path.exists():
+            raise RuntimeError(f"Stale shard {path} without {sqlite_db}")
+        migrate(path)
+    # The main file appears last, its presence marks a complete DB
+    new_db = sqlite_db.with_name(sqlite_db.name + ".new")
+    if new_db.exists():
+        new_db.unlink()
+    migrate(new_db)
+    with sqlite3.connect(str(new_db)) as conn:
+        conn.execute(
+            "INSERT INTO settings (name, value) VALUES ('shards', ?)", [shards]
         )
-        conn.commit()
+    conn.close()
+    os.replace(new_db, sqlite_db)
+
+
+def convert_db(sqlite_db: Path) -> None:
+    """Upgrade the main file and all shards, switch them to incremental vacuum.
+
+    An offline step for files created before incremental auto-vacuum,
+    see convert_auto_vacuum(); run it once with the server stopped.
+    """
+    convert_auto_vacuum(sqlite_db)
+    migrate(sqlite_db)
+    with sqlite3.connect(str(sqlite_db)) as conn:
+        cur = conn.execute("SELECT value FROM settings WHERE name = 'shards'")
+        row = cur.fetchone()
+    conn.close()
+    # Files older than sharding have no settings
+    count = int(row[0]) if row is not None else 1
+    for index in range(1, count):
+        path = shard_db_path(sqlite_db, index)
+        convert_auto_vacuum(path)
+        migrate(path)
 
 
 def get_db_path() -> Path:
@@ -405,7 +1172,80 @@ def get_db_path() -> Path:
     return here / "db.sqlite3"
 
 
+def _serve(
+    db_path: Path, sock: socket.socket, block_threshold: Optional[float]
+) -> None:
+    # Other workers write to the same DB, an in-memory index would go stale
+    app = init_app(db_path, post_index=False, block_threshold=block_threshold)
+    web.run_app(app, sock=sock)
+
+
+@click.command()
+@click.option("--host", type=str, default="0.0.0.0", show_default=True)
+@click.option("--port", type=int, default=8080, show_default=True)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of worker processes sharing the listening socket",
+)
+@click.option(
+    "--db",
+    "db_file",
+    type=click.Path(dir_okay=False),
+    help="SQLite database file, default is db.sqlite3 in the git root",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of database files to spread posts over, used by a new database",
+)
+@click.option(
+    "--debug-blocking",
+    type=click.IntRange(min=1),
+    metavar="MS",
+    help="Log stacks of callbacks which block the event loop longer than MS",
+)
+@click.option(
+    "--convert-vacuum",
+    is_flag=True,
+    help="Rebuild old database files for incremental vacuum and exit, "
+    "run it with the server stopped",
+)
+def main(
+    host: str,
+    port: int,
+    workers: int,
+    db_file: Optional[str],
+    shards: int,
+    debug_blocking: Optional[int],
+    convert_vacuum: bool,
+) -> None:
+    """Blog server"""
+    db_path = Path(db_file) if db_file is not None else get_db_path()
+    try_make_db(db_path, shards)
+    if convert_vacuum:
+        logging.basicConfig(level=logging.INFO)
+        convert_db(db_path)
+        return
+    block_threshold = debug_blocking / 1000 if debug_blocking is not None else None
+    if workers == 1:
+        if block_threshold is not None:
+            logging.basicConfig(level=logging.INFO)
+        app = init_app(db_path, block_threshold=block_threshold)
+        web.run_app(app, host=host, port=port)
+    else:
+        logging.basicConfig(level=logging.INFO)
+        sock = make_socket(host, port)
+        print(
+            f"======== Running on http://{host}:{port} with {workers} workers ========"
+        )
+        serve = functools.partial(_serve, db_path, sock, block_threshold)
+        Supervisor(serve, workers).run()
+
+
 if __name__ == "__main__":
-    db_path = get_db_path()
-    try_make_db(db_path)
-    web.run_app(init_app(db_path))
+    main()
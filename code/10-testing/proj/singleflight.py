@@ -0,0 +1,44 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+
+_T = TypeVar("_T")
+
+
+class SingleFlight(Generic[_T]):
+    """Coalesce concurrent calls with the same key into a single execution.
+
+    The first caller starts the work, callers arriving while it is in flight
+    wait for the same result instead of repeating it.  The work runs in its
+    own task: a cancelled caller, the first one included, stops waiting
+    while the others still get the result.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, "asyncio.Future[_T]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[_T]]) -> _T:
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        # Cancelling one waiter must not cancel the work shared with others
+        return await asyncio.shield(fut)
+
+    def forget(self, key: Hashable) -> None:
+        """Make the next call with *key* start a new execution.
+
+        Callers already waiting get the result of the current one.  Call it
+        after a write, so later reads don't join a read started before.
+        """
+        self._calls.pop(key, None)
+
+    def _forget(self, key: Hashable, fut: "asyncio.Future[_T]") -> None:
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            fut.exception()  # mark retrieved when every waiter has gone
@@ -0,0 +1,169 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from types import FrameType
+from typing import Callable, List, Optional
+
+
+log = logging.getLogger(__name__)
+
+_HANDLED_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+# A worker that dies sooner than this after start is considered crashlooping,
+# the supervisor backs off before spawning a replacement.
+MIN_WORKER_LIFETIME = 1.0
+MAX_RESPAWN_DELAY = 10.0
+
+
+def make_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """Create a listening socket shared by all worker processes.
+
+    The socket is bound once by the supervisor and inherited by forked workers,
+    the kernel distributes incoming connections between them.  SO_REUSEPORT is
+    set when available so a new supervisor can bind the same port during
+    a deploy while the old one drains.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class _Worker:
+    def __init__(self, process: multiprocessing.process.BaseProcess) -> None:
+        self.process = process
+        self.started = time.monotonic()
+
+
+class Supervisor:
+    """Run *workers* copies of *target* and keep them alive.
+
+    *target* is called in a forked child process and should serve requests
+    until SIGTERM is received.  Signals handled by the supervisor:
+
+    * SIGTERM, SIGINT -- graceful shutdown of all workers
+    * SIGHUP -- graceful rolling restart, one worker at a time
+    """
+
+    def __init__(
+        self,
+        target: Callable[[], None],
+        workers: int,
+        *,
+        shutdown_timeout: float = 60.0,
+        poll_interval: float = 0.2,
+    ) -> None:
+        if workers < 1:
+            raise ValueError("workers should be positive")
+        self._target = target
+        self._workers_count = workers
+        self._shutdown_timeout = shutdown_timeout
+        self._poll_interval = poll_interval
+        self._ctx = multiprocessing.get_context("fork")
+        self._workers: List[_Worker] = []
+        self._stopping = False
+        self._restart_requested = False
+        self._respawn_delay = 0.0
+
+    def _run_worker(self) -> None:
+        # Drop handlers inherited from the supervisor, the worker's event loop
+        # installs its own SIGINT/SIGTERM handlers for graceful shutdown.
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _HANDLED_SIGNALS)
+        self._target()
+
+    def _spawn(self) -> _Worker:
+        process = self._ctx.Process(target=self._run_worker, daemon=False)
+        # Signals are blocked until the child resets the supervisor's handlers,
+        # otherwise an early SIGTERM would be swallowed by the inherited one.
+        signal.pthread_sigmask(signal.SIG_BLOCK, _HANDLED_SIGNALS)
+        try:
+            process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _HANDLED_SIGNALS)
+        log.info("Started worker %s", process.pid)
+        return _Worker(process)
+
+    def _stop_worker(self, worker: _Worker) -> None:
+        if worker.process.is_alive():
+            worker.process.terminate()
+        self._join_worker(worker)
+
+    def _join_worker(self, worker: _Worker) -> None:
+        # A repeated SIGTERM would interrupt the worker's graceful shutdown,
+        # so the signal is sent once and then we only wait.
+        process = worker.process
+        process.join(self._shutdown_timeout)
+        if process.is_alive():
+            log.warning("Worker %s did not stop in time, killing", process.pid)
+            process.kill()
+            process.join()
+
+    def _on_stop(self, signum: int, frame: Optional[FrameType]) -> None:
+        self._stopping = True
+
+    def _on_restart(self, signum: int, frame: Optional[FrameType]) -> None:
+        self._restart_requested = True
+
+    def _rolling_restart(self) -> None:
+        log.info("Restarting workers")
+        for i, old in enumerate(list(self._workers)):
+            if self._stopping:
+                return
+            # Start the replacement first so serving capacity never drops.
+            self._workers[i] = self._spawn()
+            self._stop_worker(old)
+
+    def _reap(self) -> None:
+        now = time.monotonic()
+        for i, worker in enumerate(self._workers):
+            if worker.process.is_alive():
+                continue
+            lifetime = now - worker.started
+            log.warning(
+                "Worker %s exited with code %s",
+                worker.process.pid,
+                worker.process.exitcode,
+            )
+            if lifetime < MIN_WORKER_LIFETIME:
+                self._respawn_delay = min(
+                    max(self._respawn_delay * 2, self._poll_interval),
+                    MAX_RESPAWN_DELAY,
+                )
+                time.sleep(self._respawn_delay)
+            else:
+                self._respawn_delay = 0.0
+            if self._stopping:
+                return
+            self._workers[i] = self._spawn()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        log.info("Supervisor %s starting %d workers", os.getpid(), self._workers_count)
+        try:
+            self._workers = [self._spawn() for _ in range(self._workers_count)]
+            while not self._stopping:
+                if self._restart_requested:
+                    self._restart_requested = False
+                    self._rolling_restart()
+                self._reap()
+                time.sleep(self._poll_interval)
+        finally:
+            for worker in self._workers:
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self._workers:
+                self._join_worker(worker)
+            log.info("Supervisor %s stopped", os.getpid())
@@ -1,11 +1,31 @@
 from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Optional
 
 import aiosqlite
 import pytest
 
+from proj.blocking import BlockingDetector
 from proj.server import try_make_db
 
 
+# Async tests fail if the code under test blocks the loop that long
+BLOCK_THRESHOLD = 0.25
+
+
+@pytest.fixture(autouse=True)
+def block_detector(request: Any) -> Iterator[Optional[BlockingDetector]]:
+    if "loop" not in request.fixturenames:
+        yield None
+        return
+    loop = request.getfixturevalue("loop")
+    detector = BlockingDetector(BLOCK_THRESHOLD)
+    detector.start(loop)
+    yield detector
+    detector.stop()
+    if detector.stalls:
+        pytest.fail(detector.report(), pytrace=False)
+
+
 @pytest.fixture
 def db_path(tmp_path: Path) -> Path:
     path = tmp_path / "test_sqlite.db"
@@ -14,7 +34,7 @@ def db_path(tmp_path: Path) -> Path:
 
 
 @pytest.fixture
-async def db(db_path: Path) -> aiosqlite.Connection:
+async def db(db_path: Path) -> AsyncIterator[aiosqlite.Connection]:
     conn = await aiosqlite.connect(db_path)
     conn.row_factory = aiosqlite.Row
     yield conn
@@ -0,0 +1,76 @@
+import asyncio
+from pathlib import Path
+from typing import Any
+
+from proj.admission import AdmissionControl, TokenBucket
+from proj.server import init_app
+
+
+def test_token_bucket() -> None:
+    bucket = TokenBucket(rate=2, burst=2, now=0)
+    assert bucket.take(0) == 0
+    assert bucket.take(0) == 0
+    assert bucket.take(0) == 0.5
+    assert bucket.take(0.5) == 0
+    assert not bucket.full(0.5)
+    assert bucket.full(1.5)
+
+
+async def test_user_rate_limit(aiohttp_client: Any, db_path: Path) -> None:
+    admission = AdmissionControl(user_rate=0.5, user_burst=2)
+    app = await init_app(db_path, admission=admission)
+    client = await aiohttp_client(app)
+    resp = await client.post("/login", data={"login": "user"}, allow_redirects=False)
+    assert resp.status == 303
+    for i in range(2):
+        resp = await client.get("/api")
+        assert resp.status == 200
+    resp = await client.get("/api")
+    assert resp.status == 429
+    assert resp.headers["Retry-After"] == "2"
+    # Anonymous clients are not limited by the user's bucket
+    client.session.cookie_jar.clear()
+    resp = await client.get("/api")
+    assert resp.status == 200
+    assert admission.rejected["rate"] == 1
+
+
+async def test_anonymous_clients_share_address(
+    aiohttp_client: Any, db_path: Path
+) -> None:
+    admission = AdmissionControl(user_rate=0.5, user_burst=2)
+    app = await init_app(db_path, admission=admission)
+    clients = [await aiohttp_client(app) for i in range(5)]
+    resps = await asyncio.gather(
+        *(client.get("/api") for client in clients for i in range(4))
+    )
+    assert [resp.status for resp in resps] == [200] * 20
+    assert admission.rejected["rate"] == 0
+
+
+async def test_route_limit(aiohttp_client: Any, db_path: Path) -> None:
+    admission = AdmissionControl(route_limits={"GET /api/{post}": 0})
+    app = await init_app(db_path, admission=admission)
+    client = await aiohttp_client(app)
+    resp = await client.get("/api/1")
+    assert resp.status == 503
+    assert resp.headers["Retry-After"] == "1"
+    resp = await client.get("/api")
+    assert resp.status == 200
+    assert admission.rejected["route"] == 1
+    assert admission.in_flight == 0
+
+
+async def test_shed_on_loop_lag(aiohttp_client: Any, db_path: Path) -> None:
+    admission = AdmissionControl(max_lag=0.5)
+    app = await init_app(db_path, admission=admission)
+    client = await aiohttp_client(app)
+    admission.lag_monitor.lag = 100.0
+    resp = await client.get("/api")
+    assert resp.status == 503
+    assert int(resp.headers["Retry-After"]) > 1
+    # Probes are never shed
+    resp = await client.get("/ready")
+    assert resp.status in (200, 503)
+    assert await resp.text() != "Server is overloaded"
+    assert admission.rejected["lag"] == 1
@@ -0,0 +1,46 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Any
+
+from aiohttp import web
+
+from proj.blocking import BlockingDetector
+from proj.server import init_app, placeholder_image
+
+
+async def test_reports_blocking_handler(
+    aiohttp_client: Any, db_path: Path, block_detector: BlockingDetector
+) -> None:
+    async def blocking(request: web.Request) -> web.Response:
+        time.sleep(0.5)
+        return web.Response(text="done")
+
+    app = await init_app(db_path, block_threshold=0.1)
+    app.router.add_get("/block/now", blocking)
+    client = await aiohttp_client(app)
+    resp = await client.get("/block/now")
+    assert resp.status == 200
+    await asyncio.sleep(0.1)
+
+    [stall] = app["BLOCK_DETECTOR"].stalls
+    assert stall.route == "GET /block/now"
+    assert "time.sleep(0.5)" in stall.stack
+    assert stall.duration >= 0.4
+    assert "Event loop was blocked for" in app["BLOCK_DETECTOR"].report()
+    # The test-wide detector caught it too, it would fail the test
+    assert block_detector.stalls
+    block_detector.stalls.clear()
+
+
+async def test_idle_loop_is_not_blocked(loop: asyncio.AbstractEventLoop) -> None:
+    detector = BlockingDetector(0.05)
+    detector.start(loop)
+    await asyncio.sleep(0.2)
+    detector.stop()
+    assert detector.stalls == []
+
+
+def test_placeholder_image_is_cached() -> None:
+    assert placeholder_image() is placeholder_image()
+    assert placeholder_image().startswith(b"\xff\xd8")
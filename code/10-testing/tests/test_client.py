@@ -1,11 +1,21 @@
+import asyncio
+import functools
+import io
+import json
+import os
+import threading
 from pathlib import Path
-from typing import Any, AsyncIterator
+from typing import Any, AsyncIterator, Awaitable, Callable
 
+import aiohttp
 import aiosqlite
 import pytest
+from aiohttp import web
 from aiohttp.test_utils import TestServer as _TestServer
+from click.testing import CliRunner
 
-from proj.client import Client
+from proj.cache import HTTPCache
+from proj.client import Client, main, run_batch
 from proj.server import init_app
 
 
@@ -32,3 +42,323 @@ async def test_get_post(client: Client, db: aiosqlite.Connection) -> None:
         assert record["text"] == "test text"
         assert record["owner"] == "test_user"
         assert record["editor"] == "test_user"
+
+
+async def test_get_post_revalidates(client: Client) -> None:
+    post = await client.create("test title", "test text")
+    first = await client.get(post.id)
+    assert first.title == "test title"
+    # Served from the validated copy after 304 Not Modified
+    assert await client.get(post.id) == first
+
+    await client.update(post.id, title="new title")
+    updated = await client.get(post.id)
+    assert updated.title == "new title"
+    assert updated.text == "test text"
+
+
+async def test_persistent_cache(
+    server: _TestServer, db: aiosqlite.Connection, tmp_path: Path
+) -> None:
+    async with HTTPCache(tmp_path / "cache.db") as cache:
+        async with Client(server.make_url("/"), "test_user", cache=cache) as client:
+            post = await client.create("test title", "test text")
+            assert (await client.get(post.id)).title == "test title"
+            assert len(await client.list()) == 1
+
+    # Changed behind the client's back, the fresh copy is used without network
+    await db.execute("UPDATE posts SET title = 'changed' WHERE id = ?", [post.id])
+    await db.commit()
+    async with HTTPCache(tmp_path / "cache.db") as cache:
+        async with Client(server.make_url("/"), "test_user", cache=cache) as client:
+            assert (await client.get(post.id)).title == "test title"
+            # Own writes invalidate cached post and listings
+            await client.update(post.id, text="new text")
+            assert (await client.get(post.id)).title == "changed"
+            await client.delete(post.id)
+            assert await client.list() == []
+
+
+async def test_cache_revalidates_stale(server: _TestServer, tmp_path: Path) -> None:
+    async with HTTPCache(tmp_path / "cache.db", fresh_for=0) as cache:
+        async with Client(server.make_url("/"), "test_user", cache=cache) as client:
+            post = await client.create("test title", "test text")
+            first = await client.get(post.id)
+            entry = await cache.get(str(server.make_url(f"/api/{post.id}")))
+            assert entry is not None and not entry.fresh
+            assert await client.get(post.id) == first
+
+
+async def test_cache_evicts_by_size(tmp_path: Path) -> None:
+    async with HTTPCache(tmp_path / "cache.db", max_size=100) as cache:
+        await cache.put("http://example.com/1", '"1"', b"x" * 60)
+        await cache.get("http://example.com/1")
+        await cache.put("http://example.com/2", '"2"', b"x" * 60)
+        assert await cache.get("http://example.com/1") is None
+        assert await cache.get("http://example.com/2") is not None
+
+
+async def test_cache_replace_keeps_size(tmp_path: Path) -> None:
+    async with HTTPCache(tmp_path / "cache.db", max_size=100) as cache:
+        await cache.put("http://example.com/1", '"1"', b"x" * 60)
+        await cache.put("http://example.com/1", '"2"', b"x" * 50)
+        assert cache.size == 50
+        await cache.put("http://example.com/2", '"1"', b"x" * 40)
+        assert cache.size == 90
+        assert await cache.get("http://example.com/1") is not None
+        await cache.invalidate("http://example.com/", prefix=True)
+        assert cache.size == 0
+
+
+async def test_cache_hits_written_in_batches(tmp_path: Path) -> None:
+    async with HTTPCache(tmp_path / "cache.db") as cache:
+        await cache.put("http://example.com/1", '"1"', b"body")
+        changes = cache.db.total_changes
+        for i in range(10):
+            assert await cache.get("http://example.com/1") is not None
+        assert cache.db.total_changes == changes
+        async with cache.db.execute("SELECT used FROM responses") as cursor:
+            stored = (await cursor.fetchone())[0]
+    # Written on close
+    async with HTTPCache(tmp_path / "cache.db") as cache:
+        async with cache.db.execute("SELECT used FROM responses") as cursor:
+            assert (await cursor.fetchone())[0] > stored
+
+
+async def test_retry_on_overload(aiohttp_server: Any, db_path: Path) -> None:
+    failures = 2
+
+    @web.middleware
+    async def overloaded(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        nonlocal failures
+        if request.method == "GET" and failures:
+            failures -= 1
+            raise web.HTTPServiceUnavailable()
+        return await handler(request)
+
+    app = await init_app(db_path)
+    app.middlewares.append(overloaded)
+    server = await aiohttp_server(app)
+    async with Client(
+        server.make_url("/"), "test_user", retries=2, backoff=0.01
+    ) as client:
+        post = await client.create("test title", "test text")
+        assert (await client.get(post.id)).title == "test title"
+        assert client.stats.retries == 2
+
+
+async def test_hedged_get(aiohttp_server: Any, db_path: Path) -> None:
+    stall = False
+
+    @web.middleware
+    async def slow_once(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        nonlocal stall
+        if stall:
+            stall = False
+            await asyncio.sleep(10)
+        return await handler(request)
+
+    app = await init_app(db_path)
+    app.middlewares.append(slow_once)
+    server = await aiohttp_server(app)
+    async with Client(server.make_url("/"), "test_user", hedge=True) as client:
+        post = await client.create("test title", "test text")
+        for _ in range(client.HEDGE_MIN_SAMPLES):
+            await client.get(post.id)
+        assert client.stats.hedges == 0
+
+        stall = True
+        assert (await client.get(post.id)).title == "test title"
+        assert client.stats.hedges == 1
+        assert client.stats.hedges_won == 1
+
+
+async def test_batch(client: Client) -> None:
+    commands = io.StringIO(
+        "create --title 'first post' --text text\n"
+        "create --title second --text text\n"
+        "\n"
+        "# comments are skipped\n"
+        "update 1 --title 'new title'\n"
+        "get 2\n"
+        "delete 2\n"
+        "list\n"
+        "get 100\n"
+        "frobnicate\n"
+    )
+    out = io.StringIO()
+    assert await run_batch(client, commands, out, parallel=1) == 2
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [result["line"] for result in results] == [1, 2, 5, 6, 7, 8, 9, 10]
+    assert results[0]["result"]["title"] == "first post"
+    assert results[2]["result"]["title"] == "new title"
+    assert results[3]["result"]["title"] == "second"
+    assert results[4]["result"] is None
+    assert [post["title"] for post in results[5]["result"]] == ["new title"]
+    assert "error" in results[6]
+    assert results[7]["error"] == "Unknown command 'frobnicate'"
+
+
+async def test_batch_keeps_order(client: Client) -> None:
+    commands = [f"create --title 'post {i}' --text text" for i in range(50)]
+    out = io.StringIO()
+    assert await run_batch(client, commands, out, parallel=8) == 0
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [result["result"]["title"] for result in results] == [
+        f"post {i}" for i in range(50)
+    ]
+
+
+async def test_batch_runs_while_reading_input(client: Client) -> None:
+    read_fd, write_fd = os.pipe()
+    commands = open(read_fd)
+    feed = open(write_fd, "w")
+    # Ends the input anyway if the loop got blocked on reading it
+    timer = threading.Timer(5, feed.close)
+    timer.start()
+    try:
+        feed.write("create --title first --text text\n")
+        feed.flush()
+        out = io.StringIO()
+        batch = asyncio.ensure_future(run_batch(client, commands, out))
+        # The first command runs while the input is still open
+        while not await client.list():
+            await asyncio.sleep(0.01)
+        feed.write("get 100\n")
+        feed.close()
+        assert await batch == 1
+    finally:
+        timer.cancel()
+        feed.close()
+        commands.close()
+    assert len(out.getvalue().splitlines()) == 2
+
+
+async def test_batch_exit_code(server: _TestServer) -> None:
+    loop = asyncio.get_event_loop()
+    runner = CliRunner()
+    args = ["--base-url", str(server.make_url("/")), "batch"]
+    # The command runs its own event loop, in a thread
+    invoke = functools.partial(runner.invoke, main, args)
+    result = await loop.run_in_executor(
+        None, functools.partial(invoke, input="create --title a --text b\n")
+    )
+    assert result.exit_code == 0, result.output
+    result = await loop.run_in_executor(
+        None, functools.partial(invoke, input="get 1\nget 100\nget 101\n")
+    )
+    assert result.exit_code == 1
+    results = [line for line in result.output.splitlines() if line.startswith("{")]
+    assert len(results) == 3
+    assert "2 commands failed" in result.output
+
+
+async def test_watch(client: Client, server: _TestServer) -> None:
+    hub = server.app["EVENTS"]
+    events = client.watch()
+    first = asyncio.ensure_future(events.__anext__())
+    while not len(hub):
+        await asyncio.sleep(0.01)
+
+    post = await client.create("test title", "test text")
+    event = await first
+    assert event.type == "create"
+    assert event.post_id == post.id
+    assert event.data == {
+        "owner": "test_user",
+        "editor": "test_user",
+        "title": "test title",
+    }
+
+    await client.delete(post.id)
+    event = await events.__anext__()
+    assert event.type == "delete"
+    assert event.post_id == post.id
+    await events.aclose()  # type: ignore
+
+
+async def test_ws_transport_pipelining(server: _TestServer) -> None:
+    async with Client(server.make_url("/"), "test_user", transport="ws") as client:
+        posts = await asyncio.gather(
+            *(client.create(f"title {i}", f"text {i}") for i in range(20))
+        )
+        assert [post.title for post in posts] == [f"title {i}" for i in range(20)]
+
+        post = await client.get(posts[0].id)
+        assert post == posts[0]
+
+        post = await client.update(post.id, title="new title")
+        assert post.title == "new title"
+        assert post.editor == "test_user"
+
+        await asyncio.gather(*(client.delete(post.id) for post in posts[1:]))
+        assert [post.id for post in await client.list()] == [posts[0].id]
+
+        with pytest.raises(RuntimeError, match="doesn't exist"):
+            await client.get(posts[1].id)
+
+
+async def test_ws_rejects_bad_frames(server: _TestServer) -> None:
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(server.make_url("/api/ws")) as ws:
+            for frame in ["[1, 2]", "42", '"op"', "null", "{"]:
+                await ws.send_str(frame)
+                reply = await ws.receive_json(timeout=5)
+                assert reply["status"] == "failed"
+            # The connection still serves requests
+            await ws.send_json({"id": 1, "op": "list"})
+            assert await ws.receive_json(timeout=5) == {
+                "id": 1,
+                "status": "ok",
+                "data": [],
+            }
+
+
+async def test_update_same_over_http_and_ws(server: _TestServer) -> None:
+    hub = server.app["EVENTS"]
+    edit = {"title": "new title", "editor": "bob"}
+    async with aiohttp.ClientSession() as session:
+        resp = await session.post(
+            server.make_url("/api"), json={"title": "t", "text": "x", "owner": "ann"}
+        )
+        post_id = (await resp.json())["data"]["id"]
+        with hub.subscribe() as events:
+            resp = await session.patch(server.make_url(f"/api/{post_id}"), json=edit)
+            patched = (await resp.json())["data"]
+            async with session.ws_connect(server.make_url("/api/ws")) as ws:
+                args = {"post_id": post_id, **edit}
+                await ws.send_json({"id": 1, "op": "update", "args": args})
+                updated = (await ws.receive_json(timeout=5))["data"]
+            frames = [await events.get(), await events.get()]
+        resp = await session.get(server.make_url(f"/api/{post_id}"))
+        etag = resp.headers["ETag"]
+
+    assert patched == updated == {
+        "id": post_id,
+        "owner": "ann",
+        "editor": "bob",
+        "title": "new title",
+        "text": "x",
+    }
+    payloads = []
+    for frame in frames:
+        assert frame is not None
+        data = frame.decode().splitlines()[2]
+        payloads.append(json.loads(data[len("data: ") :]))
+    # Each event carries the version of its own edit
+    assert etag == f'"{payloads[1]["version"]}"'
+    assert payloads[0].pop("version") + 1 == payloads[1].pop("version")
+    assert payloads[0] == payloads[1] == {
+        "id": post_id,
+        "owner": "ann",
+        "editor": "bob",
+        "title": "new title",
+    }
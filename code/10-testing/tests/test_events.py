@@ -0,0 +1,32 @@
+import json
+
+from proj.events import EventHub
+
+
+async def test_publish_fan_out() -> None:
+    hub = EventHub()
+    with hub.subscribe() as sub1, hub.subscribe() as sub2:
+        hub.publish("create", {"id": 1, "version": 5, "title": "title"})
+        for sub in (sub1, sub2):
+            frame = await sub.get()
+            assert frame is not None
+            lines = frame.decode().splitlines()
+            assert lines[0] == "id: 5"
+            assert lines[1] == "event: create"
+            assert json.loads(lines[2][len("data: ") :]) == {
+                "id": 1,
+                "version": 5,
+                "title": "title",
+            }
+    assert len(hub) == 0
+
+
+async def test_slow_consumer_disconnected() -> None:
+    hub = EventHub(queue_size=2)
+    with hub.subscribe() as slow, hub.subscribe() as fast:
+        for i in range(3):
+            hub.publish("delete", {"id": i, "version": i})
+            assert await fast.get() is not None
+        assert slow.overflowed
+        assert await slow.get() is None
+        assert len(hub) == 1
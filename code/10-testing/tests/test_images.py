@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import io
+from pathlib import Path
+from typing import Any, List
+
+import aiohttp
+import aiosqlite
+import PIL.Image
+import pytest
+from aiohttp.test_utils import TestClient as _TestClient
+
+from proj.imagecache import VariantCache
+from proj.server import init_app
+
+
+def make_png(width: int, height: int) -> bytes:
+    buf = io.BytesIO()
+    PIL.Image.new("RGB", (width, height), color=(255, 0, 0)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+async def client(aiohttp_client: Any, db_path: Path) -> _TestClient:
+    app = await init_app(db_path)
+    client = await aiohttp_client(app)
+    resp = await client.post("/login", data={"login": "test_user"})
+    assert resp.status == 200
+    return client
+
+
+def post_form(content: bytes) -> aiohttp.FormData:
+    data = aiohttp.FormData()
+    data.add_field("title", "title")
+    data.add_field("text", "text")
+    data.add_field("image", content, filename="image.png", content_type="image/png")
+    return data
+
+
+async def upload(client: _TestClient, content: bytes) -> None:
+    resp = await client.post("/new", data=post_form(content))
+    assert resp.status == 200, await resp.text()
+
+
+async def test_image_variant(client: _TestClient) -> None:
+    await upload(client, make_png(300, 200))
+
+    resp = await client.get("/1/image?w=128&fmt=png")
+    assert resp.status == 200
+    assert resp.content_type == "image/png"
+    img = PIL.Image.open(io.BytesIO(await resp.read()))
+    assert img.size == (128, 85)
+
+    cache = client.server.app["IMAGE_CACHE"]
+    assert len(cache) == 1
+    resp = await client.get("/1/image?w=128&fmt=png")
+    assert resp.status == 200
+    assert len(cache) == 1
+
+    # Legacy thumbnail is still available
+    resp = await client.get("/1/image")
+    assert resp.status == 200
+    assert PIL.Image.open(io.BytesIO(await resp.read())).size == (64, 64)
+
+
+async def test_image_variant_not_allowed(client: _TestClient) -> None:
+    await upload(client, make_png(300, 200))
+    resp = await client.get("/1/image?w=100")
+    assert resp.status == 400
+    resp = await client.get("/1/image?w=128&fmt=gif")
+    assert resp.status == 400
+    resp = await client.get("/2/image?w=128")
+    assert resp.status == 404
+
+
+async def test_cache_single_flight(tmp_path: Path) -> None:
+    cache = VariantCache(tmp_path, 1024)
+    cache.load()
+    calls: List[str] = []
+
+    def factory() -> bytes:
+        calls.append("call")
+        return b"x" * 100
+
+    results = await asyncio.gather(*(cache.get("key", factory) for _ in range(10)))
+    assert results == [b"x" * 100] * 10
+    assert calls == ["call"]
+    assert (tmp_path / "key").read_bytes() == b"x" * 100
+
+
+async def test_cache_lru_eviction(tmp_path: Path) -> None:
+    cache = VariantCache(tmp_path, 250)
+    cache.load()
+    await cache.get("a", lambda: b"a" * 100)
+    await cache.get("b", lambda: b"b" * 100)
+    await cache.get("a", lambda: b"unused")
+    await cache.get("c", lambda: b"c" * 100)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.size == 200
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "c"]
+
+    reloaded = VariantCache(tmp_path, 250)
+    reloaded.load()
+    assert reloaded.size == 200
+
+
+async def test_cache_bound_is_shared_by_processes(tmp_path: Path) -> None:
+    # Worker processes have their own index over one directory
+    first = VariantCache(tmp_path, 250)
+    first.load()
+    second = VariantCache(tmp_path, 250)
+    second.load()
+    await first.get("a", lambda: b"a" * 100)
+    await second.get("b", lambda: b"b" * 100)
+    await first.get("a", lambda: b"unused")
+    await second.get("c", lambda: b"c" * 100)
+    # The hit of the other process keeps "a", the total stays in the bound
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "c"]
+    assert second.size == 200
+
+
+async def test_upload_rejects_non_image(client: _TestClient) -> None:
+    data = aiohttp.FormData()
+    data.add_field("title", "title")
+    data.add_field("text", "text")
+    data.add_field("image", b"text", filename="a.txt", content_type="text/plain")
+    resp = await client.post("/new", data=data)
+    assert resp.status == 415
+    media_path = client.server.app["MEDIA_PATH"]
+    assert list(media_path.iterdir()) == []
+    resp = await client.get("/api")
+    assert (await resp.json())["data"] == []
+
+
+async def test_upload_chunked(client: _TestClient, monkeypatch: Any) -> None:
+    content = make_png(300, 200)
+    # No Content-Length, the size is only known while spooling
+    resp = await client.post(
+        "/new", data=post_form(content), chunked=True, allow_redirects=False
+    )
+    assert resp.status == 303, await resp.text()
+    media_path = client.server.app["MEDIA_PATH"]
+    assert [path.name for path in media_path.iterdir()] == [
+        hashlib.sha256(content).hexdigest()
+    ]
+
+    monkeypatch.setattr("proj.server.MAX_UPLOAD_SIZE", len(content) - 1)
+    resp = await client.post(
+        "/new", data=post_form(content), chunked=True, allow_redirects=False
+    )
+    assert resp.status == 413
+    assert len(list(media_path.iterdir())) == 1
+
+
+async def test_upload_without_image(client: _TestClient) -> None:
+    data = aiohttp.FormData()
+    data.add_field("title", "title")
+    data.add_field("text", "text")
+    data.add_field("image", b"", filename="", content_type="application/octet-stream")
+    resp = await client.post("/new", data=data)
+    assert resp.status == 200, await resp.text()
+    resp = await client.get("/1/image?w=128")
+    assert resp.status == 404
+
+
+async def test_upload_deduplicated(
+    client: _TestClient, db: aiosqlite.Connection
+) -> None:
+    content = make_png(300, 200)
+    await upload(client, content)
+    await upload(client, content)
+    jobs = client.server.app["IMAGE_JOBS"]
+    await jobs.join()
+    assert jobs.done == 1
+
+    media_path = client.server.app["MEDIA_PATH"]
+    image_hash = hashlib.sha256(content).hexdigest()
+    assert [path.name for path in media_path.iterdir()] == [image_hash]
+    async with db.execute("SELECT hash, refs FROM images") as cursor:
+        assert [tuple(row) for row in await cursor.fetchall()] == [(image_hash, 2)]
+
+    resp = await client.delete("/api/1")
+    assert resp.status == 200
+    resp = await client.get("/2/image?w=128")
+    assert resp.status == 200
+    assert [path.name for path in media_path.iterdir()] == [image_hash]
+
+    resp = await client.delete("/api/2")
+    assert resp.status == 200
+    assert list(media_path.iterdir()) == []
+    async with db.execute("SELECT count(*) FROM images") as cursor:
+        assert (await cursor.fetchone())[0] == 0
@@ -0,0 +1,139 @@
+import asyncio
+import io
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+import aiohttp
+import aiosqlite
+import PIL.Image
+from aiohttp.test_utils import TestClient as _TestClient
+
+from proj.jobs import ImageJobs
+from proj.server import init_app, make_thumbnail, placeholder_image
+
+
+def make_png() -> bytes:
+    buf = io.BytesIO()
+    PIL.Image.new("RGB", (300, 200), color=(255, 0, 0)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+async def make_client(
+    aiohttp_client: Any, db_path: Path, jobs: ImageJobs
+) -> _TestClient:
+    app = await init_app(db_path)
+    app["IMAGE_JOBS"] = jobs
+    client = await aiohttp_client(app)
+    resp = await client.post("/login", data={"login": "test_user"})
+    assert resp.status == 200
+    return client
+
+
+async def upload(client: _TestClient) -> None:
+    data = aiohttp.FormData()
+    data.add_field("title", "title")
+    data.add_field("text", "text")
+    data.add_field("image", make_png(), filename="a.png", content_type="image/png")
+    resp = await client.post("/new", data=data)
+    assert resp.status == 200, await resp.text()
+
+
+def gated(gate: threading.Event, started: threading.Event) -> Callable[[Path], bytes]:
+    def process(path: Path) -> bytes:
+        started.set()
+        gate.wait()
+        return make_thumbnail(path)
+
+    return process
+
+
+async def wait_for(event: threading.Event) -> None:
+    # Polling, waiting on the event would block the loop
+    while not event.is_set():
+        await asyncio.sleep(0.01)
+
+
+async def image_row(db: aiosqlite.Connection) -> Any:
+    async with db.execute(
+        "SELECT status, thumbnail IS NOT NULL, attempts, run_at "
+        "FROM images LEFT JOIN image_jobs ON image_hash = hash"
+    ) as cursor:
+        return tuple(await cursor.fetchone())
+
+
+async def test_placeholder_until_done(
+    aiohttp_client: Any, db_path: Path, db: aiosqlite.Connection
+) -> None:
+    gate = threading.Event()
+    started = threading.Event()
+    jobs = ImageJobs(gated(gate, started))
+    client = await make_client(aiohttp_client, db_path, jobs)
+    try:
+        await upload(client)
+        await wait_for(started)
+        resp = await client.get("/1/image")
+        assert resp.status == 200
+        assert await resp.read() == placeholder_image()
+        assert (await image_row(db))[:2] == ("pending", 0)
+    finally:
+        gate.set()
+    await jobs.join()
+
+    assert jobs.done == 1
+    assert await image_row(db) == ("ready", 1, None, None)
+    resp = await client.get("/1/image")
+    assert await resp.read() != placeholder_image()
+
+
+async def test_retry_then_fail(
+    aiohttp_client: Any, db_path: Path, db: aiosqlite.Connection
+) -> None:
+    def broken(path: Path) -> bytes:
+        raise ValueError("cannot decode")
+
+    jobs = ImageJobs(broken, workers=0, backoff=0, max_attempts=2)
+    client = await make_client(aiohttp_client, db_path, jobs)
+    await upload(client)
+    await jobs.join()
+
+    assert (jobs.done, jobs.retried, jobs.failed) == (0, 1, 1)
+    assert await image_row(db) == ("failed", 0, None, None)
+    resp = await client.get("/1/image")
+    assert await resp.read() == placeholder_image()
+
+
+async def test_job_survives_restart(
+    aiohttp_client: Any, db_path: Path, db: aiosqlite.Connection
+) -> None:
+    gate = threading.Event()
+    started = threading.Event()
+    client = await make_client(aiohttp_client, db_path, ImageJobs(gated(gate, started)))
+    try:
+        await upload(client)
+        await wait_for(started)
+        await client.close()
+        # The interrupted claim is given back
+        assert await image_row(db) == ("pending", 0, 0, 0)
+    finally:
+        gate.set()
+
+    app = await init_app(db_path)
+    client = await aiohttp_client(app)
+    await app["IMAGE_JOBS"].join()
+    assert app["IMAGE_JOBS"].done == 1
+    assert await image_row(db) == ("ready", 1, None, None)
+
+
+async def test_deleted_image_drops_job(
+    aiohttp_client: Any, db_path: Path, db: aiosqlite.Connection
+) -> None:
+    jobs = ImageJobs(make_thumbnail, workers=0)
+    client = await make_client(aiohttp_client, db_path, jobs)
+    await upload(client)
+    resp = await client.delete("/api/1")
+    assert resp.status == 200
+    async with db.execute("SELECT COUNT(*) FROM image_jobs") as cursor:
+        assert (await cursor.fetchone())[0] == 0
+    await jobs.join()
+    assert jobs.done == 0
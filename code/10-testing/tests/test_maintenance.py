@@ -0,0 +1,85 @@
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+from proj.maintenance import Maintenance
+from proj.migrations import convert_auto_vacuum
+from proj.server import connect_db, init_app
+
+
+def test_new_db_vacuums_incrementally(db_path: Path) -> None:
+    with sqlite3.connect(str(db_path)) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+async def test_vacuum_returns_free_pages(aiohttp_client: Any, db_path: Path) -> None:
+    app = await init_app(db_path)
+    client = await aiohttp_client(app)
+    for i in range(20):
+        post = {"title": "title", "text": "x" * 100_000, "owner": "user"}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200
+    for i in range(1, 21):
+        resp = await client.delete(f"/api/{i}")
+        assert resp.status == 200
+
+    maintenance = app["MAINTENANCE"]
+    [before] = await maintenance.files()
+    assert before["free"] > 1_000_000
+    await maintenance.run("vacuum")
+    await maintenance.run("checkpoint")
+    [after] = await maintenance.files()
+    assert after["free"] == 0
+    assert after["size"] < before["size"] - 1_000_000
+
+
+async def test_report(aiohttp_client: Any, db_path: Path) -> None:
+    app = await init_app(db_path)
+    client = await aiohttp_client(app)
+    await app["MAINTENANCE"].run("optimize")
+    await app["MAINTENANCE"].run("optimize")
+
+    resp = await client.get("/api/maintenance")
+    assert resp.status == 200
+    data = (await resp.json())["data"]
+    [info] = data["files"]
+    assert info["name"] == db_path.name
+    assert info["size"] > 0
+    assert data["tasks"]["optimize"]["runs"] == 2
+    assert data["tasks"]["optimize"]["last_run"] is not None
+    assert data["tasks"]["checkpoint"]["runs"] == 0
+
+
+async def test_vacuum_after_converting_old_db(tmp_path: Path) -> None:
+    path = tmp_path / "old.sqlite3"
+    with sqlite3.connect(str(path)) as conn:
+        # Schema of the first release, files of that time have auto_vacuum off
+        conn.execute(
+            "CREATE TABLE posts (id INTEGER PRIMARY KEY, title TEXT, text TEXT, "
+            "owner TEXT, editor TEXT, image BLOB)"
+        )
+        conn.executemany(
+            "INSERT INTO posts (text) VALUES (?)", [("x" * 100_000,)] * 20
+        )
+        conn.execute("DELETE FROM posts")
+    conn.close()
+
+    maintenance = Maintenance()
+    maintenance.add_db(path, await connect_db(path))
+    try:
+        # Not in incremental mode, skipped
+        await maintenance.run("vacuum")
+        [before] = await maintenance.files()
+        assert before["free"] > 1_000_000
+    finally:
+        await maintenance.stop()
+
+    assert convert_auto_vacuum(path)
+    maintenance = Maintenance()
+    maintenance.add_db(path, await connect_db(path))
+    try:
+        await maintenance.run("vacuum")
+        [after] = await maintenance.files()
+        assert after["free"] == 0
+    finally:
+        await maintenance.stop()
@@ -0,0 +1,97 @@
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+import pytest
+from click.testing import CliRunner
+
+from proj.migrations import SCHEMA_VERSION, convert_auto_vacuum, migrate
+from proj.server import init_app, main
+
+
+@pytest.fixture
+def old_db_path(tmp_path: Path) -> Path:
+    # Schema of the first release, thumbnails stored inline
+    path = tmp_path / "old.sqlite3"
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute(
+            """CREATE TABLE posts (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            text TEXT,
+            owner TEXT,
+            editor TEXT,
+            image BLOB)
+        """
+        )
+        conn.executemany(
+            "INSERT INTO posts (title, text, owner, editor, image) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                ("first", "text", "alice", "alice", b"thumb"),
+                ("second", "text", "bob", "alice", b"thumb"),
+                ("third", "text", "bob", "bob", None),
+            ],
+        )
+    conn.close()
+    return path
+
+
+def test_migrate_old_db(old_db_path: Path) -> None:
+    assert migrate(old_db_path) == SCHEMA_VERSION
+    assert migrate(old_db_path) == 0
+
+    with sqlite3.connect(str(old_db_path)) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(posts)")}
+        assert "image" not in columns
+        assert conn.execute("SELECT refs FROM images").fetchall() == [(2,)]
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM posts WHERE owner = ? ORDER BY id",
+            ["bob"],
+        ).fetchall()
+        assert "posts_owner" in str(plan)
+    conn.close()
+
+
+def test_convert_auto_vacuum(old_db_path: Path, caplog: Any) -> None:
+    with sqlite3.connect(str(old_db_path)) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+    # Workers only migrate, the rebuild is left to the offline step
+    migrate(old_db_path)
+    assert "not in incremental auto-vacuum mode" in caplog.text
+    with sqlite3.connect(str(old_db_path)) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    conn.close()
+
+    result = CliRunner().invoke(main, ["--db", str(old_db_path), "--convert-vacuum"])
+    assert result.exit_code == 0, result.output
+    with sqlite3.connect(str(old_db_path)) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 3
+    conn.close()
+    assert not convert_auto_vacuum(old_db_path)
+
+
+def test_migrate_newer_db(tmp_path: Path) -> None:
+    path = tmp_path / "new.sqlite3"
+    with sqlite3.connect(str(path)) as conn:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+    conn.close()
+    with pytest.raises(RuntimeError, match="newer than supported"):
+        migrate(path)
+
+
+async def test_serve_migrated_db(aiohttp_client: Any, old_db_path: Path) -> None:
+    client = await aiohttp_client(await init_app(old_db_path))
+
+    resp = await client.get("/api", params={"owner": "bob", "order": "-title"})
+    assert resp.status == 200, await resp.text()
+    data = await resp.json()
+    assert [post["title"] for post in data["data"]] == ["third", "second"]
+
+    resp = await client.get("/1/image")
+    assert resp.status == 200
+    assert await resp.read() == b"thumb"
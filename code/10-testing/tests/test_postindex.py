@@ -0,0 +1,57 @@
+from pathlib import Path
+from typing import Any
+
+import aiosqlite
+from aiohttp.test_utils import TestClient as _TestClient
+
+from proj.postindex import PostIndex
+from proj.repository import PostSummary
+from proj.server import init_app
+
+
+def test_index_ordered_by_id() -> None:
+    index = PostIndex()
+    index.load([PostSummary(2, "a", "a", "two")], 5)
+    index.add(4, "b", "b", "four")
+    index.add(1, "a", "a", "one")
+    index.update(2, editor="b", title="new two")
+    index.remove(4)
+    assert index.revision == 9
+    assert 4 not in index
+    assert index.list() == [
+        PostSummary(id=1, owner="a", editor="a", title="one"),
+        PostSummary(id=2, owner="a", editor="b", title="new two"),
+    ]
+
+
+def test_index_interns_names() -> None:
+    index = PostIndex()
+    owner = "".join(["us", "er"])
+    index.add(1, owner, owner, "title")
+    index.add(2, "user", "user", "title")
+    first, second = index.list()
+    assert first.owner is second.owner
+
+
+async def test_listing_served_from_index(
+    aiohttp_client: Any, db_path: Path, db: aiosqlite.Connection
+) -> None:
+    await db.execute(
+        "INSERT INTO posts (title, text, owner, editor) VALUES (?, ?, ?, ?)",
+        ["loaded", "text", "user", "user"],
+    )
+    await db.commit()
+    client: _TestClient = await aiohttp_client(await init_app(db_path))
+
+    resp = await client.post(
+        "/api", json={"title": "created", "text": "text", "owner": "user"}
+    )
+    assert resp.status == 200
+    # Bypasses the server, not visible until restart
+    await db.execute("DELETE FROM posts WHERE id = 1")
+    await db.commit()
+
+    resp = await client.get("/api")
+    data = await resp.json()
+    assert [post["title"] for post in data["data"]] == ["loaded", "created"]
+    assert resp.headers["ETag"] == '"1"'
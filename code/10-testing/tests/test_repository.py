@@ -0,0 +1,182 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+from typing import Any, AsyncIterator
+
+import aiosqlite
+import pytest
+
+from proj.repository import ListQuery, Post, PostRepository, PostSummary
+from proj.server import connect_db
+
+
+@pytest.fixture
+async def posts(
+    loop: asyncio.AbstractEventLoop, db_path: Path
+) -> AsyncIterator[PostRepository]:
+    db = await connect_db(db_path)
+    yield PostRepository(db)
+    await db.close()
+
+
+async def test_insert_and_get(posts: PostRepository) -> None:
+    version = await posts.bump_revision()
+    post_id = await posts.next_post_id()
+    await posts.insert(post_id, "user", "title", "text", version)
+    await posts.db.commit()
+
+    post = await posts.get(post_id)
+    assert post == Post(post_id, "user", "user", "title", "text", None, version)
+    assert await posts.version(post_id) == version
+    assert await posts.revision() == version
+
+    with pytest.raises(RuntimeError, match="Post 100 doesn't exist"):
+        await posts.get(100)
+    assert await posts.version(100) is None
+
+
+@pytest.mark.skipif(
+    sqlite3.sqlite_version_info < (3, 35, 0), reason="needs UPDATE ... RETURNING"
+)
+async def test_concurrent_bumps_are_distinct(posts: PostRepository) -> None:
+    versions = await asyncio.gather(*(posts.bump_revision() for i in range(10)))
+    assert sorted(versions) == list(range(1, 11))
+
+
+async def test_list_filters_and_orders(posts: PostRepository) -> None:
+    for post_id, (owner, title) in enumerate([("a", "b"), ("b", "c"), ("a", "a")], 1):
+        await posts.insert(post_id, owner, title, "text", 1)
+    assert await posts.update(2, editor="a", version=2)
+    await posts.db.commit()
+
+    assert await posts.list() == [
+        PostSummary(1, "a", "a", "b"),
+        PostSummary(2, "b", "a", "c"),
+        PostSummary(3, "a", "a", "a"),
+    ]
+    query = ListQuery(owner="a", order="title")
+    assert [post.id for post in await posts.list(query)] == [3, 1]
+    query = ListQuery(editor="a", order="-id")
+    assert [post.id for post in await posts.list(query)] == [3, 2, 1]
+    query = ListQuery(owner="b", editor="b")
+    assert await posts.list(query) == []
+
+
+async def test_update_rejects_unknown_fields(posts: PostRepository) -> None:
+    with pytest.raises(ValueError, match="Cannot update owner"):
+        await posts.update(1, owner="other")
+    assert not await posts.update(1, title="missing post")
+
+
+async def test_image_references(
+    posts: PostRepository, db: aiosqlite.Connection
+) -> None:
+    first, second = 1, 2
+    await posts.insert(first, "user", "first", "text", 1)
+    await posts.insert(second, "user", "second", "text", 1)
+    assert not await posts.acquire_image("hash")
+    await posts.queue_image("hash")
+    await posts.set_image(first, "hash")
+    assert await posts.acquire_image("hash")
+    await posts.set_image(second, "hash")
+    await posts.db.commit()
+    assert await posts.thumbnail(second) is None
+
+    job = await posts.claim_image_job(now=0, lease=60)
+    assert job is not None and job.image_hash == "hash"
+    assert await posts.claim_image_job(now=0, lease=60) is None
+    await posts.finish_image_job(job, b"thumbnail")
+    await posts.db.commit()
+
+    assert await posts.image_hash(first) == "hash"
+    assert await posts.thumbnail(second) == b"thumbnail"
+    assert await posts.release_image("hash") is None
+    assert await posts.release_image("hash") == "hash"
+    await posts.db.commit()
+    async with db.execute("SELECT COUNT(*) FROM images") as cursor:
+        assert (await cursor.fetchone())[0] == 0
+
+
+async def test_concurrent_reads_share_query(posts: PostRepository) -> None:
+    post_id = 1
+    await posts.insert(post_id, "user", "title", "text", 1)
+    await posts.db.commit()
+    queries = 0
+    fetchone = posts._fetchone
+
+    async def counting_fetchone(sql: str, params: Any = ()) -> Any:
+        nonlocal queries
+        queries += 1
+        return await fetchone(sql, params)
+
+    posts._fetchone = counting_fetchone  # type: ignore
+    results = await asyncio.gather(*(posts.get(post_id) for i in range(100)))
+    assert queries == 1
+    assert all(post.title == "title" for post in results)
+    # "1" from a URL and 1 are the same post
+    await asyncio.gather(posts.thumbnail(post_id), posts.thumbnail(str(post_id)))
+    assert queries == 2
+
+
+async def test_read_survives_cancelled_leader(posts: PostRepository) -> None:
+    post_id = 1
+    await posts.insert(post_id, "user", "title", "text", 1)
+    await posts.db.commit()
+    leader = asyncio.ensure_future(posts.get(post_id))
+    follower = asyncio.ensure_future(posts.get(post_id))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert (await follower).title == "title"
+    assert leader.cancelled()
+
+
+async def test_read_after_write_is_not_shared(posts: PostRepository) -> None:
+    post_id = 1
+    await posts.insert(post_id, "user", "title", "text", 1)
+    await posts.db.commit()
+    before = asyncio.ensure_future(posts.get(post_id))
+    for i in range(3):  # let the query reach the DB thread
+        await asyncio.sleep(0)
+    await posts.update(post_id, title="new title", version=2)
+    after = await posts.get(post_id)
+    assert after.title == "new title"
+    assert (await before).title == "title"
+
+
+async def test_begin_waits_for_stale_read(posts: PostRepository, db_path: Path) -> None:
+    for post_id, title in enumerate(["first", "second"], 1):
+        await posts.insert(post_id, "user", title, "text", 1)
+    await posts.db.commit()
+    # A concurrent request reads on the same connection...
+    cursor = await posts.db.execute("SELECT id FROM posts")
+    # ...while another connection commits, the read's snapshot is stale now
+    other = await connect_db(db_path)
+    await PostRepository(other).bump_revision()
+    await other.commit()
+    await other.close()
+
+    begin = asyncio.ensure_future(posts.begin())
+    await asyncio.sleep(0.005)
+    await cursor.close()
+    await begin
+    assert await posts.bump_revision() == 2
+    await posts.commit()
+
+
+async def test_write_transactions_take_turns(posts: PostRepository) -> None:
+    async def create(title: str) -> None:
+        async with posts.transaction():
+            version = await posts.bump_revision()
+            post_id = await posts.next_post_id()
+            await posts.insert(post_id, "user", title, "text", version)
+
+    async def delete_missing() -> None:
+        await posts.begin()
+        await posts.delete(100)
+        await posts.rollback()
+
+    await asyncio.gather(
+        *(create(f"title {i}") for i in range(5)), *(delete_missing() for i in range(5))
+    )
+    assert len(await posts.list()) == 5
+    assert await posts.revision() == 5
@@ -1,6 +1,8 @@
+import asyncio
 from pathlib import Path
 from typing import Any
 
+import aiohttp_jinja2
 import aiosqlite
 import pytest
 from aiohttp.test_utils import TestClient as _TestClient
@@ -14,6 +16,26 @@ async def client(aiohttp_client: Any, db_path: Path) -> _TestClient:
     return await aiohttp_client(app)
 
 
+async def test_ready_after_warm_up(client: _TestClient) -> None:
+    await client.server.app["WARM_UP"]
+    resp = await client.get("/ready")
+    assert resp.status == 200, await resp.text()
+    data = await resp.json()
+    assert data == {"data": {"ready": True}, "status": "ok"}
+
+    env = aiohttp_jinja2.get_env(client.server.app)
+    assert len(env.cache) == len(env.list_templates())
+
+
+async def test_not_ready_while_warming_up(client: _TestClient) -> None:
+    await client.server.app["WARM_UP"]
+    client.server.app["READY"].clear()  # as if still warming up
+    resp = await client.get("/ready")
+    assert resp.status == 503, await resp.text()
+    data = await resp.json()
+    assert data == {"reason": "warming up", "status": "failed"}
+
+
 async def test_list_empty(client: _TestClient) -> None:
     resp = await client.get("/api")
     assert resp.status == 200, await resp.text()
@@ -48,13 +70,106 @@ async def test_get_post(client: _TestClient, db: aiosqlite.Connection) -> None:
     resp = await client.get(f"/api/{post_id}")
     assert resp.status == 200
     data = await resp.json()
+    assert isinstance(data["data"]["id"], int)
     assert data == {
         "data": {
             "editor": "user",
-            "id": "1",
+            "id": post_id,
             "owner": "user",
             "text": "text",
             "title": "title",
         },
         "status": "ok",
     }
+
+
+async def test_get_post_not_modified(client: _TestClient) -> None:
+    POST_REQ = {"title": "test title", "text": "test text", "owner": "test user"}
+    resp = await client.post("/api", json=POST_REQ)
+    assert resp.status == 200, await resp.text()
+    post_id = (await resp.json())["data"]["id"]
+
+    resp = await client.get(f"/api/{post_id}")
+    assert resp.status == 200
+    etag = resp.headers["ETag"]
+
+    resp = await client.get(f"/api/{post_id}", headers={"If-None-Match": etag})
+    assert resp.status == 304
+    assert resp.headers["ETag"] == etag
+
+    resp = await client.patch(f"/api/{post_id}", json={"title": "new title"})
+    assert resp.status == 200, await resp.text()
+
+    resp = await client.get(f"/api/{post_id}", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert resp.headers["ETag"] != etag
+    data = await resp.json()
+    assert data["data"]["title"] == "new title"
+
+
+async def test_list_not_modified(client: _TestClient) -> None:
+    resp = await client.get("/api")
+    assert resp.status == 200
+    etag = resp.headers["ETag"]
+
+    resp = await client.get("/api", headers={"If-None-Match": etag})
+    assert resp.status == 304
+
+    POST_REQ = {"title": "test title", "text": "test text", "owner": "test user"}
+    resp = await client.post("/api", json=POST_REQ)
+    assert resp.status == 200, await resp.text()
+    post_id = (await resp.json())["data"]["id"]
+
+    resp = await client.get("/api", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    etag = resp.headers["ETag"]
+
+    resp = await client.delete(f"/api/{post_id}")
+    assert resp.status == 200
+    assert await resp.json() == {"status": "ok", "id": post_id}
+
+    resp = await client.get("/api", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert await resp.json() == {"data": [], "status": "ok"}
+
+
+async def test_concurrent_writes_are_kept(
+    client: _TestClient, db: aiosqlite.Connection
+) -> None:
+    async def create(i: int) -> None:
+        post = {"title": f"title {i}", "text": "text", "owner": "user"}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200, await resp.text()
+
+    async def delete_missing(i: int) -> None:
+        resp = await client.delete(f"/api/{100 + i}")
+        assert resp.status == 404
+
+    await asyncio.gather(
+        *(create(i) for i in range(5)), *(delete_missing(i) for i in range(5))
+    )
+    async with db.execute("SELECT COUNT(*), MAX(version) FROM posts") as cursor:
+        assert tuple(await cursor.fetchone()) == (5, 5)
+    async with db.execute("SELECT value FROM revision") as cursor:
+        assert (await cursor.fetchone())[0] == 5
+    resp = await client.get("/api")
+    assert len((await resp.json())["data"]) == 5
+
+
+async def test_list_filter_and_order(client: _TestClient) -> None:
+    for owner, title in [("alice", "b"), ("bob", "c"), ("alice", "a")]:
+        post = {"title": title, "text": "text", "owner": owner}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200
+    await client.patch("/api/2", json={"editor": "alice"})
+
+    resp = await client.get("/api", params={"owner": "alice", "order": "title"})
+    data = await resp.json()
+    assert [post["id"] for post in data["data"]] == [3, 1]
+
+    resp = await client.get("/api", params={"editor": "alice", "order": "-id"})
+    data = await resp.json()
+    assert [post["id"] for post in data["data"]] == [3, 2, 1]
+
+    resp = await client.get("/api", params={"order": "random"})
+    assert resp.status == 400
@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+from typing import Any, Type
+
+import pytest
+
+from proj.repository import PostSummary
+from proj.serializer import JSONSerializer, OrjsonSerializer, make_serializer, orjson
+from proj.server import init_app
+
+
+SERIALIZERS = [JSONSerializer]
+if orjson is not None:
+    SERIALIZERS.append(OrjsonSerializer)
+
+
+@pytest.mark.parametrize("factory", SERIALIZERS)
+def test_ok_records(factory: Type[JSONSerializer]) -> None:
+    serializer = factory()
+    records = [
+        PostSummary(1, "user", "user", 'quotes " and \\ and ü'),
+        PostSummary(2, "user", None, None),
+    ]
+    assert json.loads(serializer.ok_records(records)) == {
+        "status": "ok",
+        "data": [
+            {
+                "id": 1,
+                "owner": "user",
+                "editor": "user",
+                "title": 'quotes " and \\ and ü',
+            },
+            {"id": 2, "owner": "user", "editor": None, "title": None},
+        ],
+    }
+    assert json.loads(serializer.ok_records([])) == {"status": "ok", "data": []}
+
+
+@pytest.mark.parametrize("factory", SERIALIZERS)
+def test_envelopes(factory: Type[JSONSerializer]) -> None:
+    serializer = factory()
+    assert json.loads(serializer.ok({"a": [1, 2.5, True]})) == {
+        "status": "ok",
+        "data": {"a": [1, 2.5, True]},
+    }
+    assert json.loads(serializer.failed("error")) == {
+        "status": "failed",
+        "reason": "error",
+    }
+
+
+def test_make_serializer() -> None:
+    assert make_serializer("json").name == "json"
+    assert make_serializer().name == ("orjson" if orjson is not None else "json")
+    with pytest.raises(ValueError, match="Unknown JSON serializer 'yaml'"):
+        make_serializer("yaml")
+
+
+@pytest.mark.parametrize("factory", SERIALIZERS)
+async def test_api_uses_serializer(
+    aiohttp_client: Any, db_path: Path, factory: Type[JSONSerializer]
+) -> None:
+    app = await init_app(db_path, serializer=factory())
+    client = await aiohttp_client(app)
+    post = {"title": "test title", "text": "test text", "owner": "test user"}
+    resp = await client.post("/api", json=post)
+    assert resp.status == 200, await resp.text()
+    resp = await client.get("/api")
+    assert resp.content_type == "application/json"
+    data = await resp.json()
+    assert data == {
+        "status": "ok",
+        "data": [
+            {
+                "id": 1,
+                "owner": "test user",
+                "editor": "test user",
+                "title": "test title",
+            }
+        ],
+    }
+    resp = await client.get("/api/100")
+    assert resp.status == 400
+    assert await resp.json() == {"status": "failed", "reason": "Post 100 doesn't exist"}
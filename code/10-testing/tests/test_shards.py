@@ -0,0 +1,120 @@
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+import pytest
+from aiohttp.test_utils import TestClient as _TestClient
+
+from proj.server import init_app, shard_db_path, try_make_db
+
+
+@pytest.fixture
+def sharded_db_path(tmp_path: Path) -> Path:
+    path = tmp_path / "sharded.db"
+    try_make_db(path, shards=3)
+    return path
+
+
+@pytest.fixture
+async def client(aiohttp_client: Any, sharded_db_path: Path) -> _TestClient:
+    app = await init_app(sharded_db_path)
+    return await aiohttp_client(app)
+
+
+def shard_ids(db_path: Path, index: int) -> Any:
+    with sqlite3.connect(shard_db_path(db_path, index)) as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM posts ORDER BY id")]
+
+
+async def test_posts_spread_over_shards(
+    client: _TestClient, sharded_db_path: Path
+) -> None:
+    ids = []
+    for i in range(6):
+        post = {"title": f"title {i}", "text": "text", "owner": "user"}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200, await resp.text()
+        ids.append((await resp.json())["data"]["id"])
+    assert ids == [1, 2, 3, 4, 5, 6]
+    for index in range(3):
+        ids = shard_ids(sharded_db_path, index)
+        assert len(ids) == 2
+        assert all(post_id % 3 == index for post_id in ids)
+
+    resp = await client.get("/api")
+    data = await resp.json()
+    assert [post["id"] for post in data["data"]] == [1, 2, 3, 4, 5, 6]
+
+
+async def test_routing_by_id(client: _TestClient, sharded_db_path: Path) -> None:
+    for i in range(3):
+        post = {"title": f"title {i}", "text": "text", "owner": "user"}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200
+
+    resp = await client.get("/api")
+    etag = resp.headers["ETag"]
+
+    resp = await client.patch("/api/2", json={"title": "new title"})
+    assert resp.status == 200, await resp.text()
+    resp = await client.get("/api/2")
+    assert (await resp.json())["data"]["title"] == "new title"
+
+    resp = await client.get("/api", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert resp.headers["ETag"] != etag
+
+    resp = await client.delete("/api/2")
+    assert resp.status == 200
+    resp = await client.delete("/api/2")
+    assert resp.status == 404
+    assert 2 not in shard_ids(sharded_db_path, 2)
+    resp = await client.get("/api")
+    data = await resp.json()
+    assert [post["id"] for post in data["data"]] == [1, 3]
+
+
+async def test_filtered_gather(aiohttp_client: Any, sharded_db_path: Path) -> None:
+    app = await init_app(sharded_db_path, post_index=False)
+    client = await aiohttp_client(app)
+    for owner, title in [("alice", "b"), ("bob", "c"), ("alice", "a"), ("alice", "c")]:
+        post = {"title": title, "text": "text", "owner": owner}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200
+
+    resp = await client.get("/api", params={"owner": "alice", "order": "-title"})
+    data = await resp.json()
+    assert [post["id"] for post in data["data"]] == [4, 1, 3]
+
+
+async def test_newest_first_across_shards(
+    aiohttp_client: Any, sharded_db_path: Path
+) -> None:
+    app = await init_app(sharded_db_path, post_index=False)
+    client = await aiohttp_client(app)
+    for i in range(5):
+        post = {"title": f"title {i}", "text": "text", "owner": "user"}
+        resp = await client.post("/api", json=post)
+        assert resp.status == 200
+
+    resp = await client.get("/api", params={"order": "-id"})
+    data = await resp.json()
+    assert [post["title"] for post in data["data"]] == [
+        f"title {i}" for i in reversed(range(5))
+    ]
+
+
+async def test_ids_continue_after_existing_posts(
+    aiohttp_client: Any, sharded_db_path: Path
+) -> None:
+    # Posts of a release without the id sequence
+    with sqlite3.connect(shard_db_path(sharded_db_path, 1)) as conn:
+        conn.execute("INSERT INTO posts (id, title, owner) VALUES (7, 'old', 'user')")
+    conn.close()
+    client = await aiohttp_client(await init_app(sharded_db_path))
+
+    post = {"title": "new", "text": "text", "owner": "user"}
+    resp = await client.post("/api", json=post)
+    assert resp.status == 200
+    assert (await resp.json())["data"]["id"] == 8
+    assert shard_ids(sharded_db_path, 2) == [8]
@@ -0,0 +1,42 @@
+import subprocess
+import sys
+from typing import Dict
+
+
+# Cold import of the CLI, aiohttp alone takes longer than this
+IMPORT_BUDGET_MS = 150
+HEAVY_MODULES = ["asyncio", "aiohttp", "aiosqlite", "yarl", "proj.restclient"]
+
+
+def import_times(*args: str) -> Dict[str, float]:
+    """Run python -X importtime, return cumulative import times in ms"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():  # skip the header
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def test_help_skips_heavy_imports() -> None:
+    times = import_times("-m", "proj.client", "--help")
+    assert "click" in times
+    for name in HEAVY_MODULES:
+        assert name not in times
+
+
+def test_import_time_budget() -> None:
+    # The best of several runs, a busy machine shouldn't fail the test
+    best = min(
+        import_times("-c", "import proj.client")["proj.client"] for _ in range(3)
+    )
+    assert best < IMPORT_BUDGET_MS
@@ -0,0 +1,160 @@
+import functools
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Callable, Iterator, Set
+
+import pytest
+
+from proj.workers import Supervisor
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url: str) -> Any:
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+@pytest.fixture
+def server_url(db_path: Path) -> Iterator[str]:
+    port = _free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "proj.server",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            "2",
+            "--db",
+            str(db_path),
+        ],
+        cwd=Path(__file__).parent.parent,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                _get(url + "/api")
+                break
+            except OSError:
+                if time.monotonic() > deadline or proc.poll() is not None:
+                    raise
+                time.sleep(0.1)
+        yield url
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=30) == 0
+
+
+def test_workers_share_socket(server_url: str) -> None:
+    for _ in range(20):
+        assert _get(server_url + "/api") == {"status": "ok", "data": []}
+
+
+def _record_start(path: Path, lifetime: float) -> None:
+    # Worker target, a file per started worker named by its pid
+    (path / str(os.getpid())).write_text(str(time.monotonic()))
+    time.sleep(lifetime)
+
+
+def _started(path: Path) -> Set[int]:
+    return {int(item.name) for item in path.iterdir()}
+
+
+def _alive(pids: Set[int]) -> Set[int]:
+    # Dead workers are reaped by the supervisor, their pids are gone
+    ret = set()
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            continue
+        ret.add(pid)
+    return ret
+
+
+def _wait_for(predicate: Callable[[], bool], timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def supervise(tmp_path: Path) -> Iterator[Callable[[Supervisor], int]]:
+    procs = []
+
+    def start(supervisor: Supervisor) -> int:
+        proc = multiprocessing.get_context("fork").Process(target=supervisor.run)
+        proc.start()
+        procs.append(proc)
+        assert proc.pid is not None
+        return proc.pid
+
+    yield start
+    for proc in procs:
+        proc.terminate()
+        proc.join(30)
+        assert proc.exitcode == 0
+
+
+def test_crashed_worker_is_replaced(
+    tmp_path: Path, supervise: Callable[[Supervisor], int]
+) -> None:
+    target = functools.partial(_record_start, tmp_path, 60)
+    supervise(Supervisor(target, 2, poll_interval=0.05))
+    _wait_for(lambda: len(_started(tmp_path)) == 2)
+    first = _started(tmp_path)
+
+    victim = min(first)
+    os.kill(victim, signal.SIGKILL)
+    _wait_for(lambda: len(_started(tmp_path)) == 3)
+    _wait_for(lambda: victim not in _alive(first))
+    assert _alive(_started(tmp_path)) == _started(tmp_path) - {victim}
+
+
+def test_crashlooping_worker_backs_off(
+    tmp_path: Path, supervise: Callable[[Supervisor], int]
+) -> None:
+    target = functools.partial(_record_start, tmp_path, 0)
+    supervise(Supervisor(target, 1, poll_interval=0.05))
+    time.sleep(1.5)
+
+    starts = sorted(float(item.read_text()) for item in tmp_path.iterdir())
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    # Without backoff a worker would be spawned every poll interval
+    assert 3 <= len(starts) <= 8
+    assert gaps[-1] > 2 * gaps[0]
+
+
+def test_rolling_restart_on_sighup(
+    tmp_path: Path, supervise: Callable[[Supervisor], int]
+) -> None:
+    target = functools.partial(_record_start, tmp_path, 60)
+    pid = supervise(Supervisor(target, 2, poll_interval=0.05))
+    _wait_for(lambda: len(_started(tmp_path)) == 2)
+    first = _started(tmp_path)
+
+    os.kill(pid, signal.SIGHUP)
+    _wait_for(lambda: len(_started(tmp_path)) == 4)
+    _wait_for(lambda: not _alive(first))
+    new = _started(tmp_path) - first
+    assert len(new) == 2
+    assert _alive(new) == new